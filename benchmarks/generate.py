@@ -0,0 +1,103 @@
+import os
+import random
+import shutil
+from typing import List
+
+class TreeSpec:
+    """
+    Shape of a synthetic directory tree.
+
+    Sizes are drawn from a log-normal distribution clamped to [min_size, max_size]
+    (or uniformly when size_distribution is 'uniform'). A duplicate_ratio fraction of
+    files reuse the content of an earlier file, and change_rate is the fraction of
+    files touched by each call to `mutate_tree`.
+    """
+
+    def __init__(self, files: int = 1000, min_size: int = 128, max_size: int = 64 * 1024,
+                 size_distribution: str = 'lognormal', depth: int = 3, fanout: int = 4,
+                 duplicate_ratio: float = 0.1, change_rate: float = 0.05, seed: int = 0):
+        if size_distribution not in ('lognormal', 'uniform'):
+            raise ValueError(f"Unknown size distribution: {size_distribution}")
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size_distribution = size_distribution
+        self.depth = depth
+        self.fanout = fanout
+        self.duplicate_ratio = duplicate_ratio
+        self.change_rate = change_rate
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+def _directories(spec: TreeSpec) -> List[str]:
+    dirs = ['']
+    level = ['']
+    for _ in range(spec.depth):
+        level = [os.path.join(parent, f'd{i}') for parent in level for i in range(spec.fanout)]
+        dirs.extend(level)
+    return dirs
+
+def _file_size(rng: random.Random, spec: TreeSpec) -> int:
+    if spec.size_distribution == 'uniform':
+        return rng.randint(spec.min_size, spec.max_size)
+    # Median around the geometric mean of the bounds, long tail towards max_size
+    mu = (spec.min_size * spec.max_size) ** 0.5
+    size = int(rng.lognormvariate(0, 1) * mu / 2)
+    return max(spec.min_size, min(spec.max_size, size))
+
+def _content(rng: random.Random, size: int) -> bytes:
+    # Half random, half repeated so that compression has something to do
+    half = size // 2
+    return rng.getrandbits(half * 8).to_bytes(half, 'little') + b'x' * (size - half)
+
+def generate_tree(root: str, spec: TreeSpec) -> List[str]:
+    """Create a deterministic synthetic tree under root and return its relative file paths."""
+    rng = random.Random(spec.seed)
+    dirs = _directories(spec)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    paths = []
+    contents = []
+    for i in range(spec.files):
+        rel_path = os.path.join(rng.choice(dirs), f'f{i}.bin')
+        if contents and rng.random() < spec.duplicate_ratio:
+            content = rng.choice(contents)
+        else:
+            content = _content(rng, _file_size(rng, spec))
+            contents.append(content)
+        with open(os.path.join(root, rel_path), 'wb') as f:
+            f.write(content)
+        paths.append(rel_path)
+    return paths
+
+def mutate_tree(root: str, spec: TreeSpec, paths: List[str], round_number: int = 1) -> List[str]:
+    """
+    Modify, delete and add files in a tree created by `generate_tree`.
+
+    A change_rate fraction of the files is touched: 80% rewritten, 10% deleted and
+    10% replaced by new files. Returns the updated list of relative paths.
+    """
+    rng = random.Random(spec.seed * 1000003 + round_number)
+    paths = list(paths)
+    changes = max(1, int(len(paths) * spec.change_rate)) if paths else 0
+    for rel_path in rng.sample(paths, changes):
+        roll = rng.random()
+        full_path = os.path.join(root, rel_path)
+        if roll < 0.8:
+            with open(full_path, 'wb') as f:
+                f.write(_content(rng, _file_size(rng, spec)))
+        elif roll < 0.9:
+            os.remove(full_path)
+            paths.remove(rel_path)
+        else:
+            new_path = os.path.join(os.path.dirname(rel_path), f'r{round_number}_{os.path.basename(rel_path)}')
+            with open(os.path.join(root, new_path), 'wb') as f:
+                f.write(_content(rng, _file_size(rng, spec)))
+            paths.append(new_path)
+    return paths
+
+def remove_tree(root: str) -> None:
+    shutil.rmtree(root, ignore_errors=True)
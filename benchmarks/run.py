@@ -0,0 +1,211 @@
+"""
+Benchmark suite for pyfilesnap.
+
+Each operation runs in a freshly spawned process against a copy of the same
+synthetic repository, so wall time, peak RSS and bytes written are comparable
+between operations and between runs. Results are written as JSON; pass a
+previous result file with --compare to flag regressions.
+
+    python -m benchmarks.run --files 2000 --output results.json
+    python -m benchmarks.run --files 2000 --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+import multiprocessing
+from datetime import datetime
+from typing import List
+
+from benchmarks.generate import TreeSpec, generate_tree, mutate_tree
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+BACKUP_DIR = '.pyfilesnap'
+OPERATIONS = ('snapshot', 'incremental_snapshot', 'restore', 'partial_restore', 'listing')
+
+def _wait_next_second() -> None:
+    # Snapshot names have a one second resolution
+    time.sleep(1 - (time.time() % 1) + 0.01)
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def _peak_rss_kb() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def _operation_child(operation: str, target: str, compress: bool, conn) -> None:
+    from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+    from pyfilesnap.restore import Restore
+
+    backup_path = os.path.join(target, BACKUP_DIR)
+    size_before = _dir_size(backup_path) if os.path.exists(backup_path) else 0
+    bytes_written = None
+    start = time.perf_counter()
+    if operation in ('snapshot', 'incremental_snapshot'):
+        Snapshot(target, config=SnapshotConfig(compress=compress)).take_snapshot()
+    elif operation == 'restore':
+        restore = Restore(target)
+        restore.restore_last()
+        bytes_written = restore.last_stats.counters.get('bytes_written', 0)
+    elif operation == 'partial_restore':
+        # Restore a single top-level directory of the latest snapshot
+        restore = Restore(target)
+        restore.restore_last(paths=['d0'])
+        bytes_written = restore.last_stats.counters.get('bytes_written', 0)
+    elif operation == 'listing':
+        Restore(target)._get_snapshots()
+    else:
+        raise ValueError(f"Unknown operation: {operation}")
+    wall = time.perf_counter() - start
+    if bytes_written is None:
+        bytes_written = max(0, _dir_size(backup_path) - size_before)
+    conn.send({'wall': wall, 'peak_rss_kb': _peak_rss_kb(), 'bytes_written': bytes_written})
+    conn.close()
+
+def _measure(operation: str, target: str, compress: bool) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_operation_child, args=(operation, target, compress, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError(f"Benchmark of {operation} failed with exit code {process.exitcode}")
+    return result
+
+def _build_repository(root: str, spec: TreeSpec, compress: bool, history: int) -> List[str]:
+    """Create a tree with `history` snapshots, mutating it between snapshots."""
+    from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+
+    paths = generate_tree(root, spec)
+    snapshot = Snapshot(root, config=SnapshotConfig(compress=compress))
+    for round_number in range(history):
+        if round_number:
+            paths = mutate_tree(root, spec, paths, round_number)
+            _wait_next_second()
+        snapshot.take_snapshot()
+    return paths
+
+def _prepare(operation: str, template: str, workdir: str, spec: TreeSpec, paths: List[str], history: int) -> str:
+    target = os.path.join(workdir, operation)
+    if operation == 'snapshot':
+        shutil.copytree(template, target, ignore=shutil.ignore_patterns(BACKUP_DIR))
+        return target
+    shutil.copytree(template, target)
+    if operation in ('incremental_snapshot', 'restore'):
+        mutate_tree(target, spec, paths, history + 1)
+        _wait_next_second()
+    return target
+
+def run_benchmarks(spec: TreeSpec, repeat: int = 3, history: int = 3, operations=OPERATIONS) -> dict:
+    results = {}
+    for compress in (False, True):
+        mode = 'compressed' if compress else 'uncompressed'
+        workdir = tempfile.mkdtemp(prefix='pyfilesnap-bench-')
+        try:
+            template = os.path.join(workdir, 'template')
+            paths = _build_repository(template, spec, compress, history)
+            for operation in operations:
+                runs = []
+                for i in range(repeat):
+                    target = _prepare(operation, template, os.path.join(workdir, f'run{i}'), spec, paths, history)
+                    runs.append(_measure(operation, target, compress))
+                    shutil.rmtree(target)
+                results[f'{operation}[{mode}]'] = {
+                    'wall': statistics.median(r['wall'] for r in runs),
+                    'wall_min': min(r['wall'] for r in runs),
+                    'peak_rss_kb': max(r['peak_rss_kb'] for r in runs),
+                    'bytes_written': int(statistics.median(r['bytes_written'] for r in runs)),
+                    'repeat': repeat,
+                }
+                print(f"{operation}[{mode}]: {results[f'{operation}[{mode}]']['wall']:.3f}s", file=sys.stderr)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'spec': spec.to_dict(),
+            'history': history,
+        },
+        'results': results,
+    }
+
+def compare_results(baseline: dict, current: dict, threshold: float = 0.2) -> List[str]:
+    """Return a description of every metric that regressed by more than threshold."""
+    regressions = []
+    if baseline['meta'].get('spec') != current['meta'].get('spec'):
+        regressions.append("Tree specs differ, results are not comparable")
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric in ('wall', 'peak_rss_kb', 'bytes_written'):
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name} {metric}: {base[metric]} -> {result[metric]}")
+    return regressions
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the pyfilesnap benchmark suite.")
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--min-size', type=int, default=128)
+    parser.add_argument('--max-size', type=int, default=64 * 1024)
+    parser.add_argument('--size-distribution', choices=('lognormal', 'uniform'), default='lognormal')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--change-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', type=int, default=3, help="Number of snapshots taken before measuring")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare against a previous results file")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args(argv)
+
+    spec = TreeSpec(files=args.files, min_size=args.min_size, max_size=args.max_size,
+                    size_distribution=args.size_distribution, depth=args.depth, fanout=args.fanout,
+                    duplicate_ratio=args.duplicate_ratio, change_rate=args.change_rate, seed=args.seed)
+    results = run_benchmarks(spec, repeat=args.repeat, history=args.history, operations=args.operations)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 from .snapshot import Snapshot
-from .restore import Restore
\ No newline at end of file
+from .restore import Restore
+from .transfer import export, import_stream
\ No newline at end of file
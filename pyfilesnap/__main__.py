@@ -0,0 +1,52 @@
+import os
+import sys
+import argparse
+import logging
+from typing import List, Optional
+from .snapshot import Snapshot, SnapshotConfig, CATALOG_FILE
+from .store import OBJECTS_DIR
+from .transfer import export, import_stream, FORMATS
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='pyfilesnap', description='Replicate pyfilesnap snapshots through pipes.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log debug messages to stderr')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    export_parser = commands.add_parser('export', help='Write a snapshot to stdout')
+    export_parser.add_argument('target_dir', help='Directory the snapshots were taken of')
+    export_parser.add_argument('--snapshot', help='Snapshot to export, the latest by default')
+    export_parser.add_argument('--base', help='Only export the changes since this snapshot')
+    export_parser.add_argument('--format', choices=FORMATS, default='pack')
+    export_parser.add_argument('--backup-dir', default='.pyfilesnap')
+
+    import_parser = commands.add_parser('import', help='Read a snapshot from stdin')
+    import_parser.add_argument('target_dir', help='Directory of the repository to import into')
+    import_parser.add_argument('--backup-dir', default='.pyfilesnap')
+    import_parser.add_argument('--compress', action='store_true', help='Compress a new repository')
+    import_parser.add_argument('--object-store', action='store_true', help='Use an object store in a new repository')
+    return parser
+
+def _open(target_dir: str, backup_dir: str, compress: bool = False, object_store: bool = False) -> Snapshot:
+    """Open a repository with the storage options it was created with; the flags only apply to a new one."""
+    backup_path = os.path.join(target_dir, backup_dir)
+    if os.path.exists(os.path.join(backup_path, CATALOG_FILE)):
+        compress = os.path.exists(os.path.join(backup_path, 'snapshots.tar.gz'))
+        object_store = object_store or os.path.isdir(os.path.join(backup_path, OBJECTS_DIR))
+    config = SnapshotConfig(compress=compress, object_store=object_store)
+    return Snapshot(target_dir, backup_dir, config=config)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
+    if args.command == 'export':
+        snapshot = _open(args.target_dir, args.backup_dir)
+        export(snapshot, sys.stdout.buffer, args.snapshot, format=args.format, base=args.base)
+    else:
+        snapshot = _open(args.target_dir, args.backup_dir, args.compress, args.object_store)
+        print(import_stream(snapshot, sys.stdin.buffer), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+class LRUCache:
+    """
+    A thread-safe cache bounded by the total size of its values.
+
+    Sizes are given by the caller when inserting, the least recently used entries
+    are evicted once max_bytes is exceeded. Entries are tagged with a version:
+    setting a different version (e.g. a new catalog version) drops everything.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.version: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def set_version(self, version: int) -> None:
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.current_bytes = 0
+                self.version = version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+_caches: Dict[str, LRUCache] = {}
+_caches_lock = threading.Lock()
+
+def get_cache(backup_dir: str, max_bytes: int = DEFAULT_CACHE_SIZE) -> LRUCache:
+    """Return the cache shared by all Snapshot and Restore objects of a backup directory."""
+    with _caches_lock:
+        cache = _caches.get(backup_dir)
+        if cache is None:
+            cache = _caches[backup_dir] = LRUCache(max_bytes)
+        cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+from typing import Dict, Optional, Set, Tuple
+from .store import ObjectRef
+
+CHECKPOINT_DIR = 'checkpoint'
+PROGRESS_FILE = 'progress.jsonl'
+
+def read_progress(path: str) -> Dict[str, list]:
+    """Read a progress log into {path: index entry}, ignoring a torn last line."""
+    entries = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, list) and len(record) >= 5:
+                    entries[record[0]] = record[1:]
+    except FileNotFoundError:
+        pass
+    return entries
+
+def checkpoint_digests(backup_dir: str) -> Set[str]:
+    """Digests of the objects stored by an unfinished capture, which no snapshot references yet."""
+    progress = read_progress(os.path.join(backup_dir, CHECKPOINT_DIR, PROGRESS_FILE))
+    return set(entry[2] for entry in progress.values())
+
+class Checkpoint:
+    """
+    Progress log of a resumable snapshot capture.
+
+    Every file read is stored in the object store right away and appended to
+    checkpoint/progress.jsonl as [path, size, mtime_ns, digest, mode, ...]. A restarted
+    capture reuses the entries of files whose size and mtime did not change and
+    whose object exists, instead of reading them again. The log is fsynced every
+    sync_interval files and removed once the snapshot is published.
+    """
+
+    def __init__(self, backup_dir: str, store, sync_interval: int = 1000):
+        self.dir = os.path.join(backup_dir, CHECKPOINT_DIR)
+        self.path = os.path.join(self.dir, PROGRESS_FILE)
+        self.store = store
+        self.sync_interval = sync_interval
+        self.entries: Dict[str, list] = {}
+        self._file = None
+        self._unsynced = 0
+
+    def open(self) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        self.entries = read_progress(self.path)
+        if self.entries:
+            logging.debug(f"Resuming capture with {len(self.entries)} files already stored")
+        self._file = open(self.path, 'a')
+        if self._file.tell() > 0:
+            # Terminate a line torn by the interruption, so the next record stays readable
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def resume(self, relative_path: str, st: os.stat_result) -> Optional[Tuple[list, ObjectRef]]:
+        """Return the recorded entry and object of an unchanged file, or None if it must be read."""
+        entry = self.entries.get(relative_path)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns or not self.store.has(entry[2]):
+            return None
+        return entry, ObjectRef(entry[2], entry[0])
+
+    def commit(self, relative_path: str, data: bytes, entry: list) -> Tuple[ObjectRef, int]:
+        """Store a file's content and record it. Returns its reference and the bytes written."""
+        # Logged before the object is written: a repack lists loose objects before reading
+        # this log, so it never sees an object of the capture as unreferenced
+        self._file.write(json.dumps([relative_path] + entry) + '\n')
+        self._file.flush()
+        written = self.store.put(data, entry[2])
+        self._unsynced += 1
+        if self._unsynced >= self.sync_interval:
+            self.sync()
+        return ObjectRef(entry[2], entry[0]), written
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def discard(self) -> None:
+        """Remove the log once its snapshot is published."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
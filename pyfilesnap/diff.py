@@ -1,4 +1,5 @@
-from typing import Dict, Optional
+import difflib
+from typing import Dict, List, Optional
 
 def create_diff(old_data: Dict[str, bytes], new_data: Dict[str, bytes]) -> Dict[str, Optional[bytes]]:
     """
@@ -25,21 +26,89 @@ def create_diff(old_data: Dict[str, bytes], new_data: Dict[str, bytes]) -> Dict[
     
     return diff
 
-def apply_diff(base_data: Dict[str, bytes], diff_data: Dict[str, Optional[bytes]]) -> Dict[str, bytes]:
+def apply_diff(base_data: Dict[str, bytes], diff_data: Dict[str, Optional[bytes]],
+               moves: Optional[Dict[str, str]] = None) -> Dict[str, bytes]:
     """
     Apply a diff to base data.
 
     Args:
         base_data (Dict[str, bytes]): The base file data.
         diff_data (Dict[str, Optional[bytes]]): The diff to apply.
+        moves (Optional[Dict[str, str]]): Destination to source paths. Each destination
+            takes the content its source had in the base data, before the diff is applied.
 
     Returns:
         Dict[str, bytes]: The result of applying the diff to the base data.
     """
     result = base_data.copy()
+    for dest_path, src_path in (moves or {}).items():
+        if src_path in base_data:
+            result[dest_path] = base_data[src_path]
     for file_path, content in diff_data.items():
         if content is None:
             result.pop(file_path, None)  # Remove the file if it exists
         else:
             result[file_path] = content
-    return result
\ No newline at end of file
+    return result
+
+def detect_moves(old_digests: Dict[str, str], new_index: Dict[str, list], changed: List[str],
+                 deleted: List[str]) -> Dict[str, str]:
+    """
+    Find changed files whose content already existed in the old state.
+
+    Args:
+        old_digests (Dict[str, str]): Content digest of every old path.
+        new_index (Dict[str, list]): The new [size, mtime_ns, digest, ...] entries.
+        changed (List[str]): New or modified paths.
+        deleted (List[str]): Deleted paths, preferred as sources so that renames are detected as such.
+
+    Returns:
+        Dict[str, str]: Destination to source paths. A source that is also deleted makes
+        the pair a rename, otherwise it is a copy.
+    """
+    deleted_paths = set(deleted)
+    paths_by_digest = {}
+    for path, digest in old_digests.items():
+        paths_by_digest.setdefault(digest, []).append(path)
+
+    moves = {}
+    for path in changed:
+        candidates = paths_by_digest.get(new_index[path][2])
+        if not candidates:
+            continue
+        moves[path] = next((c for c in candidates if c in deleted_paths), candidates[0])
+    return moves
+
+def find_similar(new_contents: Dict[str, bytes], old_contents: Dict[str, bytes], threshold: float,
+                 max_candidates: int = 20) -> Dict[str, str]:
+    """
+    Pair new files with the most similar removed file, for renames combined with small edits.
+
+    Args:
+        new_contents (Dict[str, bytes]): Content of the added files.
+        old_contents (Dict[str, bytes]): Content of the removed files.
+        threshold (float): Minimum similarity ratio, between 0 and 1.
+        max_candidates (int): Number of removed files, closest in size, compared to each new file.
+
+    Returns:
+        Dict[str, str]: Destination to source paths. Each source is used at most once.
+    """
+    moves = {}
+    available = dict(old_contents)
+    for new_path, new_content in new_contents.items():
+        candidates = sorted(available, key=lambda p: abs(len(available[p]) - len(new_content)))[:max_candidates]
+        best_path, best_ratio = None, threshold
+        for old_path in candidates:
+            old_content = available[old_path]
+            if min(len(old_content), len(new_content)) < threshold * max(len(old_content), len(new_content)):
+                continue
+            matcher = difflib.SequenceMatcher(None, old_content, new_content, autojunk=False)
+            if matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best_path, best_ratio = old_path, ratio
+        if best_path is not None:
+            moves[new_path] = best_path
+            del available[best_path]
+    return moves
@@ -0,0 +1,106 @@
+import os
+import time
+import socket
+import logging
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+class RepositoryLock:
+    """
+    Exclusive lock on a backup directory, held by snapshot writers.
+
+    Uses fcntl.flock where available, so a lock held by a crashed process is
+    released by the kernel. Elsewhere it falls back to an O_EXCL lock file holding
+    the owner's pid and host; the file is considered stale and removed when that
+    process no longer exists, or when it is older than stale_after seconds.
+    """
+
+    def __init__(self, backup_dir: str, timeout: Optional[float] = None,
+                 poll_interval: float = 0.05, stale_after: float = 3600.0):
+        self.path = os.path.join(backup_dir, 'lock')
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self._fd: Optional[int] = None
+
+    def _owner(self) -> str:
+        return f'{os.getpid()}@{socket.gethostname()}\n'
+
+    def _try_flock(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (BlockingIOError, PermissionError):
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, self._owner().encode())
+        self._fd = fd
+        return True
+
+    def _is_stale(self) -> bool:
+        try:
+            with open(self.path) as f:
+                owner = f.read().strip()
+            age = time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return False
+        pid, _, host = owner.partition('@')
+        if host == socket.gethostname() and pid.isdigit() and not _pid_alive(int(pid)):
+            return True
+        return age > self.stale_after
+
+    def _try_lockfile(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if self._is_stale():
+                logging.warning(f"Removing stale repository lock {self.path}")
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            return False
+        os.write(fd, self._owner().encode())
+        self._fd = fd
+        return True
+
+    def acquire(self) -> None:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        try_lock = self._try_flock if fcntl is not None else self._try_lockfile
+        while not try_lock():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Could not acquire repository lock {self.path} within {self.timeout} seconds")
+            time.sleep(self.poll_interval)
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            # Keep the file: unlinking a flock'ed file lets two processes lock different inodes
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        else:
+            os.close(self._fd)
+            os.remove(self.path)
+        self._fd = None
+
+    def __enter__(self) -> 'RepositoryLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
@@ -0,0 +1,395 @@
+import sys
+import json
+import mmap
+import struct
+import bisect
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+from .utils import atomic_write
+
+MAGIC = b'PFSM'
+FORMAT_VERSION = 2
+DIGEST_SIZE = 32  # sha256
+RESTART_INTERVAL = 16
+# Owner of entries recorded without ownership
+NO_OWNER = -1
+# magic, version, count, restart interval, meta size, paths size, xattrs size
+_HEADER = struct.Struct('<4sIQIIQQ')
+
+def _encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _decode_varint(buf, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _pad(length: int) -> int:
+    return -length % 8
+
+class ManifestEntry:
+    """A read-only view of one manifest row."""
+
+    __slots__ = ('_manifest', '_i')
+
+    def __init__(self, manifest: 'Manifest', i: int):
+        self._manifest = manifest
+        self._i = i
+
+    @property
+    def path(self) -> str:
+        return self._manifest.path_at(self._i)
+
+    @property
+    def size(self) -> int:
+        return self._manifest.sizes[self._i]
+
+    @property
+    def mtime_ns(self) -> int:
+        return self._manifest.mtimes[self._i]
+
+    @property
+    def mode(self) -> int:
+        return self._manifest.modes[self._i]
+
+    @property
+    def uid(self) -> int:
+        return self._manifest.uids[self._i]
+
+    @property
+    def gid(self) -> int:
+        return self._manifest.gids[self._i]
+
+    @property
+    def xattrs(self) -> Dict[str, str]:
+        """Extended attributes, with base64-encoded values."""
+        return self._manifest.xattrs.get(self.path, {})
+
+    @property
+    def digest(self) -> str:
+        return bytes(self._manifest.digests[self._i * DIGEST_SIZE:(self._i + 1) * DIGEST_SIZE]).hex()
+
+    def to_list(self) -> list:
+        entry = [self.size, self.mtime_ns, self.digest, self.mode]
+        if self.uid != NO_OWNER:
+            entry += [self.uid, self.gid]
+            if self.xattrs:
+                entry.append(self.xattrs)
+        return entry
+
+    def __repr__(self) -> str:
+        return f'ManifestEntry({self.path!r}, size={self.size}, digest={self.digest[:12]})'
+
+class Manifest:
+    """
+    Compact, sorted table of the files of a snapshot.
+
+    Paths are sorted and front-coded (each path stores only the suffix it does not
+    share with the previous one, with a full path every RESTART_INTERVAL rows for
+    random access). Size, mtime, mode, owner and digest live in fixed-width arrays,
+    so a manifest costs a few dozen bytes per file instead of several Python
+    objects. The rare extended attributes are kept in a separate JSON section.
+    Manifests saved to disk are loaded through mmap without copying the arrays.
+    """
+
+    def __init__(self, paths_blob, restarts, sizes, mtimes, modes, uids, gids, digests, count: int,
+                 meta: Optional[dict] = None, xattrs: Optional[Dict[str, dict]] = None):
+        self._paths = paths_blob
+        self._restarts = restarts
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.modes = modes
+        self.uids = uids
+        self.gids = gids
+        self.digests = digests
+        self.xattrs = xattrs or {}
+        self._count = count
+        self.meta = meta or {}
+        self._mmap = None
+        self._restart_keys: Optional[List[str]] = None
+
+    @classmethod
+    def from_index(cls, index: Dict[str, list], meta: Optional[dict] = None) -> 'Manifest':
+        """Build a manifest from a {path: [size, mtime_ns, digest, mode, uid, gid, xattrs]} snapshot index."""
+        return ManifestBuilder.from_index(index).build(meta)
+
+    def to_index(self) -> Dict[str, list]:
+        return {path: entry.to_list() for path, entry in self.items()}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _decode_block(self, block: int) -> Iterator[str]:
+        """Yield the paths of one restart block."""
+        pos = self._restarts[block]
+        end = block * RESTART_INTERVAL
+        count = min(RESTART_INTERVAL, self._count - end)
+        previous = b''
+        for _ in range(count):
+            shared, pos = _decode_varint(self._paths, pos)
+            length, pos = _decode_varint(self._paths, pos)
+            previous = previous[:shared] + bytes(self._paths[pos:pos + length])
+            pos += length
+            yield previous.decode('utf-8', 'surrogateescape')
+
+    def __iter__(self) -> Iterator[str]:
+        for block in range(len(self._restarts)):
+            yield from self._decode_block(block)
+
+    def entries(self) -> Iterator[ManifestEntry]:
+        for i in range(self._count):
+            yield ManifestEntry(self, i)
+
+    def items(self) -> Iterator[Tuple[str, ManifestEntry]]:
+        for i, path in enumerate(self):
+            yield path, ManifestEntry(self, i)
+
+    def path_at(self, i: int) -> str:
+        block, offset = divmod(i, RESTART_INTERVAL)
+        for j, path in enumerate(self._decode_block(block)):
+            if j == offset:
+                return path
+        raise IndexError(i)
+
+    def _index_of(self, path: str) -> int:
+        if self._restart_keys is None:
+            self._restart_keys = [next(self._decode_block(block)) for block in range(len(self._restarts))]
+        block = bisect.bisect_right(self._restart_keys, path) - 1
+        if block < 0:
+            return -1
+        for j, candidate in enumerate(self._decode_block(block)):
+            if candidate == path:
+                return block * RESTART_INTERVAL + j
+            if candidate > path:
+                break
+        return -1
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        i = self._index_of(path)
+        return ManifestEntry(self, i) if i >= 0 else None
+
+    def __contains__(self, path: str) -> bool:
+        return self._index_of(path) >= 0
+
+    def _digest_at(self, i: int) -> bytes:
+        return bytes(self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+
+    def diff(self, new: 'Manifest') -> Tuple[List[str], List[str]]:
+        """
+        Merge-join two manifests over their sorted paths.
+
+        Returns:
+            Tuple[List[str], List[str]]: Paths new or modified in `new`, and paths deleted from self.
+        """
+        changed, deleted = [], []
+        old_paths, new_paths = iter(self), iter(new)
+        old_path, new_path = next(old_paths, None), next(new_paths, None)
+        i = j = 0
+        while old_path is not None or new_path is not None:
+            if new_path is None or (old_path is not None and old_path < new_path):
+                deleted.append(old_path)
+                old_path, i = next(old_paths, None), i + 1
+            elif old_path is None or new_path < old_path:
+                changed.append(new_path)
+                new_path, j = next(new_paths, None), j + 1
+            else:
+                if self._digest_at(i) != new._digest_at(j):
+                    changed.append(new_path)
+                old_path, i = next(old_paths, None), i + 1
+                new_path, j = next(new_paths, None), j + 1
+        return changed, deleted
+
+    def changed_metadata(self, new: 'Manifest') -> List[str]:
+        """Paths whose content is unchanged in `new` but whose mode, mtime, owner or xattrs differ."""
+        changed = []
+        old_paths, new_paths = iter(self), iter(new)
+        old_path, new_path = next(old_paths, None), next(new_paths, None)
+        i = j = 0
+        while old_path is not None and new_path is not None:
+            if old_path < new_path:
+                old_path, i = next(old_paths, None), i + 1
+            elif new_path < old_path:
+                new_path, j = next(new_paths, None), j + 1
+            else:
+                if self._digest_at(i) == new._digest_at(j) and (
+                        self.modes[i] != new.modes[j] or self.mtimes[i] != new.mtimes[j] or
+                        self.uids[i] != new.uids[j] or self.gids[i] != new.gids[j] or
+                        self.xattrs.get(old_path) != new.xattrs.get(new_path)):
+                    changed.append(new_path)
+                old_path, i = next(old_paths, None), i + 1
+                new_path, j = next(new_paths, None), j + 1
+        return changed
+
+    def to_bytes(self) -> bytes:
+        meta = json.dumps(self.meta).encode()
+        xattrs = json.dumps(self.xattrs).encode()
+        columns = []
+        for typecode, column in (('Q', self.sizes), ('q', self.mtimes), ('I', self.modes),
+                                 ('q', self.uids), ('q', self.gids)):
+            column = array(typecode, column)
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column.tobytes())
+        restarts = array('Q', self._restarts)
+        if sys.byteorder != 'little':
+            restarts.byteswap()
+        parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, self._count, RESTART_INTERVAL, len(meta), len(self._paths),
+                              len(xattrs))]
+        for section in (*columns, bytes(self.digests), restarts.tobytes(), meta, bytes(self._paths), xattrs):
+            parts.append(section)
+            parts.append(b'\0' * _pad(len(section)))
+        return b''.join(parts)
+
+    def save(self, path: str) -> None:
+        atomic_write(path, self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'Manifest':
+        """Map a saved manifest in memory. Arrays are views on the mapping, not copies."""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls._parse(mapped, path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Manifest':
+        """Parse a manifest serialized by `to_bytes`, e.g. one already read to check its digest."""
+        return cls._parse(data, 'manifest data')
+
+    @classmethod
+    def _parse(cls, buffer, source: str) -> 'Manifest':
+        view = memoryview(buffer)
+        if len(view) < _HEADER.size or view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a supported manifest file: {source}")
+        magic, version, count, restart_interval, meta_size, paths_size, xattrs_size = _HEADER.unpack_from(view, 0)
+        if version != FORMAT_VERSION or restart_interval != RESTART_INTERVAL:
+            raise ValueError(f"Not a supported manifest file: {source}")
+        pos = _HEADER.size + _pad(_HEADER.size)
+        sections = []
+        for size in (8 * count, 8 * count, 4 * count, 8 * count, 8 * count, DIGEST_SIZE * count,
+                     8 * ((count + RESTART_INTERVAL - 1) // RESTART_INTERVAL), meta_size, paths_size, xattrs_size):
+            sections.append(view[pos:pos + size])
+            pos += size + _pad(size)
+        if pos > len(view):
+            raise ValueError(f"Truncated manifest file: {source}")
+        sizes, mtimes, modes, uids, gids, digests, restarts, meta, paths_blob, xattrs = sections
+        meta = json.loads(bytes(meta))
+        xattrs = json.loads(bytes(xattrs))
+        if sys.byteorder != 'little':
+            # Arrays are stored little-endian: swap into copies instead of mapping them
+            columns = []
+            for typecode, section in (('Q', restarts), ('Q', sizes), ('q', mtimes), ('I', modes),
+                                      ('q', uids), ('q', gids)):
+                column = array(typecode, bytes(section))
+                column.byteswap()
+                columns.append(column)
+            restarts, sizes, mtimes, modes, uids, gids = columns
+            return cls(bytes(paths_blob), restarts, sizes, mtimes, modes, uids, gids, bytes(digests), count,
+                       meta, xattrs)
+        manifest = cls(paths_blob, restarts.cast('Q'), sizes.cast('Q'), mtimes.cast('q'), modes.cast('I'),
+                       uids.cast('q'), gids.cast('q'), digests, count, meta, xattrs)
+        if isinstance(buffer, mmap.mmap):
+            manifest._mmap = buffer
+        return manifest
+
+    def close(self) -> None:
+        """Release the mapping of a loaded manifest. The manifest is unusable afterwards."""
+        if self._mmap is not None:
+            for view in (self._paths, self._restarts, self.sizes, self.mtimes, self.modes, self.uids, self.gids,
+                         self.digests):
+                view.release()
+            self._mmap.close()
+            self._mmap = None
+
+class ManifestBuilder:
+    """
+    Rows of a manifest being collected, in any order, until `build` sorts them.
+
+    Rows are kept in the same fixed-width arrays as a Manifest, plus one string
+    per path, so a capture can stream its walk into a manifest without holding
+    a {path: entry} index.
+    """
+
+    def __init__(self):
+        self._paths: List[str] = []
+        self._sizes = array('Q')
+        self._mtimes = array('q')
+        self._modes = array('I')
+        self._uids = array('q')
+        self._gids = array('q')
+        self._digests = bytearray()
+        self._xattrs: Dict[str, dict] = {}
+
+    @classmethod
+    def from_index(cls, index: Dict[str, list]) -> 'ManifestBuilder':
+        builder = cls()
+        for path, entry in index.items():
+            builder.add(path, entry)
+        return builder
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def add(self, path: str, entry: list) -> None:
+        """Add the row of a path not added yet, from a [size, mtime_ns, digest, mode, uid, gid, xattrs] entry."""
+        self._paths.append(path)
+        self._sizes.append(entry[0])
+        self._mtimes.append(entry[1])
+        self._modes.append(entry[3] if len(entry) > 3 else 0)
+        self._uids.append(entry[4] if len(entry) > 5 else NO_OWNER)
+        self._gids.append(entry[5] if len(entry) > 5 else NO_OWNER)
+        self._digests += bytes.fromhex(entry[2])
+        if len(entry) > 6 and entry[6]:
+            self._xattrs[path] = entry[6]
+
+    def replace(self, path: str, entry: Optional[list]) -> None:
+        """Replace the row of a path, or remove it if entry is None. Scans the rows, so meant for a few paths."""
+        i = self._paths.index(path)
+        del self._paths[i]
+        for column in (self._sizes, self._mtimes, self._modes, self._uids, self._gids):
+            del column[i]
+        del self._digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        self._xattrs.pop(path, None)
+        if entry is not None:
+            self.add(path, entry)
+
+    def build(self, meta: Optional[dict] = None) -> Manifest:
+        """Sort the rows by path and encode them into a Manifest."""
+        paths_blob = bytearray()
+        restarts = array('Q')
+        sizes = array('Q')
+        mtimes = array('q')
+        modes = array('I')
+        uids = array('q')
+        gids = array('q')
+        digests = bytearray()
+        previous = b''
+        for n, i in enumerate(sorted(range(len(self._paths)), key=self._paths.__getitem__)):
+            encoded = self._paths[i].encode('utf-8', 'surrogateescape')
+            shared = 0
+            if n % RESTART_INTERVAL == 0:
+                restarts.append(len(paths_blob))
+            else:
+                limit = min(len(previous), len(encoded))
+                while shared < limit and previous[shared] == encoded[shared]:
+                    shared += 1
+            _encode_varint(shared, paths_blob)
+            _encode_varint(len(encoded) - shared, paths_blob)
+            paths_blob += encoded[shared:]
+            previous = encoded
+            sizes.append(self._sizes[i])
+            mtimes.append(self._mtimes[i])
+            modes.append(self._modes[i])
+            uids.append(self._uids[i])
+            gids.append(self._gids[i])
+            digests += self._digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        return Manifest(bytes(paths_blob), restarts, sizes, mtimes, modes, uids, gids, bytes(digests), len(sizes),
+                        meta, dict(self._xattrs))
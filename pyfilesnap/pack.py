@@ -0,0 +1,143 @@
+import os
+import json
+import lzma
+import zlib
+import threading
+from typing import Dict, List, Optional, Tuple
+from .utils import atomic_write, hash_data
+
+PACKS_DIR = 'packs'
+PACK_FORMAT_VERSION = 1
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+CODECS = ('none', 'zlib', 'lzma')
+
+# Pack entry keys: 'snapshot/<time>' for manifests, 'object/<digest>' for object store contents
+SNAPSHOT_KEY = 'snapshot/'
+OBJECT_KEY = 'object/'
+
+def compress(data: bytes, codec: str) -> Tuple[bytes, str]:
+    """Compress data with a codec, falling back to 'none' when it does not shrink."""
+    if codec == 'zlib':
+        compressed = zlib.compress(data, 6)
+    elif codec == 'lzma':
+        compressed = lzma.compress(data, preset=9)
+    elif codec == 'none':
+        return data, 'none'
+    else:
+        raise ValueError(f"Unknown codec: {codec}")
+    if len(compressed) >= len(data):
+        return data, 'none'
+    return compressed, codec
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'none':
+        return data
+    raise ValueError(f"Unknown codec: {codec}")
+
+class PackSet:
+    """
+    Read access to the pack files of a backup directory.
+
+    A pack is an immutable file of individually compressed entries, described by a
+    JSON index next to it (pack-<hash>.pack and pack-<hash>.idx). The index is
+    written after the pack, so a pack is only visible once complete. The set of
+    indexes is listed again on every lookup miss, and only new indexes are loaded.
+    """
+
+    def __init__(self, backup_dir: str):
+        self.root = os.path.join(backup_dir, PACKS_DIR)
+        self._entries: Dict[str, Tuple[str, int, int, str]] = {}
+        self._indexes: Dict[str, Dict[str, Tuple[str, int, int, str]]] = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> bool:
+        """Load the indexes published or removed since the last refresh. Returns whether there were any."""
+        try:
+            names = set(name for name in os.listdir(self.root) if name.endswith('.idx'))
+        except FileNotFoundError:
+            names = set()
+        if names == set(self._indexes):
+            return False
+        # Packs are named after their content, so an index seen before never changes
+        indexes = {name: entries for name, entries in self._indexes.items() if name in names}
+        for name in sorted(names - set(indexes)):
+            try:
+                with open(os.path.join(self.root, name), 'r') as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                continue  # Removed since it was listed
+            indexes[name] = {key: (name[:-len('.idx')], offset, length, codec)
+                             for key, (offset, length, codec) in index['entries'].items()}
+        entries = {}
+        for name in sorted(indexes):
+            entries.update(indexes[name])
+        self._entries, self._indexes = entries, indexes
+        return True
+
+    def locate(self, key: str) -> Optional[Tuple[str, int, int, str]]:
+        """Return the (pack name, offset, length, codec) of an entry, or None if it is not packed."""
+        with self._lock:
+            location = self._entries.get(key)
+            if location is None and self._refresh():
+                location = self._entries.get(key)
+            return location
+
+    def has(self, key: str) -> bool:
+        return self.locate(key) is not None
+
+    def pack_of(self, key: str) -> Optional[str]:
+        location = self.locate(key)
+        return location[0] if location else None
+
+    def read(self, key: str) -> bytes:
+        location = self.locate(key)
+        if location is None:
+            raise FileNotFoundError(f"{key} is not in any pack")
+        pack_name, offset, length, codec = location
+        with open(os.path.join(self.root, f'{pack_name}.pack'), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise ValueError(f"Pack {pack_name} is truncated")
+        return decompress(data, codec)
+
+    def keys(self, prefix: str = '') -> List[str]:
+        with self._lock:
+            self._refresh()
+            return sorted(key for key in self._entries if key.startswith(prefix))
+
+class PackWriter:
+    """Accumulates compressed entries in memory until they are published as one pack."""
+
+    def __init__(self, backup_dir: str):
+        self.root = os.path.join(backup_dir, PACKS_DIR)
+        self._buffer = bytearray()
+        self._entries: Dict[str, list] = {}
+
+    def add(self, key: str, data: bytes, codec: str) -> int:
+        """Add an entry and return its stored size."""
+        compressed, codec = compress(data, codec)
+        self._entries[key] = [len(self._buffer), len(compressed), codec]
+        self._buffer += compressed
+        return len(compressed)
+
+    def keys(self) -> List[str]:
+        return list(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def publish(self) -> str:
+        """Write the pack, then its index, and return the pack name. The writer is empty afterwards."""
+        os.makedirs(self.root, exist_ok=True)
+        name = f'pack-{hash_data(bytes(self._buffer))[:32]}'
+        atomic_write(os.path.join(self.root, f'{name}.pack'), bytes(self._buffer))
+        index = {'version': PACK_FORMAT_VERSION, 'entries': self._entries}
+        atomic_write(os.path.join(self.root, f'{name}.idx'), json.dumps(index).encode())
+        self._buffer = bytearray()
+        self._entries = {}
+        return name
@@ -1,21 +1,63 @@
 import os
-import json
+import copy
+import stat
+import time
+import base64
+import concurrent.futures
+from collections import deque
 from datetime import datetime
-from typing import List, Union, Optional  # Add Optional to the import
-from .utils import apply_snapshot, decode_data, extract_archive
-from .snapshot import Snapshot, SnapshotConfig
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Union, Optional  # Add Optional to the import
+from .utils import apply_snapshot, apply_metadata
+from .snapshot import Snapshot, SnapshotConfig, STORAGE_OBJECTS, _state_size
 import logging
-import tarfile
-from .diff import apply_diff  # Import apply_diff
+from .stats import OperationStats, report_stats
+from .store import COPY_MODES, ObjectRef
+from .manifest import Manifest
+
+def _decode_entry(content: str) -> Tuple[bytes, float]:
+    """Decode one base64-encoded file of a snapshot. Returns the content and the seconds it took."""
+    start = time.perf_counter()
+    data = base64.b64decode(content + '=' * (-len(content) % 4))
+    return data, time.perf_counter() - start
+
+def _selector(paths: Optional[Iterable[str]]) -> Optional[Callable[[str], bool]]:
+    """Return a test accepting the given files and the files under the given directories, or None for all."""
+    if paths is None:
+        return None
+    prefixes = tuple(path.strip('/') for path in paths)
+    return lambda path: any(path == prefix or path.startswith(prefix + '/') for prefix in prefixes)
 
 class Restore:
-    def __init__(self, target_dir: str, backup_dir: str = '.pyfilesnap'):
+    def __init__(self, target_dir: str, backup_dir: str = '.pyfilesnap',
+                 stats_callback: Optional[Callable[[OperationStats], None]] = None, copy_mode: str = 'auto',
+                 config: Optional[SnapshotConfig] = None):
+        """
+        copy_mode controls how files held in the object store are restored: 'auto'
+        tries a reflink, copy_file_range and sendfile before a plain copy, or one of
+        'reflink', 'copy_file_range', 'sendfile', 'copy' can be forced. 'hardlink'
+        links restored read-only files to the stored objects, keeping the objects'
+        own metadata; writable files are copied instead.
+
+        The I/O budget and priority options of config (max_read_mbps, max_iops,
+        nice, ionice_class, adaptive_throttle) also apply to the restore's writes.
+        config.max_workers threads load and decode the snapshot chain while files
+        are written, with at most config.max_memory_mb MiB decoded ahead of the writes.
+        """
+        if copy_mode not in COPY_MODES:
+            raise ValueError(f"Unknown copy mode: {copy_mode}")
+        self.copy_mode = copy_mode
         self.target_dir = os.path.abspath(target_dir)
         self.backup_dir = os.path.join(self.target_dir, backup_dir)
-        config = SnapshotConfig(compress=os.path.exists(os.path.join(self.backup_dir, 'snapshots.tar.gz')))
+        config = copy.copy(config) if config is not None else SnapshotConfig()
+        config.compress = os.path.exists(os.path.join(self.backup_dir, 'snapshots.tar.gz'))
+        if stats_callback is not None:
+            config.stats_callback = stats_callback
         self.snapshot = Snapshot(target_dir, backup_dir=backup_dir, config=config)
+        # Stats of the last restore, also passed to stats_callback
+        self.last_stats: Optional[OperationStats] = None
 
-    def restore_to_date(self, target_date: str, direction: str = 'exact') -> bool:
+    def restore_to_date(self, target_date: str, direction: str = 'exact',
+                        paths: Optional[Iterable[str]] = None) -> bool:
         target_datetime = datetime.strptime(target_date, "%Y%m%d_%H%M%S")
         snapshots = self._get_snapshots()
         logging.debug(f"Available snapshots: {snapshots}")
@@ -24,51 +66,253 @@ class Restore:
         logging.debug(f"Closest snapshot found: {closest_snapshot}")
         
         if closest_snapshot:
-            return self._restore_snapshot(closest_snapshot)
+            return self._restore_snapshot(closest_snapshot, paths)
         else:
             logging.warning(f"No suitable snapshot found for date {target_date} with direction {direction}")
             return False
 
-    def _restore_snapshot(self, snapshot_file: str) -> bool:
-        snapshot_chain = self._get_snapshot_chain(snapshot_file)
-        if not snapshot_chain:
-            logging.error(f"Failed to get snapshot chain for {snapshot_file}")
+    def _restore_snapshot(self, snapshot_file: str, paths: Optional[Iterable[str]] = None) -> bool:
+        """Restore a snapshot, or with `paths` only these files and the files under these directories."""
+        selected = _selector(paths)
+        stats = OperationStats('restore')
+        self.last_stats = stats
+        try:
+            # Manifests and reconstructed states are shared with the Snapshot cache
+            self.snapshot._sync_cache()
+            manifest = self.snapshot._load_manifest(snapshot_file, stats)
+            if manifest is not None:
+                try:
+                    index = manifest.to_index()
+                finally:
+                    manifest.close()
+                self._restore_pipelined(snapshot_file, index, stats, selected)
+                report_stats(stats, self.snapshot.config.stats_callback)
+                return True
+            # Snapshots taken before indexes were recorded: the files are only known once the state is rebuilt
+            full_state = self.snapshot._reconstruct_state(snapshot_file, stats, resolve_objects=False)
+        except (FileNotFoundError, ValueError) as e:
+            logging.error(f"Failed to reconstruct snapshot {snapshot_file}: {e}")
+            report_stats(stats, self.snapshot.config.stats_callback)
             return False
 
-        logging.debug(f"Restoring snapshot chain: {snapshot_chain}")
-        full_state = {}
-        
-        for snapshot in reversed(snapshot_chain):
-            logging.debug(f"Processing snapshot: {snapshot}")
-            snapshot_data = self._load_snapshot_data(f"snapshot_{snapshot}")
-            if snapshot_data is None:
-                logging.error(f"Failed to load snapshot data for {snapshot}")
-                return False
-            diff_data = decode_data(snapshot_data['data'])
-            logging.debug(f"Diff data keys: {list(diff_data.keys())}")
-            full_state = apply_diff(full_state, diff_data)
-        
         logging.debug(f"Final state keys: {list(full_state.keys())}")
-        apply_snapshot(self.target_dir, full_state)
+        # Without an index every entry is a regular file
+        index = {}
+        with stats.phase('restore'):
+            renamed = self._apply_renames(snapshot_file, full_state, stats, selected)
+            if renamed or selected is not None:
+                full_state = {path: content for path, content in full_state.items()
+                              if path not in renamed and (selected is None or selected(path))}
+            config = self.snapshot.config
+            args = (self.target_dir, full_state, index, stats, self.snapshot.store, self.copy_mode,
+                    config.make_throttle())
+            initializer = config.worker_initializer()
+            if initializer is None:
+                apply_snapshot(*args)
+                # Metadata goes last, in one pass, so later writes do not change restored mtimes
+                apply_metadata(self.target_dir, index, stats, self.snapshot.store)
+            else:
+                # Write from a thread with lowered priority, leaving the caller's own priority alone
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1, initializer=initializer) as executor:
+                    executor.submit(apply_snapshot, *args).result()
+                    executor.submit(apply_metadata, self.target_dir, index, stats, self.snapshot.store).result()
+        report_stats(stats, self.snapshot.config.stats_callback)
         return True
 
+    def _restore_pipelined(self, snapshot_time: str, index: Dict[str, list], stats: OperationStats,
+                           selected: Optional[Callable[[str], bool]] = None) -> None:
+        """
+        Restore a snapshot by resolving each file from the newest snapshot of the chain that stores it.
+
+        The chain is walked newest first, with upcoming snapshots loaded ahead by a
+        thread pool, and a file is only looked up in older snapshots while no newer
+        one stored it. Nothing is written until the whole chain is resolved, so a
+        damaged chain leaves the directory untouched. Files are then decoded by the
+        pool while a single writer thread writes the ones already decoded, and the
+        metadata pass runs once all are written. With `selected`, only the files
+        it accepts are restored.
+        """
+        config = self.snapshot.config
+        initializer = config.worker_initializer()
+        workers = config.max_workers
+        max_memory = int(config.max_memory_mb * 1024 * 1024) if config.max_memory_mb else None
+        writer_stats = OperationStats('restore')
+        wanted = index if selected is None else {path: entry for path, entry in index.items() if selected(path)}
+        # Kept for the cache only if complete and it fits, as the files are otherwise streamed to disk
+        fits = sum(entry[0] for entry in index.values()) <= self.snapshot._cache.max_bytes
+        state = {} if selected is None and fits else None
+
+        def write(paths: List[str], content, decoding: Optional[concurrent.futures.Future]) -> None:
+            # Runs on the writer thread, the only one updating writer_stats and state
+            if decoding is not None:
+                content, seconds = decoding.result()
+                writer_stats.observe('decode', seconds)
+                writer_stats.incr('files_decoded')
+            files = {path: content for path in paths}
+            apply_snapshot(self.target_dir, files, index, writer_stats, self.snapshot.store, self.copy_mode, throttle)
+            if state is not None:
+                state.update(files)
+
+        with stats.phase('restore'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=initializer) as pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1, initializer=initializer) as writer:
+            plan = self._plan_restore(snapshot_time, wanted, pool, workers, stats)
+            renamed = self._apply_renames(snapshot_time, index, stats, selected)
+            throttle = config.make_throttle()
+            pending = deque()
+            in_flight = 0
+            for paths, content, kind in plan:
+                paths = [path for path in paths if path not in renamed]
+                if not paths:
+                    continue
+                decoding = None
+                size = index[paths[0]][0]
+                if kind == 'encoded':
+                    decoding = pool.submit(_decode_entry, content)
+                elif kind == 'object':
+                    content = ObjectRef(content, size)
+                pending.append((writer.submit(write, paths, content, decoding), size))
+                in_flight += size
+                while len(pending) > 2 * workers or (max_memory is not None and in_flight > max_memory):
+                    future, done_size = pending.popleft()
+                    future.result()
+                    in_flight -= done_size
+            while pending:
+                pending.popleft()[0].result()
+            # Metadata goes last, in one pass, so later writes do not change restored mtimes
+            writer.submit(apply_metadata, self.target_dir, wanted, writer_stats, self.snapshot.store).result()
+        stats.merge(writer_stats)
+        if state is not None and not renamed:
+            self.snapshot._cache.put(('state', snapshot_time, False), state, _state_size(state))
+
+    def _plan_restore(self, snapshot_time: str, index: Dict[str, list], pool: concurrent.futures.Executor,
+                      prefetch: int, stats: OperationStats) -> List[tuple]:
+        """
+        Walk the chain newest first and return (paths, content, kind) for every file to write.
+
+        kind is 'encoded' for base64 content still to decode, 'object' for a digest
+        in the object store, or 'content' for a value taken from a cached state.
+        Paths sharing a source (copies) are grouped, so it is only decoded once.
+        Up to `prefetch` snapshots are loaded ahead of the one being visited.
+        """
+        cache = self.snapshot._cache
+        # Path in the snapshot being visited -> paths of the restored snapshot it provides
+        wanted = {path: [path] for path in index}
+        plan = []
+        # Chains normally follow the catalog order: guess the next snapshots to load it ahead
+        guesses = [t for t in self._get_snapshots() if t <= snapshot_time][::-1]
+        loading = {}
+        visited = []
+        current = snapshot_time
+        try:
+            while wanted and current is not None:
+                if current in visited:
+                    logging.warning(f"Circular reference detected in snapshot chain: {current}")
+                    break
+                visited.append(current)
+                cached_state = cache.get(('state', current, False))
+                if cached_state is not None:
+                    stats.incr('cache_hits')
+                    plan.extend((paths, cached_state[path], 'content') for path, paths in wanted.items()
+                                if path in cached_state)
+                    wanted = {path: paths for path, paths in wanted.items() if path not in cached_state}
+                    break
+                position = guesses.index(current) if current in guesses else len(guesses)
+                for guess in guesses[position + 1:position + 1 + prefetch]:
+                    if guess not in loading:
+                        loading[guess] = pool.submit(self._load_for_restore, guess)
+                future = loading.pop(current, None) or pool.submit(self._load_for_restore, current)
+                snapshot_data, load_stats = future.result()
+                stats.merge(load_stats)
+
+                data = snapshot_data['data']
+                kind = 'object' if snapshot_data.get('storage') == STORAGE_OBJECTS else 'encoded'
+                moves = snapshot_data.get('moves') or {}
+                older = {}
+                for path, paths in wanted.items():
+                    if path not in data:
+                        # A moved file has the content its source had in the previous snapshot
+                        older.setdefault(moves.get(path, path), []).extend(paths)
+                    elif data[path] is not None:
+                        plan.append((paths, data[path], kind))
+                    else:
+                        raise ValueError(f"{path} of snapshot {snapshot_time} is deleted in snapshot {current}")
+                wanted = older
+                current = snapshot_data.get('prev_snapshot')
+        finally:
+            for future in loading.values():
+                future.cancel()
+        stats.incr('chain_length', len(visited))
+        if wanted:
+            raise FileNotFoundError(f"{len(wanted)} files of snapshot {snapshot_time} are missing from its chain")
+        return plan
+
+    def _load_for_restore(self, snapshot_time: str) -> Tuple[dict, OperationStats]:
+        """Load a snapshot on a worker thread, with its own stats for the caller to merge."""
+        stats = OperationStats('load')
+        with stats.phase('load'):
+            snapshot_data = self.snapshot._load_snapshot_data(f'snapshot_{snapshot_time}.json', stats)
+        return snapshot_data, stats
+
+    def _apply_renames(self, snapshot_time: str, state: dict, stats: OperationStats,
+                       selected: Optional[Callable[[str], bool]] = None) -> Set[str]:
+        """
+        Replay the renames recorded in a snapshot with os.rename instead of rewriting the files.
+
+        A rename is only replayed if its source is gone from the restored state, is still
+        on disk with the size and mtime the previous snapshot recorded, and its
+        destination does not exist yet (and is accepted by `selected`, if given).
+        Returns the destinations that were renamed.
+        """
+        snapshot_data = self.snapshot._load_snapshot_data(f'snapshot_{snapshot_time}.json', stats)
+        moves = snapshot_data.get('moves')
+        prev_snapshot = snapshot_data.get('prev_snapshot')
+        if not moves or prev_snapshot is None:
+            return set()
+        manifest = self.snapshot._load_manifest(snapshot_time, stats)
+        prev_manifest = self.snapshot._load_manifest(prev_snapshot, stats)
+        try:
+            if manifest is None or prev_manifest is None:
+                return set()
+            renamed = self._replay_renames(moves, state, manifest, prev_manifest, selected)
+        finally:
+            for loaded in (manifest, prev_manifest):
+                if loaded is not None:
+                    loaded.close()
+        stats.incr('files_renamed', len(renamed))
+        return renamed
+
+    def _replay_renames(self, moves: Dict[str, str], state: dict, manifest: Manifest, prev_manifest: Manifest,
+                        selected: Optional[Callable[[str], bool]]) -> Set[str]:
+        renamed = set()
+        for dest_path, src_path in moves.items():
+            entry, prev_entry = manifest.get(dest_path), prev_manifest.get(src_path)
+            if src_path in state or entry is None or prev_entry is None:
+                continue
+            if selected is not None and not selected(dest_path):
+                continue
+            if entry.digest != prev_entry.digest:  # Renamed and edited: rewrite the file
+                continue
+            if entry.mode and prev_entry.mode and stat.S_IFMT(entry.mode) != stat.S_IFMT(prev_entry.mode):
+                continue  # Same content but another type, e.g. a file holding a symlink's target
+            full_src = os.path.join(self.target_dir, src_path)
+            full_dest = os.path.join(self.target_dir, dest_path)
+            if os.path.lexists(full_dest):
+                continue
+            try:
+                st = os.lstat(full_src)
+            except OSError:
+                continue
+            if st.st_size != prev_entry.size or st.st_mtime_ns != prev_entry.mtime_ns:
+                continue
+            os.makedirs(os.path.dirname(full_dest), exist_ok=True)
+            os.rename(full_src, full_dest)
+            renamed.add(dest_path)
+        return renamed
+
     def _get_snapshots(self) -> List[str]:
-        snapshots = []
-        if self.snapshot.config.compress:
-            archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
-            if os.path.exists(archive_path):
-                with tarfile.open(archive_path, 'r:gz') as tar:
-                    snapshots = sorted([
-                        member.name.replace('snapshot_', '').replace('.json', '')
-                        for member in tar.getmembers() 
-                        if member.isfile() and member.name.startswith('snapshot_') and member.name.endswith('.json')
-                    ])
-        else:
-            snapshots = sorted([
-                f.replace('snapshot_', '').replace('.json', '')
-                for f in os.listdir(self.backup_dir)
-                if f.startswith('snapshot_') and f.endswith('.json')
-            ])
+        # Read from the catalog, which writers replace atomically, so no lock is needed
+        snapshots = self.snapshot.list_snapshots()
         logging.debug(f"Found snapshots: {snapshots}")
         return snapshots
 
@@ -78,7 +322,7 @@ class Restore:
 
         for snapshot in snapshots:
             try:
-                snapshot_time = datetime.strptime(snapshot, "%Y%m%d%H%M%S")
+                snapshot_time = datetime.strptime(snapshot, "%Y%m%d_%H%M%S")
             except ValueError:
                 logging.warning(f"Unexpected snapshot name format: {snapshot}")
                 continue
@@ -100,70 +344,10 @@ class Restore:
         logging.debug(f"Closest snapshot found: {closest_snapshot}")
         return closest_snapshot
 
-    def _get_snapshot_chain(self, snapshot_file: str) -> List[str]:
-        snapshot_chain = []
-        current_snapshot = snapshot_file
-
-        while current_snapshot is not None:
-            if current_snapshot in snapshot_chain:
-                logging.warning(f"Circular reference detected in snapshot chain: {current_snapshot}")
-                break
-            snapshot_chain.append(current_snapshot)
-            snapshot_data = self._load_snapshot_data(current_snapshot)
-            if snapshot_data is None:
-                logging.error(f"Failed to load snapshot data for {current_snapshot}")
-                break
-            current_snapshot = snapshot_data.get('prev_snapshot')
-
-        return snapshot_chain[::-1]
-
-    def _load_snapshot_data(self, snapshot_file: str) -> dict:
-        if self.snapshot.config.compress:
-            return self._load_compressed_snapshot(snapshot_file)
-        else:
-            return self._load_uncompressed_snapshot(snapshot_file)
-
-    def _load_compressed_snapshot(self, snapshot_file: str) -> dict:
-        archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
-        if not os.path.exists(archive_path):
-            raise FileNotFoundError(f"Compressed archive not found: {archive_path}")
-        
-        with tarfile.open(archive_path, 'r:gz') as tar:
-            snapshot_name = snapshot_file.split('.')[0]  # Remove file extension if present
-            possible_names = [snapshot_name, f'snapshot_{snapshot_name}']
-            
-            for name in possible_names:
-                try:
-                    member = tar.getmember(name)
-                    f = tar.extractfile(member)
-                    if f is None:
-                        raise ValueError(f"Failed to extract {name}")
-                    snapshot_content = f.read()
-                    return json.loads(snapshot_content)
-                except KeyError:
-                    continue
-            
-            raise FileNotFoundError(f"No snapshot found matching {snapshot_file} in the compressed archive")
-
-    def _load_uncompressed_snapshot(self, snapshot_file: str) -> dict:
-        possible_paths = [
-            os.path.join(self.backup_dir, snapshot_file),
-            os.path.join(self.backup_dir, f"{snapshot_file}.json"),
-            os.path.join(self.backup_dir, f"snapshot_{snapshot_file}"),
-            os.path.join(self.backup_dir, f"snapshot_{snapshot_file}.json")
-        ]
-        
-        for path in possible_paths:
-            if os.path.exists(path):
-                with open(path, 'r') as f:
-                    return json.load(f)
-        
-        raise FileNotFoundError(f"No snapshot file found for {snapshot_file}")
-
-    def restore_last(self) -> bool:
+    def restore_last(self, paths: Optional[Iterable[str]] = None) -> bool:
         snapshots = self._get_snapshots()
         if not snapshots:
             raise ValueError("No snapshots found")
         
         latest_snapshot = snapshots[-1]
-        return self._restore_snapshot(latest_snapshot)
+        return self._restore_snapshot(latest_snapshot, paths)
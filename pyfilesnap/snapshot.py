@@ -2,19 +2,98 @@ import os
 import json
 import base64  # Add this import
 from datetime import datetime
-from typing import Dict, Union, Optional, List, Set
+from typing import Callable, Dict, Union, Optional, List, Set, Tuple
 import tarfile  # Add this import
-from .utils import ensure_backup_dir, collect_files_data, create_archive, update_archive, decode_data, extract_archive, encode_data  # Add encode_data import
-from .diff import create_diff, apply_diff  # Ensure apply_diff is imported here as well
+from .utils import ensure_backup_dir, collect_files_data, create_archive, update_archive, decode_data, extract_archive, encode_data, hash_data, manifest_checksum, HASH_ALGORITHM  # Add encode_data import
+from .utils import atomic_write, remove_temp_files, remove_from_archive, FilesData
+from .verify import verify_snapshot_data, check_worktree
+from .lock import RepositoryLock
+from .diff import create_diff, apply_diff, detect_moves, find_similar  # Ensure apply_diff is imported here as well
+from .cache import get_cache, DEFAULT_CACHE_SIZE
+from .manifest import Manifest, ManifestBuilder
+from .store import ObjectStore, ObjectRef
+from .pack import PackWriter, DEFAULT_PACK_SIZE, SNAPSHOT_KEY, OBJECT_KEY
+from .stats import OperationStats, report_stats
+from .throttle import Throttle, IONICE_CLASSES, set_thread_priority
+from .checkpoint import Checkpoint, checkpoint_digests
+from .view import SnapshotView
 import logging
 import time
+import functools
 import concurrent.futures
 from fnmatch import fnmatch
 
+CATALOG_FILE = 'catalog.json'
+# Directory of the binary manifest of every snapshot, named after the snapshot
+MANIFESTS_DIR = 'manifests'
+# Larger files are not compared for similarity-based rename detection
+SIMILARITY_MAX_SIZE = 1024 * 1024
+# Value of a snapshot's 'storage' field when its data references the object store
+STORAGE_OBJECTS = 'objects'
+
 class SnapshotConfig:
-    def __init__(self, compress: bool = False, excluded_patterns: List[str] = None):
+    def __init__(self, compress: bool = False, excluded_patterns: List[str] = None,
+                 stats_callback: Optional[Callable[[OperationStats], None]] = None,
+                 lock_timeout: Optional[float] = None, cache_size: int = DEFAULT_CACHE_SIZE,
+                 object_store: bool = False, detect_renames: bool = True,
+                 similarity_threshold: Optional[float] = None, max_read_mbps: Optional[float] = None,
+                 max_iops: Optional[float] = None, max_workers: int = 1, max_memory_mb: Optional[float] = None,
+                 nice: Optional[int] = None, ionice_class: Optional[str] = None,
+                 adaptive_throttle: bool = False, target_latency_ms: float = 20.0,
+                 resumable: bool = False, checkpoint_interval: int = 1000, capture_metadata: bool = True,
+                 trust_mtime: bool = True):
+        if resumable and not object_store:
+            raise ValueError("Resumable snapshots need object_store=True")
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if ionice_class is not None and ionice_class not in IONICE_CLASSES:
+            raise ValueError(f"Unknown ionice class: {ionice_class}")
         self.compress = compress
         self.excluded_patterns = excluded_patterns or []
+        # Called with the OperationStats of every snapshot taken with this config
+        self.stats_callback = stats_callback
+        # Seconds to wait for a concurrent snapshot to finish, None waits forever
+        self.lock_timeout = lock_timeout
+        # Bytes of decoded snapshots and reconstructed states kept in memory, 0 disables caching
+        self.cache_size = cache_size
+        # Store file contents once each in a content-addressed object store instead of inline
+        self.object_store = object_store
+        # Record files whose content already existed at another path as moves instead of new content
+        self.detect_renames = detect_renames
+        # If set (e.g. 0.8), also pair added and removed files at least this similar as renames
+        self.similarity_threshold = similarity_threshold
+        # I/O budget of snapshots (reads) and restores (writes), in MiB/s and operations/s
+        self.max_read_mbps = max_read_mbps
+        self.max_iops = max_iops
+        # Threads reading and hashing files, and MiB they may read ahead of the directory walk
+        self.max_workers = max_workers
+        self.max_memory_mb = max_memory_mb
+        # Niceness and I/O priority class ('realtime', 'best-effort', 'idle') of the I/O threads
+        self.nice = nice
+        self.ionice_class = ionice_class
+        # Back off when the latency of reads or writes rises above target_latency_ms
+        self.adaptive_throttle = adaptive_throttle
+        self.target_latency_ms = target_latency_ms
+        # Commit contents to the object store while reading, so an interrupted snapshot resumes where it stopped
+        self.resumable = resumable
+        # Files captured between two fsyncs of the progress log
+        self.checkpoint_interval = checkpoint_interval
+        # Record owners, xattrs, symlinks (as their targets) and empty directories, and snapshot metadata-only changes
+        self.capture_metadata = capture_metadata
+        # Reuse the digest of files whose size and mtime match the previous snapshot instead of reading them
+        self.trust_mtime = trust_mtime
+
+    def make_throttle(self) -> Optional[Throttle]:
+        """Return a Throttle enforcing the I/O budget, or None if no budget is set."""
+        if not (self.max_read_mbps or self.max_iops or self.adaptive_throttle):
+            return None
+        return Throttle(self.max_read_mbps, self.max_iops, self.adaptive_throttle, self.target_latency_ms / 1000)
+
+    def worker_initializer(self) -> Optional[Callable[[], None]]:
+        """Return the initializer lowering the priority of I/O threads, or None if no priority is set."""
+        if self.nice is None and self.ionice_class is None:
+            return None
+        return functools.partial(set_thread_priority, self.nice, self.ionice_class)
 
 class Snapshot:
     def __init__(self, target_dir: str, backup_dir: str = '.pyfilesnap', config: SnapshotConfig = None):
@@ -23,50 +102,327 @@ class Snapshot:
             raise FileNotFoundError(f"The target directory '{self.target_dir}' does not exist.")
         self.backup_dir = os.path.join(self.target_dir, backup_dir)
         self.config = config or SnapshotConfig()
+        self.last_stats: Optional[OperationStats] = None
         ensure_backup_dir(self.backup_dir)
+        self._cache = get_cache(self.backup_dir, self.config.cache_size)
+        self.store = ObjectStore(self.backup_dir)
 
     def take_snapshot(self) -> str:
+        """
+        Take a snapshot of the target directory and return its time.
+
+        Counters and per-phase timings of the run are left in `self.last_stats`
+        and passed to `config.stats_callback` if one is set.
+        """
+        stats = OperationStats('snapshot')
+        self.last_stats = stats
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        current_data = collect_files_data(self.target_dir, self.backup_dir)
-        
+        if self.config.resumable:
+            checkpoint = Checkpoint(self.backup_dir, self.store, self.config.checkpoint_interval)
+            os.makedirs(checkpoint.dir, exist_ok=True)
+            # Only one capture at a time may append to the progress log
+            with RepositoryLock(checkpoint.dir, timeout=self.config.lock_timeout):
+                checkpoint.open()
+                try:
+                    snapshot_time = self._capture(stats, current_time, checkpoint)
+                finally:
+                    checkpoint.close()
+                checkpoint.discard()
+        else:
+            snapshot_time = self._capture(stats, current_time)
+        report_stats(stats, self.config.stats_callback)
+        return snapshot_time
+
+    def _capture(self, stats: OperationStats, current_time: str, checkpoint: Optional[Checkpoint] = None) -> str:
+        builder = ManifestBuilder()
+        max_memory = int(self.config.max_memory_mb * 1024 * 1024) if self.config.max_memory_mb else None
+        previous, trusted_before_ns = self._previous_manifest(stats)
+        if not self.config.trust_mtime:
+            trusted_before_ns = None
+        try:
+            current_data = collect_files_data(self.target_dir, self.backup_dir, stats, builder=builder,
+                                              throttle=self.config.make_throttle(),
+                                              max_workers=self.config.max_workers, max_memory=max_memory,
+                                              initializer=self.config.worker_initializer(), checkpoint=checkpoint,
+                                              metadata=self.config.capture_metadata, previous=previous,
+                                              trusted_before_ns=trusted_before_ns)
+        finally:
+            if previous is not None:
+                previous.close()
+
+        # Reading the tree needs no lock; choosing the diff base and publishing does
+        with RepositoryLock(self.backup_dir, timeout=self.config.lock_timeout):
+            remove_temp_files(self.backup_dir)
+            if os.path.isdir(os.path.join(self.backup_dir, MANIFESTS_DIR)):
+                remove_temp_files(os.path.join(self.backup_dir, MANIFESTS_DIR))
+            return self._commit_snapshot(stats, current_time, current_data, builder)
+
+    def _previous_manifest(self, stats: OperationStats) -> Tuple[Optional[Manifest], Optional[int]]:
+        """
+        Return the manifest of the latest snapshot and the time (in ns) its capture started.
+
+        Files modified before that time with the size and mtime the manifest records
+        are unchanged since; later ones may have changed within the mtime granularity.
+        """
+        self._sync_cache()
+        snapshots = self.list_snapshots()
+        if not snapshots:
+            return None, None
+        manifest = self._load_manifest(snapshots[-1], stats)
+        if manifest is None:
+            return None, None
+        try:
+            started = time.mktime(time.strptime(manifest.meta.get('started', snapshots[-1]), "%Y%m%d_%H%M%S"))
+        except ValueError:
+            manifest.close()
+            return None, None
+        return manifest, int(started) * 1000000000
+
+    def _commit_snapshot(self, stats: OperationStats, current_time: str, current_data: FilesData,
+                         builder: ManifestBuilder) -> str:
+        """Diff against the last snapshot and publish the new one. Must be called under the repository lock."""
+        self._sync_cache()
+        current_manifest = builder.build()
+
+        def refresh_manifest() -> Manifest:
+            # Files modified or removed since the walk are recorded with their current entries
+            for path, entry in current_data.refreshed.items():
+                builder.replace(path, entry)
+            current_data.refreshed.clear()
+            return builder.build()
+
         prev_snapshot = self._get_last_snapshot()
+        moves = {}
+        metadata_changed = []
+        prev_snapshot_time = None  # Stays None for the first snapshot
         if prev_snapshot:
-            prev_snapshot_time = prev_snapshot.split('_', 1)[1].split('.')[0]  # Extract timestamp from filename
-            prev_data = self._load_snapshot_data(prev_snapshot)
-            if prev_data and 'data' in prev_data:
-                prev_full_data = decode_data(prev_data['data'])
-                diff_data = create_diff(prev_full_data, current_data)
-                if not diff_data:  # No changes detected
-                    logging.debug(f"No changes detected, returning previous snapshot time: {prev_data['time']}")
-                    return prev_data['time']  # Return the time of the previous snapshot
+            prev_time = prev_snapshot.split('_', 1)[1].split('.')[0]  # Extract timestamp from filename
+            prev_manifest = self._load_manifest(prev_time, stats)
+            if prev_manifest is not None:
+                with stats.phase('diff'):
+                    # Only changed files are needed: those skipped as unchanged are never read again
+                    changed, deleted = prev_manifest.diff(current_manifest)
+                    diff_data = current_data.contents(current_manifest, changed)
+                    while current_data.refreshed:
+                        current_manifest = refresh_manifest()
+                        changed, deleted = prev_manifest.diff(current_manifest)
+                        diff_data = current_data.contents(current_manifest, changed)
+                    diff_data.update({path: None for path in deleted})
+                    if self.config.detect_renames and changed:
+                        changed_index = {path: current_manifest.get(path).to_list() for path in changed}
+                        moves = self._detect_moves(prev_time, prev_manifest, changed_index, diff_data,
+                                                   changed, deleted, stats)
+                        for dest_path, src_path in moves.items():
+                            # Exact moves need no content, similar ones still store the new content
+                            if changed_index[dest_path][2] == prev_manifest.get(src_path).digest:
+                                del diff_data[dest_path]
+                    if self.config.capture_metadata:
+                        # Recorded in the index only, the content is not stored again
+                        metadata_changed = prev_manifest.changed_metadata(current_manifest)
+                prev_manifest.close()
             else:
-                diff_data = current_data
-                prev_snapshot_time = None  # Set to None if prev_data is invalid
+                # Snapshots taken before indexes were recorded: compare with the full content
+                prev_state = self._reconstruct_state(prev_time, stats)
+                with stats.phase('diff'):
+                    diff_data = create_diff(prev_state, current_data.contents(current_manifest, current_manifest))
+            if not diff_data and not moves and not metadata_changed:  # No changes detected
+                logging.debug(f"No changes detected, returning previous snapshot time: {prev_time}")
+                return prev_time  # Return the time of the previous snapshot
+            prev_snapshot_time = prev_time
         else:
-            diff_data = current_data
-            prev_snapshot_time = None  # Set to None for the first snapshot
+            diff_data = current_data.contents(current_manifest, current_manifest)
+        if current_data.refreshed:
+            current_manifest = refresh_manifest()
+
+        # Another writer may have published a snapshot since this one's capture started
+        capture_time = current_time
+        current_time = self._unused_time(current_time)
         
-        encoded_diff_data = encode_data(diff_data)
+        if self.config.object_store:
+            # Contents go to the object store, deduplicated by digest; the diff only references them
+            encoded_diff_data = {}
+            for path, content in diff_data.items():
+                if content is None:
+                    encoded_diff_data[path] = None
+                    continue
+                digest = current_manifest.get(path).digest
+                if not isinstance(content, ObjectRef):  # Already stored by a resumable capture otherwise
+                    with stats.phase('write'):
+                        stats.incr('bytes_written', self.store.put(content, digest))
+                encoded_diff_data[path] = digest
+        else:
+            with stats.phase('encode'):
+                encoded_diff_data = encode_data(diff_data)
+        stats.incr('files_stored', sum(1 for v in diff_data.values() if v is not None))
+        stats.incr('files_deleted', sum(1 for v in diff_data.values() if v is None))
         
+        current_manifest.meta = {'time': current_time}
+        if current_time != capture_time:
+            current_manifest.meta['started'] = capture_time
+        with stats.phase('write'):
+            manifest_digest, manifest_size = self._save_manifest(current_manifest, current_time)
+        stats.incr('snapshot_bytes', manifest_size)
+        stats.incr('bytes_written', manifest_size)
+
         snapshot_data = {
             'time': current_time,
             'data': encoded_diff_data,
             'compression': self.config.compress,
-            'prev_snapshot': prev_snapshot_time
+            'prev_snapshot': prev_snapshot_time,
+            'hash_algorithm': HASH_ALGORITHM,
+            # The index is in the manifest file, which the checksum covers through its digest
+            'manifest': manifest_digest
         }
+        if self.config.object_store:
+            snapshot_data['storage'] = STORAGE_OBJECTS
+        if current_time != capture_time:
+            # The next snapshot must only trust mtimes older than the capture, not than the name
+            snapshot_data['started'] = capture_time
+        if moves:
+            snapshot_data['moves'] = moves
+            stats.incr('files_moved', len(moves))
+        if metadata_changed:
+            snapshot_data['metadata_changed'] = metadata_changed
+            stats.incr('files_metadata_changed', len(metadata_changed))
+        with stats.phase('hash'):
+            snapshot_data['checksum'] = manifest_checksum(snapshot_data)
         
         # Save the new snapshot
         new_snapshot_file = f'snapshot_{current_time}.json'
         if self.config.compress:
-            self._save_compressed_snapshot(snapshot_data, current_time)
+            with stats.phase('compress'):
+                serialized, written = self._save_compressed_snapshot(snapshot_data, current_time)
         else:
-            self._save_uncompressed_snapshot(snapshot_data, current_time)
+            with stats.phase('write'):
+                serialized, written = self._save_uncompressed_snapshot(snapshot_data, current_time)
+        stats.incr('snapshot_bytes', serialized)
+        stats.incr('bytes_written', written)
+        # The catalog is only updated once the snapshot itself is durable
+        self._cache.set_version(self._add_to_catalog(current_time))
         
         logging.debug(f"New snapshot created: {new_snapshot_file}")
         return current_time
 
+    def _unused_time(self, current_time: str) -> str:
+        """
+        Return current_time, or a later time if it does not sort after every published snapshot.
+
+        Names follow the chain: a capture that started in the same second as the latest
+        published snapshot, or before it, takes the current time or the second after
+        the latest, whichever is later. Must be called under the repository lock, so
+        that no other writer publishes in between.
+        """
+        snapshots = self.list_snapshots()
+        if not snapshots or current_time > snapshots[-1]:
+            return current_time
+        try:
+            latest = time.mktime(time.strptime(snapshots[-1], "%Y%m%d_%H%M%S"))
+        except ValueError:
+            latest = time.time()
+        after_latest = time.strftime("%Y%m%d_%H%M%S", time.localtime(latest + 1))
+        return max(datetime.now().strftime("%Y%m%d_%H%M%S"), after_latest)
+
+    def _read_catalog(self) -> Optional[dict]:
+        """Read the catalog of published snapshots. It is replaced atomically, so no lock is needed."""
+        catalog_path = os.path.join(self.backup_dir, CATALOG_FILE)
+        try:
+            with open(catalog_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _add_to_catalog(self, snapshot_time: str) -> int:
+        catalog = self._read_catalog()
+        if catalog is None:
+            # Repositories created before the catalog existed
+            catalog = {'version': 0, 'snapshots': self._list_legacy_snapshots()}
+        snapshots = set(catalog['snapshots'])
+        snapshots.add(snapshot_time)
+        catalog = {'version': catalog['version'] + 1, 'snapshots': sorted(snapshots)}
+        atomic_write(os.path.join(self.backup_dir, CATALOG_FILE), json.dumps(catalog).encode())
+        return catalog['version']
+
+    def _sync_cache(self) -> None:
+        # Anything cached under an older catalog version may be stale
+        self._cache.set_version(self.catalog_version())
+
+    def _detect_moves(self, prev_time: str, prev_manifest: Manifest, changed_index: Dict[str, list],
+                      current_data: Dict[str, bytes], changed: List[str], deleted: List[str],
+                      stats: OperationStats) -> Dict[str, str]:
+        """Find renames and copies among the changed files (indexed in changed_index), by content hash and optionally by similarity."""
+        old_digests = {path: entry.digest for path, entry in prev_manifest.items()}
+        moves = detect_moves(old_digests, changed_index, changed, deleted)
+
+        threshold = self.config.similarity_threshold
+        if threshold is None:
+            return moves
+        renamed = set(moves.values())
+        new_paths = [p for p in changed if p not in moves and p not in old_digests
+                     and changed_index[p][0] <= SIMILARITY_MAX_SIZE]
+        old_paths = [p for p in deleted if p not in renamed and prev_manifest.get(p).size <= SIMILARITY_MAX_SIZE]
+        if new_paths and old_paths:
+            prev_state = self._reconstruct_state(prev_time, stats)
+            new_contents = {p: current_data[p] if not isinstance(current_data[p], ObjectRef)
+                            else self.store.get(current_data[p].digest) for p in new_paths}
+            moves.update(find_similar(new_contents,
+                                      {p: prev_state[p] for p in old_paths if p in prev_state}, threshold))
+        return moves
+
+    def _manifest_path(self, snapshot_time: str) -> str:
+        return os.path.join(self.backup_dir, MANIFESTS_DIR, f'{snapshot_time}.manifest')
+
+    def _save_manifest(self, manifest: Manifest, snapshot_time: str) -> Tuple[str, int]:
+        """Write the manifest file of a snapshot and return its digest and size."""
+        data = manifest.to_bytes()
+        os.makedirs(os.path.join(self.backup_dir, MANIFESTS_DIR), exist_ok=True)
+        atomic_write(self._manifest_path(snapshot_time), data)
+        return hash_data(data), len(data)
+
+    def _load_manifest(self, snapshot_time: str, stats: Optional[OperationStats] = None) -> Optional[Manifest]:
+        """
+        Return the manifest of a snapshot, mapped from its manifest file without loading the snapshot.
+
+        Snapshots taken before manifest files were written have their index in the
+        snapshot itself; those taken before indexes were recorded have none (None).
+        The caller closes the manifest.
+        """
+        stats = stats or OperationStats('manifest')
+        try:
+            manifest = Manifest.load(self._manifest_path(snapshot_time))
+        except FileNotFoundError:
+            manifest = None
+        if manifest is not None:
+            stats.incr('manifests_mapped')
+            return manifest
+        with stats.phase('load'):
+            snapshot_data = self._load_snapshot_data(f'snapshot_{snapshot_time}.json', stats)
+        if 'manifest' in snapshot_data:
+            raise FileNotFoundError(f"Manifest file of snapshot {snapshot_time} is missing")
+        if 'index' not in snapshot_data:
+            return None
+        meta = {'started': snapshot_data['started']} if 'started' in snapshot_data else None
+        return Manifest.from_index(snapshot_data['index'], meta=meta)
+
+    def catalog_version(self) -> int:
+        """Version of the catalog, incremented on every published snapshot."""
+        catalog = self._read_catalog()
+        return catalog['version'] if catalog else 0
+
+    def list_snapshots(self) -> List[str]:
+        """Return the times of all published snapshots, oldest first."""
+        catalog = self._read_catalog()
+        if catalog is not None:
+            return list(catalog['snapshots'])
+        return self._list_legacy_snapshots()
+
+    def _list_legacy_snapshots(self) -> List[str]:
+        return sorted(name.replace('snapshot_', '').replace('.json', '') for name in self._list_snapshot_names())
+
     def _get_last_snapshot(self) -> Optional[str]:
+        if os.path.exists(os.path.join(self.backup_dir, CATALOG_FILE)):
+            snapshots = self.list_snapshots()
+            return f'snapshot_{snapshots[-1]}.json' if snapshots else None
         if self.config.compress:
             archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
             if os.path.exists(archive_path):
@@ -78,7 +434,46 @@ class Snapshot:
         snapshots = sorted([f for f in os.listdir(self.backup_dir) if f.startswith('snapshot_') and f.endswith('.json')], reverse=True)
         return snapshots[0] if snapshots else None
 
-    def _load_snapshot_data(self, snapshot_file: str) -> dict:
+    def _load_snapshot_data(self, snapshot_file: str, stats: Optional[OperationStats] = None) -> dict:
+        """Load a snapshot manifest, from the cache if the stored file did not change since it was cached."""
+        snapshot_time = snapshot_file.replace('snapshot_', '').replace('.json', '')
+        if self.config.compress:
+            stored_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
+        else:
+            stored_path = os.path.join(self.backup_dir, f'snapshot_{snapshot_time}.json')
+        try:
+            st = os.stat(stored_path)
+            key = ('manifest', snapshot_time, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            # Packs are immutable, so their name identifies the content
+            pack_name = self.store.packs.pack_of(SNAPSHOT_KEY + snapshot_time)
+            key = ('manifest', snapshot_time, pack_name) if pack_name else None
+        snapshot_data = self._cache.get(key) if key else None
+        if snapshot_data is not None:
+            if stats:
+                stats.incr('cache_hits')
+            return snapshot_data
+        if stats:
+            stats.incr('cache_misses')
+        snapshot_data = self._read_snapshot_data(snapshot_file)
+        if key:
+            self._cache.put(key, snapshot_data, _manifest_size(snapshot_data))
+        return snapshot_data
+
+    def _read_snapshot_data(self, snapshot_file: str) -> dict:
+        return json.loads(self._read_snapshot_payload(snapshot_file))
+
+    def _read_snapshot_payload(self, snapshot_file: str) -> bytes:
+        """Read the raw manifest of a snapshot, from the archive, its own file, or a pack once repacked."""
+        try:
+            return self._read_stored_payload(snapshot_file)
+        except (FileNotFoundError, ValueError):
+            snapshot_time = snapshot_file.replace('snapshot_', '').replace('.json', '')
+            if not self.store.packs.has(SNAPSHOT_KEY + snapshot_time):
+                raise
+            return self.store.packs.read(SNAPSHOT_KEY + snapshot_time)
+
+    def _read_stored_payload(self, snapshot_file: str) -> bytes:
         if self.config.compress:
             archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
             with tarfile.open(archive_path, 'r:gz') as tar:
@@ -88,7 +483,7 @@ class Snapshot:
                     f = tar.extractfile(snapshot_name)
                     if f is None:
                         raise KeyError(f"File {snapshot_name} is not a regular file")
-                    snapshot_content = f.read()
+                    return f.read()
                 except KeyError:
                     # If the exact name is not found, try to find a matching snapshot
                     matching_members = [m for m in tar.getmembers() if m.name.startswith(snapshot_name)]
@@ -97,8 +492,7 @@ class Snapshot:
                     f = tar.extractfile(matching_members[0])
                     if f is None:
                         raise ValueError(f"Failed to extract {matching_members[0].name}")
-                    snapshot_content = f.read()
-                return json.loads(snapshot_content)
+                    return f.read()
         else:
             # Try with .json extension first, then without
             snapshot_path = os.path.join(self.backup_dir, f"{snapshot_file}.json")
@@ -108,61 +502,351 @@ class Snapshot:
             if not os.path.exists(snapshot_path):
                 raise FileNotFoundError(f"No snapshot file found for {snapshot_file}")
             
-            with open(snapshot_path, 'r') as f:
-                return json.load(f)
+            with open(snapshot_path, 'rb') as f:
+                return f.read()
+
+    def _save_compressed_snapshot(self, snapshot_data: dict, current_time: str) -> Tuple[int, int]:
+        """
+        Add the snapshot to the archive.
 
-    def _save_compressed_snapshot(self, snapshot_data: dict, current_time: str):
+        Returns the size of the serialized snapshot and the number of bytes written,
+        which is the size of the whole archive as it is rewritten.
+        """
         archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
         snapshot_content = json.dumps(snapshot_data).encode()
         if os.path.exists(archive_path):
+            # Rewritten into a temporary file and renamed, so readers keep a consistent archive
             update_archive(archive_path, f'snapshot_{current_time}', snapshot_content)
         else:
             create_archive(archive_path, f'snapshot_{current_time}', snapshot_content)
+        return len(snapshot_content), os.path.getsize(archive_path)
 
-    def _save_uncompressed_snapshot(self, snapshot_data: dict, current_time: str):
+    def _save_uncompressed_snapshot(self, snapshot_data: dict, current_time: str) -> Tuple[int, int]:
+        """Write the snapshot file and return the size of the serialized snapshot and the number of bytes written."""
         snapshot_file = os.path.join(self.backup_dir, f'snapshot_{current_time}.json')
-        with open(snapshot_file, 'w') as f:
-            json.dump(snapshot_data, f)
+        snapshot_content = json.dumps(snapshot_data).encode()
+        atomic_write(snapshot_file, snapshot_content)
+        return len(snapshot_content), len(snapshot_content)
 
     def get_stored_diff(self, snapshot_time: str) -> Dict[str, bytes]:
         """Get the stored diff for a given snapshot."""
         snapshot_data = self._load_snapshot_data(f'snapshot_{snapshot_time}.json')
-        return decode_data(snapshot_data['data'])
+        return self._decode_diff(snapshot_data)
+
+    def _decode_diff(self, snapshot_data: dict, resolve_objects: bool = True) -> Dict[str, object]:
+        """
+        Decode the diff stored in a snapshot.
+
+        Diffs of snapshots taken with an object store hold digests; they are read
+        from the store, or returned as ObjectRef values if resolve_objects is False.
+        """
+        if snapshot_data.get('storage') != STORAGE_OBJECTS:
+            return decode_data(snapshot_data['data'])
+        # Sizes of the stored files, for references
+        manifest = None if resolve_objects else self._load_manifest(snapshot_data['time'])
+        diff_data = {}
+        try:
+            for path, digest in snapshot_data['data'].items():
+                if digest is None:
+                    diff_data[path] = None
+                elif resolve_objects:
+                    diff_data[path] = self.store.get(digest)
+                else:
+                    entry = manifest.get(path) if manifest is not None else None
+                    diff_data[path] = ObjectRef(digest, entry.size if entry is not None else 0)
+        finally:
+            if manifest is not None:
+                manifest.close()
+        return diff_data
+
+    def open(self, snapshot_time: str) -> SnapshotView:
+        """
+        Return a lazy, read-only Mapping of the files of a snapshot.
+
+        Listing and stat come from the manifest; file contents are only read when
+        accessed, with view.open(path) streaming a single file.
+        """
+        self._sync_cache()
+        return SnapshotView(self, snapshot_time)
 
     def get_full_state(self, snapshot_time: str) -> Dict[str, bytes]:
         start_time = time.time()
-        snapshot_file = f'snapshot_{snapshot_time}.json'
-        snapshot_data = self._load_snapshot_data(snapshot_file)
-        current_state = decode_data(snapshot_data['data'])
-        
-        prev_snapshot_time = snapshot_data.get('prev_snapshot')
-        chain_length = 0
-        processed_snapshots = set()
-        
-        while prev_snapshot_time:
-            chain_length += 1
-            if chain_length > 100:  # Arbitrary limit to prevent excessive looping
-                logging.warning(f"Snapshot chain exceeds maximum length of 100")
-                break
-            
-            if prev_snapshot_time in processed_snapshots:
-                logging.warning(f"Circular reference detected in snapshot chain: {prev_snapshot_time}")
-                break
-            
-            processed_snapshots.add(prev_snapshot_time)
-            
-            logging.debug(f"Processing previous snapshot: {prev_snapshot_time}")
-            prev_snapshot_file = f'snapshot_{prev_snapshot_time}.json'
-            prev_data = self._load_snapshot_data(prev_snapshot_file)
-            prev_diff = decode_data(prev_data['data'])
-            current_state = apply_diff(current_state, prev_diff)
-            
-            prev_snapshot_time = prev_data.get('prev_snapshot')
-        
+        current_state = dict(self._reconstruct_state(snapshot_time))
         end_time = time.time()
-        logging.debug(f"Got full state in {end_time - start_time:.2f} seconds (chain length: {chain_length})")
+        logging.debug(f"Got full state in {end_time - start_time:.2f} seconds")
         return current_state
 
+    def _get_snapshot_chain(self, snapshot_time: str, stats: Optional[OperationStats] = None) -> List[str]:
+        """Return the times of the snapshots leading to snapshot_time, oldest first."""
+        stats = stats or OperationStats('chain')
+        snapshot_chain = []
+        current_snapshot = snapshot_time
+
+        while current_snapshot is not None:
+            if current_snapshot in snapshot_chain:
+                logging.warning(f"Circular reference detected in snapshot chain: {current_snapshot}")
+                break
+            snapshot_chain.append(current_snapshot)
+            with stats.phase('load'):
+                snapshot_data = self._load_snapshot_data(f'snapshot_{current_snapshot}.json', stats)
+            current_snapshot = snapshot_data.get('prev_snapshot')
+
+        return snapshot_chain[::-1]
+
+    def _reconstruct_state(self, snapshot_time: str, stats: Optional[OperationStats] = None,
+                           resolve_objects: bool = True) -> Dict[str, object]:
+        """
+        Rebuild the full file state of a snapshot by applying its chain of diffs.
+
+        Reconstructed states are cached, and a rebuild starts from the newest cached
+        state in the chain. The returned dict is shared with the cache: copy it before
+        modifying it. With resolve_objects=False, contents held in the object store
+        are left as ObjectRef values instead of being read.
+        """
+        stats = stats or OperationStats('reconstruct')
+        self._sync_cache()
+        snapshot_chain = self._get_snapshot_chain(snapshot_time, stats)
+        stats.incr('chain_length', len(snapshot_chain))
+
+        state = {}
+        start = 0
+        for i in range(len(snapshot_chain) - 1, -1, -1):
+            cached_state = self._cache.get(('state', snapshot_chain[i], resolve_objects))
+            if cached_state is not None:
+                stats.incr('cache_hits')
+                state = cached_state
+                start = i + 1
+                break
+
+        for snapshot in snapshot_chain[start:]:
+            logging.debug(f"Processing snapshot: {snapshot}")
+            with stats.phase('load'):
+                snapshot_data = self._load_snapshot_data(f'snapshot_{snapshot}.json', stats)
+            with stats.phase('decode'):
+                diff_data = self._decode_diff(snapshot_data, resolve_objects)
+            with stats.phase('diff'):
+                state = apply_diff(state, diff_data, snapshot_data.get('moves'))
+
+        if start < len(snapshot_chain):
+            self._cache.put(('state', snapshot_time, resolve_objects), state, _state_size(state))
+        return state
+
+    def verify(self, fast: bool = False, max_workers: Optional[int] = None) -> Dict[str, List[str]]:
+        """
+        Check every stored snapshot and return the problems found, keyed by snapshot.
+
+        Snapshots are streamed one by one and checked by a thread pool, with at most
+        a couple of snapshots per worker held in memory. With fast=True only the
+        manifest structure and index consistency are checked, no content is hashed.
+        """
+        max_workers = max_workers or min(8, (os.cpu_count() or 1))
+        known_snapshots = set(name.replace('snapshot_', '').replace('.json', '') for name in self._list_snapshot_names())
+        report = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            for name, payload in self._iter_snapshot_payloads():
+                if len(pending) >= max_workers * 2:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        report[pending.pop(future)] = future.result()
+                future = executor.submit(verify_snapshot_data, name, payload, known_snapshots, fast, self.store,
+                                         os.path.join(self.backup_dir, MANIFESTS_DIR))
+                pending[future] = name
+            for future in concurrent.futures.as_completed(pending):
+                report[pending[future]] = future.result()
+        return {name: errors for name, errors in sorted(report.items()) if errors}
+
+    def check_worktree(self, snapshot_time: str) -> Dict[str, List[str]]:
+        """
+        Report how the live directory drifted from a snapshot.
+
+        Returns the 'added', 'removed' and 'modified' paths. Files are only hashed
+        when their size or mtime differs from the snapshot index.
+        """
+        manifest = self._load_manifest(snapshot_time)
+        if manifest is not None:
+            try:
+                index = manifest.to_index()
+            finally:
+                manifest.close()
+            return check_worktree(self.target_dir, self.backup_dir, index, metadata=self.config.capture_metadata)
+        # Snapshots without an index can only be compared by content
+        full_state = self.get_full_state(snapshot_time)
+        content_hashes = {path: hash_data(content) for path, content in full_state.items()}
+        return check_worktree(self.target_dir, self.backup_dir, {}, content_hashes)
+
+    def _list_snapshot_names(self) -> List[str]:
+        suffix = '' if self.config.compress else '.json'
+        names = set(f'snapshot_{key[len(SNAPSHOT_KEY):]}{suffix}' for key in self.store.packs.keys(SNAPSHOT_KEY))
+        if self.config.compress:
+            archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
+            if os.path.exists(archive_path):
+                with tarfile.open(archive_path, 'r:gz') as tar:
+                    names.update(name for name in tar.getnames() if name.startswith('snapshot_'))
+        else:
+            names.update(f for f in os.listdir(self.backup_dir) if f.startswith('snapshot_') and f.endswith('.json'))
+        return sorted(names)
+
+    def _iter_snapshot_payloads(self):
+        """Yield (name, raw manifest bytes) for every stored snapshot, one at a time."""
+        if self.config.compress:
+            archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
+            seen = set()
+            if os.path.exists(archive_path):
+                # Stream mode reads members sequentially without seeking back
+                with tarfile.open(archive_path, 'r|gz') as tar:
+                    for member in tar:
+                        if member.isfile() and member.name.startswith('snapshot_'):
+                            seen.add(member.name)
+                            yield member.name, tar.extractfile(member).read()
+            for key in self.store.packs.keys(SNAPSHOT_KEY):
+                name = f'snapshot_{key[len(SNAPSHOT_KEY):]}'
+                if name not in seen:
+                    yield name, self.store.packs.read(key)
+            return
+        for name in self._list_snapshot_names():
+            yield name, self._read_snapshot_payload(name)
+
+    def repack(self, pack_size: int = DEFAULT_PACK_SIZE, max_bytes: Optional[int] = None,
+               bytes_per_second: Optional[float] = None) -> bool:
+        """
+        Move snapshot manifests and loose objects into size-bounded pack files.
+
+        Manifests are packed in chain order, then objects in the path order of the
+        latest state, then objects only older snapshots reference. Those are cold
+        and recompressed with lzma. Loose objects no snapshot references are removed.
+        Each pack is published before its sources are removed, so readers keep
+        working during a repack and an interrupted repack resumes where it stopped.
+        Snapshot writers are only blocked while planning and cleaning up.
+
+        Args:
+            pack_size (int): Size at which a pack is closed and a new one started.
+            max_bytes (Optional[int]): Stop once this many bytes were packed in this run.
+            bytes_per_second (Optional[float]): Throttle reads to this rate.
+
+        Returns:
+            bool: True if everything is packed, False if the budget ran out first.
+        """
+        stats = OperationStats('repack')
+        self.last_stats = stats
+        packs_dir = self.store.packs.root
+        os.makedirs(packs_dir, exist_ok=True)
+        # A second lock, in the packs directory, keeps repacks from running concurrently
+        with RepositoryLock(packs_dir, timeout=self.config.lock_timeout):
+            remove_temp_files(packs_dir)
+            with RepositoryLock(self.backup_dir, timeout=self.config.lock_timeout):
+                remove_temp_files(self.backup_dir)
+                self._ensure_catalog()
+                # Sources left behind by an interrupted repack
+                self._remove_packed_sources(stats)
+                items = self._plan_repack(stats)
+            complete = self._write_packs(items, pack_size, max_bytes, bytes_per_second, stats)
+            with RepositoryLock(self.backup_dir, timeout=self.config.lock_timeout):
+                self._remove_packed_sources(stats)
+        report_stats(stats, self.config.stats_callback)
+        return complete
+
+    def _ensure_catalog(self) -> None:
+        """Record the snapshots of a repository created before the catalog. Must be called under the repository lock."""
+        if self._read_catalog() is None:
+            catalog = {'version': 1, 'snapshots': self._list_legacy_snapshots()}
+            atomic_write(os.path.join(self.backup_dir, CATALOG_FILE), json.dumps(catalog).encode())
+
+    def _plan_repack(self, stats: OperationStats) -> List[tuple]:
+        """Return the (key, codec) entries to pack, in pack order, and remove unreferenced loose objects."""
+        packs = self.store.packs
+        # Listed before reading the checkpoint, which records objects before they are written
+        loose = set(self.store.iter_loose())
+        snapshots = self.list_snapshots()
+        items = [(SNAPSHOT_KEY + t, 'zlib') for t in snapshots if not packs.has(SNAPSHOT_KEY + t)]
+
+        # Objects of the latest state first, in path order, as a restore reads them
+        referenced = {}
+        if snapshots:
+            latest_state = self._reconstruct_state(snapshots[-1], stats, resolve_objects=False)
+            for path in sorted(latest_state):
+                if isinstance(latest_state[path], ObjectRef):
+                    referenced.setdefault(latest_state[path].digest, 'zlib')
+        for snapshot_time in reversed(snapshots):
+            snapshot_data = self._load_snapshot_data(f'snapshot_{snapshot_time}.json', stats)
+            if snapshot_data.get('storage') != STORAGE_OBJECTS:
+                continue
+            for path in sorted(snapshot_data['data']):
+                digest = snapshot_data['data'][path]
+                if digest is not None:
+                    referenced.setdefault(digest, 'lzma')
+        # Objects of a capture in progress, not referenced by a snapshot yet
+        for digest in sorted(checkpoint_digests(self.backup_dir)):
+            referenced.setdefault(digest, 'zlib')
+
+        for digest in loose - referenced.keys():
+            # Stored by a snapshot that was never published
+            self.store.remove_loose(digest)
+            stats.incr('objects_removed')
+        items.extend((OBJECT_KEY + digest, codec) for digest, codec in referenced.items()
+                     if digest in loose and not packs.has(OBJECT_KEY + digest))
+        stats.incr('entries_planned', len(items))
+        return items
+
+    def _write_packs(self, items: List[tuple], pack_size: int, max_bytes: Optional[int],
+                     bytes_per_second: Optional[float], stats: OperationStats) -> bool:
+        writer = PackWriter(self.backup_dir)
+        start = time.monotonic()
+        packed_bytes = 0
+        complete = True
+        for key, codec in items:
+            if max_bytes is not None and packed_bytes >= max_bytes:
+                complete = False
+                break
+            with stats.phase('read'):
+                if key.startswith(SNAPSHOT_KEY):
+                    data = self._read_stored_payload(f'{key.replace(SNAPSHOT_KEY, "snapshot_")}.json')
+                else:
+                    data = self.store.get(key[len(OBJECT_KEY):])
+            with stats.phase('compress'):
+                stored_size = writer.add(key, data, codec)
+            packed_bytes += len(data)
+            stats.incr('bytes_read', len(data))
+            stats.incr(f'entries_{codec}')
+            stats.incr('bytes_stored', stored_size)
+            if len(writer) >= pack_size:
+                self._publish_pack(writer, stats)
+            if bytes_per_second:
+                delay = packed_bytes / bytes_per_second - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        if writer.keys():
+            self._publish_pack(writer, stats)
+        return complete
+
+    def _publish_pack(self, writer: PackWriter, stats: OperationStats) -> None:
+        with stats.phase('write'):
+            stats.incr('bytes_written', len(writer))
+            stats.incr('entries_packed', len(writer.keys()))
+            pack_name = writer.publish()
+        stats.incr('packs_written')
+        logging.debug(f"Published pack {pack_name}")
+
+    def _remove_packed_sources(self, stats: OperationStats) -> None:
+        """Remove loose objects, snapshot files and archive members that are in a pack. Must be called under the repository lock."""
+        packs = self.store.packs
+        for digest in list(self.store.iter_loose()):
+            if packs.has(OBJECT_KEY + digest):
+                self.store.remove_loose(digest)
+                stats.incr('loose_removed')
+        for name in os.listdir(self.backup_dir):
+            if name.startswith('snapshot_') and name.endswith('.json') and \
+                    packs.has(SNAPSHOT_KEY + name[len('snapshot_'):-len('.json')]):
+                os.remove(os.path.join(self.backup_dir, name))
+                stats.incr('loose_removed')
+        archive_path = os.path.join(self.backup_dir, 'snapshots.tar.gz')
+        if os.path.exists(archive_path):
+            with tarfile.open(archive_path, 'r:gz') as tar:
+                packed = set(name for name in tar.getnames() if packs.has(SNAPSHOT_KEY + name[len('snapshot_'):]))
+            if packed:
+                remove_from_archive(archive_path, packed)
+                stats.incr('loose_removed', len(packed))
+
     def _get_files_to_snapshot(self) -> Set[str]:
         files = set()
         for root, _, filenames in os.walk(self.target_dir):
@@ -176,4 +860,12 @@ class Snapshot:
 
     def _process_file(self, file_path: str) -> bytes:
         with open(file_path, 'rb') as f:
-            return f.read()
\ No newline at end of file
+            return f.read()
+
+def _state_size(state: Dict[str, bytes]) -> int:
+    # Rough in-memory footprint: content plus per-entry dict and string overhead
+    return sum(len(path) + (len(content) if isinstance(content, bytes) else 0) + 150 for path, content in state.items())
+
+def _manifest_size(snapshot_data: dict) -> int:
+    return sum(len(path) + len(content or '') + 150 for path, content in snapshot_data.get('data', {}).items()) + \
+        200 * len(snapshot_data.get('index', {}))
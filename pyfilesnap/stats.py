@@ -0,0 +1,145 @@
+import json
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# Phases instrumented across the snapshot and restore pipelines.
+PHASES = ('walk', 'stat', 'read', 'hash', 'diff', 'encode', 'compress', 'write', 'load', 'decode', 'restore',
+          'throttle', 'metadata')
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+class Histogram:
+    """A fixed-bucket latency histogram, cumulative like Prometheus histograms."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is the +Inf bucket
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other: 'Histogram') -> None:
+        """Add the observations of another histogram with the same buckets."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+    def cumulative(self) -> List[int]:
+        result = []
+        running = 0
+        for count in self.counts:
+            running += count
+            result.append(running)
+        return result
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.cumulative())),
+        }
+
+class OperationStats:
+    """
+    Counters and per-phase latency histograms for a single snapshot or restore.
+
+    Counters are free-form names (e.g. 'files', 'bytes_read'); phases are timed
+    with the `phase` context manager and recorded into one histogram each, and
+    must be one of PHASES.
+
+    'bytes_written' counts bytes written to disk. A compressed snapshot rewrites
+    the whole archive, so it counts the archive size; 'snapshot_bytes' is the
+    size of the serialized snapshot and its manifest file in both modes.
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def incr(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, phase: str, seconds: float) -> None:
+        if phase not in PHASES:
+            raise ValueError(f"Unknown phase: {phase}")
+        if phase not in self.histograms:
+            self.histograms[phase] = Histogram()
+        self.histograms[phase].observe(seconds)
+
+    def merge(self, other: 'OperationStats') -> None:
+        """Add the counters and timings of other, e.g. collected by a worker thread."""
+        for name, value in other.counters.items():
+            self.incr(name, value)
+        for phase, histogram in other.histograms.items():
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram(histogram.buckets)
+            self.histograms[phase].merge(histogram)
+
+    @contextmanager
+    def phase(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def phase_time(self, phase: str) -> float:
+        """Total seconds spent in a phase."""
+        histogram = self.histograms.get(phase)
+        return histogram.total if histogram else 0.0
+
+    def finish(self) -> 'OperationStats':
+        self.elapsed = time.time() - self.started
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            'operation': self.operation,
+            'started': self.started,
+            'elapsed': self.elapsed,
+            'counters': dict(self.counters),
+            'phases': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def to_prometheus(self, prefix: str = 'pyfilesnap') -> str:
+        """Render the stats in the Prometheus text exposition format."""
+        op = self.operation
+        lines = []
+        for name in sorted(self.counters):
+            metric = f'{prefix}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}{{operation="{op}"}} {self.counters[name]}')
+        metric = f'{prefix}_phase_seconds'
+        if self.histograms:
+            lines.append(f'# TYPE {metric} histogram')
+        for phase in sorted(self.histograms):
+            histogram = self.histograms[phase]
+            bounds = [str(b) for b in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.cumulative()):
+                lines.append(f'{metric}_bucket{{operation="{op}",phase="{phase}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_sum{{operation="{op}",phase="{phase}"}} {histogram.total}')
+            lines.append(f'{metric}_count{{operation="{op}",phase="{phase}"}} {histogram.count}')
+        metric = f'{prefix}_elapsed_seconds'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric}{{operation="{op}"}} {self.elapsed}')
+        return '\n'.join(lines) + '\n'
+
+def report_stats(stats: OperationStats, callback: Optional[Callable[[OperationStats], None]]) -> OperationStats:
+    """Finish the stats and hand them to the user callback, if any."""
+    stats.finish()
+    if callback is not None:
+        callback(stats)
+    return stats
@@ -0,0 +1,177 @@
+import io
+import os
+import shutil
+import logging
+from typing import BinaryIO, Iterator, Optional
+from .utils import atomic_write, hash_data
+from .pack import PackSet, OBJECT_KEY
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+OBJECTS_DIR = 'objects'
+COPY_MODES = ('auto', 'reflink', 'copy_file_range', 'sendfile', 'copy', 'hardlink')
+
+# ioctl request number of FICLONE on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+class ObjectRef:
+    """Reference to a file content held in the object store."""
+
+    __slots__ = ('digest', 'size')
+
+    def __init__(self, digest: str, size: int = 0):
+        self.digest = digest
+        self.size = size
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ObjectRef) and other.digest == self.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return f'ObjectRef({self.digest[:12]})'
+
+class ObjectStore:
+    """
+    Content-addressed store of file contents, one file per object.
+
+    Objects live in objects/<first two hex digits>/<rest of the digest> and are
+    made read-only once written, so they can be hardlinked into a restored tree.
+    Objects moved into packs by a repack are read from there.
+    """
+
+    def __init__(self, backup_dir: str):
+        self.root = os.path.join(backup_dir, OBJECTS_DIR)
+        self.packs = PackSet(backup_dir)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest)) or self.packs.has(OBJECT_KEY + digest)
+
+    def put(self, data: bytes, digest: Optional[str] = None) -> int:
+        """Store data unless an object with the same digest exists. Returns the number of bytes written."""
+        digest = digest or hash_data(data)
+        if self.has(digest):
+            return 0
+        object_path = self.path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        atomic_write(object_path, data)
+        os.chmod(object_path, 0o444)
+        return len(data)
+
+    def get(self, digest: str) -> bytes:
+        with self.open(digest) as f:
+            return f.read()
+
+    def open(self, digest: str) -> BinaryIO:
+        try:
+            return open(self.path(digest), 'rb')
+        except FileNotFoundError:
+            pass
+        # Loose objects are only removed once packed, so a miss here means it is in a pack
+        try:
+            return io.BytesIO(self.packs.read(OBJECT_KEY + digest))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Object {digest} is missing from the object store")
+
+    def copy_to(self, digest: str, dest_path: str, mode: str = 'auto') -> str:
+        """Materialise an object at dest_path and return the copy method that was used."""
+        try:
+            return copy_file(self.path(digest), dest_path, mode)
+        except FileNotFoundError:
+            pass
+        with self.open(digest) as src, open(dest_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return 'unpack'
+
+    def iter_loose(self) -> Iterator[str]:
+        """Yield the digests of the objects stored as individual files."""
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            prefix_dir = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for rest in sorted(os.listdir(prefix_dir)):
+                if not rest.startswith('.'):
+                    yield prefix + rest
+
+    def remove_loose(self, digest: str) -> None:
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+def _reflink(src, dst) -> None:
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def _copy_file_range(src, dst) -> None:
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError("copy_file_range is not available")
+    remaining = os.fstat(src.fileno()).st_size
+    while remaining > 0:
+        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+        if copied == 0:
+            break
+        remaining -= copied
+
+def _sendfile(src, dst) -> None:
+    if not hasattr(os, 'sendfile'):
+        raise OSError("sendfile is not available")
+    offset = 0
+    size = os.fstat(src.fileno()).st_size
+    while offset < size:
+        sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
+
+def _plain_copy(src, dst) -> None:
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+_COPY_METHODS = (('reflink', _reflink), ('copy_file_range', _copy_file_range),
+                 ('sendfile', _sendfile), ('copy', _plain_copy))
+
+def copy_file(src_path: str, dest_path: str, mode: str = 'auto') -> str:
+    """
+    Copy a file, keeping the data in the kernel where possible.
+
+    'auto' tries a reflink (FICLONE, on btrfs/XFS the copy shares extents and costs
+    no space), then copy_file_range, sendfile and finally a plain read/write copy.
+    A specific mode falls back to the plain copy if it is not supported.
+    'hardlink' links to the source instead, which must then never be modified.
+    Returns the method that was used.
+    """
+    if mode not in COPY_MODES:
+        raise ValueError(f"Unknown copy mode: {mode}")
+    if os.path.lexists(dest_path):
+        # Never write through an existing hardlink into the object store
+        os.remove(dest_path)
+    if mode == 'hardlink':
+        try:
+            os.link(src_path, dest_path)
+            return 'hardlink'
+        except OSError as e:
+            logging.debug(f"Hardlink of {src_path} failed ({e}), copying instead")
+            mode = 'auto'
+    methods = _COPY_METHODS if mode == 'auto' else [m for m in _COPY_METHODS if m[0] in (mode, 'copy')]
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dst:
+        for name, method in methods:
+            try:
+                method(src, dst)
+                return name
+            except OSError as e:
+                logging.debug(f"{name} of {src_path} failed ({e})")
+                # Start over: a failed method may have written part of the data
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+    raise OSError(f"Could not copy {src_path} to {dest_path}")
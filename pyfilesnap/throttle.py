@@ -0,0 +1,151 @@
+import os
+import time
+import ctypes
+import logging
+import platform
+import threading
+from typing import Optional
+
+MB = 1024 * 1024
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# Priority level used within the realtime and best-effort classes (0 highest, 7 lowest)
+IONICE_LEVEL = 7
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+# ioprio_get/ioprio_set have no libc wrapper; their syscall numbers differ per architecture
+_IOPRIO_SYSCALLS = {
+    'x86_64': (252, 251), 'amd64': (252, 251), 'i386': (290, 289), 'i686': (290, 289),
+    'aarch64': (31, 30), 'arm64': (31, 30), 'armv7l': (315, 314), 'ppc64le': (274, 273),
+    's390x': (283, 282), 'riscv64': (31, 30),
+}
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: tokens are refilled at `rate` per second, up to `capacity`.
+
+    Requests larger than the capacity are allowed and put the bucket in debt, so
+    a single large read waits in proportion to its size instead of forever.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate  # One second of burst
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        """Take `amount` tokens, sleeping until they are available. Returns the seconds waited."""
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+class Throttle:
+    """
+    I/O budget shared by the reader or writer threads of one operation.
+
+    `acquire` is called before each file read or write with its size and waits for
+    the byte and operation buckets. In adaptive mode, `record_latency` tracks the
+    latency of each I/O (per MiB transferred) and, when it rises above the target,
+    pauses after every I/O so that only a fraction of the time is spent on the disk.
+    The fraction halves while latency stays high and recovers slowly once it drops.
+    """
+
+    def __init__(self, max_read_mbps: Optional[float] = None, max_iops: Optional[float] = None,
+                 adaptive: bool = False, target_latency: float = 0.02, min_duty_cycle: float = 0.05,
+                 sleep=time.sleep):
+        self.bytes_bucket = TokenBucket(max_read_mbps * MB, sleep=sleep) if max_read_mbps else None
+        self.ops_bucket = TokenBucket(max_iops, sleep=sleep) if max_iops else None
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_duty_cycle = min_duty_cycle
+        self.duty_cycle = 1.0
+        self.latency: Optional[float] = None
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes: int) -> float:
+        """Wait for the budget of one I/O of nbytes. Returns the seconds waited."""
+        waited = 0.0
+        if self.ops_bucket is not None:
+            waited += self.ops_bucket.consume(1)
+        if self.bytes_bucket is not None and nbytes:
+            waited += self.bytes_bucket.consume(nbytes)
+        return waited
+
+    def record_latency(self, seconds: float, nbytes: int) -> float:
+        """Feed the observed duration of an I/O to the adaptive mode. Returns the seconds paused."""
+        if not self.adaptive:
+            return 0.0
+        latency = seconds / max(1.0, nbytes / MB)
+        with self._lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.latency > self.target_latency:
+                self.duty_cycle = max(self.min_duty_cycle, self.duty_cycle / 2)
+            elif self.latency < self.target_latency / 2:
+                self.duty_cycle = min(1.0, self.duty_cycle + 0.05)
+            duty_cycle = self.duty_cycle
+        pause = seconds * (1 / duty_cycle - 1)
+        if pause > 0:
+            self._sleep(pause)
+        return pause
+
+def _ioprio_syscalls():
+    return _IOPRIO_SYSCALLS.get(platform.machine().lower()) if platform.system() == 'Linux' else None
+
+def _ioprio(call: int, *args) -> int:
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = libc.syscall(call, *args)
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+def set_thread_priority(nice: Optional[int] = None, ionice_class: Optional[str] = None) -> None:
+    """
+    Lower the CPU and I/O priority of the calling thread only.
+
+    On Linux both niceness and I/O priority are per thread, so the application
+    sharing the process keeps its own priority. An unprivileged thread cannot
+    raise its priority back, so this is meant as the initializer of worker
+    threads. Failures are logged and ignored.
+    """
+    tid = threading.get_native_id()
+    if nice is not None and hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, max(nice, os.getpriority(os.PRIO_PROCESS, tid)))
+        except OSError as e:
+            logging.debug(f"Could not set niceness {nice}: {e}")
+    if ionice_class is None:
+        return
+    syscalls = _ioprio_syscalls()
+    if syscalls is None:
+        logging.debug("I/O priority classes are only supported on Linux")
+        return
+    ioclass = IONICE_CLASSES[ionice_class]
+    level = 0 if ioclass == IONICE_CLASSES['idle'] else IONICE_LEVEL
+    try:
+        _ioprio(syscalls[1], _IOPRIO_WHO_PROCESS, tid, (ioclass << _IOPRIO_CLASS_SHIFT) | level)
+    except (OSError, AttributeError) as e:
+        logging.debug(f"Could not set I/O priority class {ionice_class}: {e}")
+
+def get_thread_ioprio() -> Optional[int]:
+    """Return the raw I/O priority of the calling thread, or None where unsupported."""
+    syscalls = _ioprio_syscalls()
+    if syscalls is None:
+        return None
+    try:
+        return _ioprio(syscalls[0], _IOPRIO_WHO_PROCESS, threading.get_native_id())
+    except (OSError, AttributeError):
+        return None
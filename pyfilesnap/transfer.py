@@ -0,0 +1,351 @@
+import io
+import os
+import json
+import stat
+import time
+import zlib
+import struct
+import tarfile
+import logging
+from datetime import datetime
+from typing import BinaryIO, Iterator, Optional
+from .lock import RepositoryLock
+from .manifest import DIGEST_SIZE, NO_OWNER, Manifest, ManifestBuilder
+from .stats import OperationStats, report_stats
+from .store import ObjectRef
+from .utils import hash_data, manifest_checksum, HASH_ALGORITHM, FilesData
+
+FORMATS = ('tar', 'pack')
+STREAM_MAGIC = b'PFSX'
+STREAM_VERSION = 1
+# Record type and payload length
+_RECORD = struct.Struct('<cQ')
+# Member of exported tar streams describing the export, written first
+EXPORT_INFO = '.pyfilesnap-export.json'
+
+def export(snapshot, fileobj: BinaryIO, snapshot_time: Optional[str] = None, format: str = 'tar',
+           base: Optional[str] = None) -> OperationStats:
+    """
+    Stream a snapshot to a file object or pipe, without restoring it.
+
+    'tar' writes the snapshot's tree as a regular tar stream, with an
+    .pyfilesnap-export.json member first. 'pack' writes the pyfilesnap stream
+    format: each object once, then the snapshot manifest, for `import_stream`.
+    With a base snapshot only the changes since the base are written (the
+    receiver must have the base), and objects the base holds are not sent.
+    Files are read one at a time, so memory is bounded by the largest file.
+
+    Counters of the export are also left in `snapshot.last_stats`.
+
+    Returns:
+        OperationStats: Counters of the export.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format: {format}")
+    stats = OperationStats('export')
+    snapshot.last_stats = stats
+    if snapshot_time is None:
+        snapshots = snapshot.list_snapshots()
+        if not snapshots:
+            raise ValueError("No snapshots to export")
+        snapshot_time = snapshots[-1]
+    with snapshot.open(snapshot_time) as view:
+        if base is not None:
+            with snapshot.open(base) as base_view:
+                changed, deleted = base_view.manifest.diff(view.manifest)
+                base_digests = set(entry.digest for entry in base_view.manifest.entries())
+        else:
+            changed, deleted, base_digests = list(view), [], set()
+        info = {'version': STREAM_VERSION, 'time': snapshot_time, 'base': base, 'deleted': deleted}
+        if format == 'tar':
+            _export_tar(view, fileobj, info, changed, stats)
+        else:
+            _export_pack(view, fileobj, info, changed, base_digests, stats)
+    return report_stats(stats, snapshot.config.stats_callback)
+
+def _export_tar(view, fileobj: BinaryIO, info: dict, paths: list, stats: OperationStats) -> None:
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        info_data = json.dumps(info).encode()
+        member = tarfile.TarInfo(EXPORT_INFO)
+        member.size = len(info_data)
+        member.mtime = int(time.time())
+        tar.addfile(member, io.BytesIO(info_data))
+        for path in paths:
+            entry = view.stat(path)
+            member = tarfile.TarInfo(path)
+            member.mtime = entry.mtime_ns / 1e9
+            member.mode = stat.S_IMODE(entry.mode) or 0o644
+            if entry.uid != NO_OWNER:
+                member.uid, member.gid = entry.uid, entry.gid
+            if stat.S_ISLNK(entry.mode) or stat.S_ISDIR(entry.mode):
+                if stat.S_ISLNK(entry.mode):
+                    member.type, member.linkname = tarfile.SYMTYPE, os.fsdecode(view[path])
+                else:
+                    member.type = tarfile.DIRTYPE
+                tar.addfile(member)
+                stats.incr('files')
+                continue
+            member.size = entry.size
+            with stats.phase('read'):
+                f = view.open(path)
+            with f:
+                with stats.phase('write'):
+                    tar.addfile(member, f)
+            stats.incr('files')
+            stats.incr('bytes_written', entry.size)
+
+def _write_record(fileobj: BinaryIO, kind: bytes, payload: bytes) -> None:
+    fileobj.write(_RECORD.pack(kind, len(payload)))
+    fileobj.write(payload)
+
+def _export_pack(view, fileobj: BinaryIO, info: dict, paths: list, base_digests: set,
+                 stats: OperationStats) -> None:
+    fileobj.write(STREAM_MAGIC + bytes([STREAM_VERSION]))
+    _write_record(fileobj, b'H', json.dumps(info).encode())
+    sent = set(base_digests)
+    data = {}
+    for path in paths:
+        digest = view.stat(path).digest
+        data[path] = digest
+        if digest in sent:
+            stats.incr('objects_skipped')
+            continue
+        sent.add(digest)
+        with stats.phase('read'):
+            content = view[path]
+        with stats.phase('compress'):
+            payload = bytes.fromhex(digest) + zlib.compress(content)
+        with stats.phase('write'):
+            _write_record(fileobj, b'O', payload)
+        stats.incr('objects')
+        stats.incr('bytes_written', len(payload))
+    data.update({path: None for path in info['deleted']})
+    snapshot_data = {
+        'time': info['time'],
+        'data': data,
+        'compression': False,
+        'prev_snapshot': info['base'],
+        'hash_algorithm': HASH_ALGORITHM,
+        'index': view.manifest.to_index(),
+        'storage': 'objects',
+    }
+    _write_record(fileobj, b'M', json.dumps(snapshot_data).encode())
+    _write_record(fileobj, b'E', b'')
+    fileobj.flush()
+
+def _read_exact(fileobj: BinaryIO, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            raise ValueError("Truncated snapshot stream")
+        data += chunk
+    return bytes(data)
+
+def import_stream(snapshot, fileobj: BinaryIO) -> str:
+    """
+    Ingest a stream written by `export` into the repository of `snapshot`.
+
+    Both formats are detected automatically. Objects already in the repository are
+    not written again. A 'pack' stream keeps the exported snapshot's time and
+    base; a 'tar' stream (any tar of a tree, or an export) is recorded as a new
+    snapshot diffed against the repository's latest one, stored in the object
+    store if the repository uses one. The repository is locked for the whole
+    import, so that a repack does not see the ingested objects as unreferenced.
+
+    Returns:
+        str: The time of the imported snapshot.
+    """
+    stats = OperationStats('import')
+    snapshot.last_stats = stats
+    head = _read_exact(fileobj, len(STREAM_MAGIC) + 1)
+    with RepositoryLock(snapshot.backup_dir, timeout=snapshot.config.lock_timeout):
+        snapshot._sync_cache()
+        if head[:len(STREAM_MAGIC)] == STREAM_MAGIC:
+            if head[-1] != STREAM_VERSION:
+                raise ValueError(f"Unsupported snapshot stream version {head[-1]}")
+            snapshot_time = _import_pack(snapshot, fileobj, stats)
+        else:
+            snapshot_time = _import_tar(snapshot, _Prepended(head, fileobj), stats)
+    report_stats(stats, snapshot.config.stats_callback)
+    return snapshot_time
+
+def _check_base(snapshot, base: Optional[str]) -> None:
+    if base is not None and base not in snapshot.list_snapshots():
+        raise ValueError(f"Base snapshot {base} of the stream is missing from the repository")
+
+def _put_object(snapshot, digest: str, content: bytes, stats: OperationStats) -> None:
+    if hash_data(content) != digest:
+        raise ValueError(f"Object {digest} of the stream is corrupt")
+    written = snapshot.store.put(content, digest)
+    stats.incr('objects_written' if written else 'objects_deduplicated')
+    stats.incr('bytes_written', written)
+
+def _import_pack(snapshot, fileobj: BinaryIO, stats: OperationStats) -> str:
+    info = None
+    snapshot_data = None
+    exists = False
+    while True:
+        kind, length = _RECORD.unpack(_read_exact(fileobj, _RECORD.size))
+        payload = _read_exact(fileobj, length)
+        if kind == b'H':
+            info = json.loads(payload)
+            _check_base(snapshot, info['base'])
+            exists = info['time'] in snapshot.list_snapshots()
+            if exists:
+                logging.warning(f"Snapshot {info['time']} already exists, skipping its import")
+        elif kind == b'O':
+            if info is None:
+                raise ValueError("Snapshot stream has no header")
+            if not exists:
+                with stats.phase('decode'):
+                    content = zlib.decompress(payload[DIGEST_SIZE:])
+                _put_object(snapshot, payload[:DIGEST_SIZE].hex(), content, stats)
+        elif kind == b'M':
+            snapshot_data = json.loads(payload)
+        elif kind == b'E':
+            break
+        else:
+            raise ValueError(f"Unknown record type {kind!r} in snapshot stream")
+    if info is None or snapshot_data is None:
+        raise ValueError("Snapshot stream has no header or manifest")
+
+    _check_paths(snapshot_data)
+    snapshot_time = snapshot_data['time']
+    if snapshot_time in snapshot.list_snapshots():
+        return snapshot_time
+    missing = [d for d in snapshot_data['data'].values() if d is not None and not snapshot.store.has(d)]
+    if missing:
+        raise ValueError(f"{len(missing)} objects of snapshot {snapshot_time} are missing from the stream")
+    # Streamed with its index inline, stored with it in a manifest file like any snapshot
+    index = snapshot_data.pop('index')
+    meta = {'time': snapshot_time}
+    if 'started' in snapshot_data:
+        meta['started'] = snapshot_data['started']
+    snapshot_data['manifest'], _ = snapshot._save_manifest(Manifest.from_index(index, meta), snapshot_time)
+    snapshot_data['compression'] = snapshot.config.compress
+    snapshot_data['checksum'] = manifest_checksum(snapshot_data)
+    if snapshot.config.compress:
+        snapshot._save_compressed_snapshot(snapshot_data, snapshot_time)
+    else:
+        snapshot._save_uncompressed_snapshot(snapshot_data, snapshot_time)
+    snapshot._cache.set_version(snapshot._add_to_catalog(snapshot_time))
+    stats.incr('files', len(index))
+    return snapshot_time
+
+def _check_paths(snapshot_data: dict) -> None:
+    """Reject a streamed snapshot whose time or paths would lead outside the repository or the tree."""
+    datetime.strptime(snapshot_data['time'], "%Y%m%d_%H%M%S")
+    paths = [*snapshot_data['data'], *snapshot_data['index'], *snapshot_data.get('metadata_changed', [])]
+    for new_path, old_path in snapshot_data.get('moves', {}).items():
+        paths += [new_path, old_path]
+    unsafe = [path for path in paths if _member_path(path) != path]
+    if unsafe:
+        raise ValueError(f"Snapshot stream has unsafe path {unsafe[0]!r}")
+
+class _BaseContents(FilesData):
+    """Contents of a tar import; files the stream did not carry are resolved from the base snapshot on access."""
+
+    def __init__(self, snapshot, view):
+        super().__init__(snapshot.target_dir)
+        self._snapshot = snapshot
+        self._view = view
+
+    def _read(self, path: str, entry) -> None:
+        if self._snapshot.config.object_store and self._snapshot.store.has(entry.digest):
+            self[path] = ObjectRef(entry.digest, entry.size)
+        else:
+            self[path] = self._view[path]
+
+def _import_tar(snapshot, fileobj: BinaryIO, stats: OperationStats) -> str:
+    info = {}
+    index = {}
+    contents = None
+    base_view = None
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                if member.name == EXPORT_INFO:
+                    info = json.loads(tar.extractfile(member).read())
+                    _check_base(snapshot, info.get('base'))
+                    if info.get('base'):
+                        base_view = snapshot.open(info['base'])
+                        index = base_view.manifest.to_index()
+                        for path in info.get('deleted', []):
+                            index.pop(path, None)
+                    continue
+                if not (member.isfile() or member.issym() or member.isdir()):
+                    continue
+                if member.isdir() and os.path.normpath(member.name) == os.curdir:
+                    continue
+                if contents is None:
+                    contents = _BaseContents(snapshot, base_view)
+                path = _member_path(member.name)
+                if path is None:
+                    logging.warning(f"Skipping unsafe path {member.name!r} in tar stream")
+                    continue
+                if member.issym():
+                    content, mode = os.fsencode(member.linkname), stat.S_IFLNK | 0o777
+                elif member.isdir():
+                    content, mode = b'', stat.S_IFDIR | member.mode
+                else:
+                    with stats.phase('read'):
+                        content = tar.extractfile(member).read()
+                    mode = stat.S_IFREG | member.mode
+                digest = hash_data(content)
+                index[path] = [len(content), int(member.mtime * 1e9), digest, mode, member.uid, member.gid]
+                if snapshot.config.object_store:
+                    with stats.phase('write'):
+                        _put_object(snapshot, digest, content, stats)
+                    contents[path] = ObjectRef(digest, len(content))
+                else:
+                    contents[path] = content
+                stats.incr('files')
+        if contents is None:
+            contents = _BaseContents(snapshot, base_view)
+        # Like a capture, only record the directories no file implies
+        parents = {parent for path in index for parent in _parents(path)}
+        for path in [path for path, entry in index.items() if stat.S_ISDIR(entry[3]) and path in parents]:
+            del index[path]
+            contents.pop(path, None)
+        snapshot_time = info.get('time') or datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Names the snapshot files, so it must not carry a path
+        datetime.strptime(snapshot_time, "%Y%m%d_%H%M%S")
+        if snapshot_time in snapshot.list_snapshots():
+            logging.warning(f"Snapshot {snapshot_time} already exists, skipping its import")
+            return snapshot_time
+        return snapshot._commit_snapshot(stats, snapshot_time, contents, ManifestBuilder.from_index(index))
+    finally:
+        if base_view is not None:
+            base_view.close()
+
+def _member_path(name: str) -> Optional[str]:
+    """Return the relative path of a tar member, or None if it escapes the tree."""
+    while name.startswith('./'):
+        name = name[2:]
+    if not name or name.startswith('/') or '..' in name.split('/'):
+        return None
+    return name
+
+def _parents(path: str) -> Iterator[str]:
+    while '/' in path:
+        path = path.rsplit('/', 1)[0]
+        yield path
+
+class _Prepended:
+    """A read-only stream with some bytes, already consumed from it, put back in front."""
+
+    def __init__(self, head: bytes, fileobj: BinaryIO):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._head:
+            return self._fileobj.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._fileobj.read(), b''
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        if len(data) < size:
+            data += self._fileobj.read(size - len(data))
+        return data
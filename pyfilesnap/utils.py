@@ -1,36 +1,435 @@
 import os
-from typing import Dict, Union
+import json
+import stat
+import time
+import hashlib
+import tempfile
+import concurrent.futures
+from collections import deque
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 import base64
 import zlib
 import tarfile
 import io
+import logging
 from typing import Optional
+from .stats import OperationStats
+
+TEMP_PREFIX = '.tmp-'
 
 def ensure_backup_dir(backup_dir: str) -> None:
     """Ensure that the backup directory exists."""
     os.makedirs(backup_dir, exist_ok=True)
 
-def collect_files_data(target_dir: str, backup_dir: str) -> Dict[str, bytes]:
-    """Collect data from all files in the target directory."""
-    files_data = {}
-    for root, _, files in os.walk(target_dir):
+def fsync_dir(dir_path: str) -> None:
+    """Flush a directory entry to disk so that a rename in it is durable."""
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:  # Directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _temp_path(path: str) -> Tuple[int, str]:
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+    os.chmod(temp_path, 0o644)  # mkstemp creates files readable by the owner only
+    return fd, temp_path
+
+def commit_file(temp_path: str, path: str) -> None:
+    """Atomically move a fully written and fsynced temporary file to its final path."""
+    os.replace(temp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Write a file atomically: readers see either the old or the new content.
+
+    The data goes to a uniquely named temporary file in the same directory, which
+    is fsynced before being renamed over the target.
+    """
+    fd, temp_path = _temp_path(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        commit_file(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def remove_temp_files(dir_path: str) -> None:
+    """Remove temporary files left behind by interrupted writes. Must be called under the repository lock."""
+    for name in os.listdir(dir_path):
+        if name.startswith(TEMP_PREFIX):
+            logging.debug(f"Removing leftover temporary file {name}")
+            os.remove(os.path.join(dir_path, name))
+
+HASH_ALGORITHM = 'sha256'
+
+def hash_data(data: bytes) -> str:
+    """Return the hex digest of data with the repository hash algorithm."""
+    return hashlib.new(HASH_ALGORITHM, data).hexdigest()
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file in chunks, without loading it in memory."""
+    with open(file_path, 'rb') as f:
+        return hash_fileobj(f, chunk_size)
+
+def hash_fileobj(f, chunk_size: int = 1024 * 1024) -> str:
+    """Hash the rest of an open binary file in chunks."""
+    h = hashlib.new(HASH_ALGORITHM)
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+def manifest_checksum(snapshot_data: dict) -> str:
+    """Checksum of a snapshot manifest, computed over everything except the checksum itself."""
+    content = {k: v for k, v in snapshot_data.items() if k != 'checksum'}
+    return hash_data(json.dumps(content, sort_keys=True, separators=(',', ':')).encode())
+
+def scan_files(target_dir: str, backup_dir: str, stats: Optional[OperationStats] = None,
+               metadata: bool = False) -> Iterator[Tuple[str, str, os.stat_result]]:
+    """
+    Yield (relative_path, full_path, stat) for every file in the target directory.
+
+    With metadata=True entries are lstat'ed: symlinks (to files or directories) are
+    yielded themselves instead of their targets, empty directories are yielded
+    too, and sockets, FIFOs and devices are skipped.
+    """
+    stats = stats or OperationStats('scan')
+    stat_entry = os.lstat if metadata else os.stat
+    walker = os.walk(target_dir)
+    while True:
+        with stats.phase('walk'):
+            entry = next(walker, None)
+        if entry is None:
+            break
+        root, dirs, files = entry
         if root == backup_dir:
             continue
-        for file in files:
-            file_path = os.path.join(root, file)
-            with open(file_path, 'rb') as f:
-                # Use os.path.relpath to get the relative path, then replace backslashes with forward slashes
-                relative_path = os.path.relpath(file_path, target_dir).replace(os.path.sep, '/')
-                files_data[relative_path] = f.read()
+        # Do not descend into the backup directory (object store, packs, ...)
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != backup_dir]
+        names = list(files)
+        if metadata:
+            # os.walk lists symlinks to directories with the directories, without following them
+            names += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            if not files and not dirs and root != target_dir:
+                names.append(os.curdir)
+        for file in names:
+            file_path = os.path.normpath(os.path.join(root, file))
+            # Use os.path.relpath to get the relative path, then replace backslashes with forward slashes
+            relative_path = os.path.relpath(file_path, target_dir).replace(os.path.sep, '/')
+            with stats.phase('stat'):
+                st = stat_entry(file_path)
+            if metadata and not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode) or stat.S_ISDIR(st.st_mode)):
+                logging.debug(f"Skipping special file {relative_path}")
+                continue
+            yield relative_path, file_path, st
+
+def read_entry(file_path: str, mode: int) -> bytes:
+    """Read the content recorded for a file: its data, a symlink's target, or nothing for a directory."""
+    if stat.S_ISLNK(mode):
+        return os.fsencode(os.readlink(file_path))
+    if stat.S_ISDIR(mode):
+        return b''
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def read_xattrs(file_path: str) -> Dict[str, str]:
+    """Return the extended attributes of a file (not following symlinks), values base64-encoded."""
+    if not hasattr(os, 'listxattr'):
+        return {}
+    try:
+        return {name: base64.b64encode(os.getxattr(file_path, name, follow_symlinks=False)).decode()
+                for name in os.listxattr(file_path, follow_symlinks=False)}
+    except OSError:  # Not supported by the filesystem, or removed meanwhile
+        return {}
+
+def index_entry(size: int, st: os.stat_result, digest: str, xattrs: Optional[Dict[str, str]] = None) -> list:
+    """Build a [size, mtime_ns, digest, mode] index entry, with [uid, gid, xattrs] if xattrs were read."""
+    entry = [size, st.st_mtime_ns, digest, st.st_mode]
+    if xattrs is not None:
+        entry += [st.st_uid, st.st_gid]
+        if xattrs:
+            entry.append(xattrs)
+    return entry
+
+class FilesData(dict):
+    """
+    Contents collected from a directory.
+
+    Only contents a diff may need are held: files skipped as unchanged since the
+    previous snapshot, or read and found identical to it, are not. `contents` reads
+    them from disk again if the snapshot is diffed against another base than that
+    previous snapshot. A file modified or removed since the walk is then recorded
+    as it is now, with its new index entry (None if removed) in `refreshed`.
+    """
+
+    def __init__(self, target_dir: str, stats: Optional[OperationStats] = None):
+        super().__init__()
+        self._target_dir = target_dir
+        self._stats = stats or OperationStats('collect')
+        self.refreshed: Dict[str, Optional[list]] = {}
+
+    def contents(self, manifest, paths: Iterable[str]) -> Dict[str, bytes]:
+        """Return the contents of paths of the manifest, leaving out files removed since the walk."""
+        result = {}
+        for relative_path in paths:
+            if relative_path not in self and relative_path not in self.refreshed:
+                self._read(relative_path, manifest.get(relative_path))
+            if relative_path in self:
+                result[relative_path] = self[relative_path]
+        return result
+
+    def _read(self, relative_path: str, entry) -> None:
+        file_path = os.path.join(self._target_dir, relative_path)
+        try:
+            st = os.lstat(file_path)
+            supported = stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode) or stat.S_ISDIR(st.st_mode)
+            data = read_entry(file_path, st.st_mode) if supported else None
+        except FileNotFoundError:
+            data = None
+        if data is None:
+            logging.debug(f"{relative_path} was removed while the snapshot was taken")
+            self.refreshed[relative_path] = None
+            return
+        self._stats.incr('files_reread')
+        self._stats.incr('bytes_read', len(data))
+        digest = hash_data(data)
+        if digest != entry.digest or stat.S_IFMT(st.st_mode) != stat.S_IFMT(entry.mode):
+            logging.debug(f"{relative_path} changed while the snapshot was taken, recording its new content")
+            xattrs = read_xattrs(file_path) if len(entry.to_list()) > 4 else None
+            self.refreshed[relative_path] = index_entry(len(data), st, digest, xattrs)
+        self[relative_path] = data
+
+def _read_and_hash(file_path: str, st: os.stat_result, throttle, want_hash: bool, metadata: bool) -> tuple:
+    """Read (and hash) one file within the throttle budget. Returns (data, digest, xattrs, read_s, hash_s, waited_s)."""
+    waited = throttle.acquire(st.st_size) if throttle is not None else 0.0
+    start = time.perf_counter()
+    data = read_entry(file_path, st.st_mode)
+    xattrs = read_xattrs(file_path) if metadata else None
+    read_seconds = time.perf_counter() - start
+    if throttle is not None:
+        waited += throttle.record_latency(read_seconds, len(data))
+    start = time.perf_counter()
+    digest = hash_data(data) if want_hash else None
+    return data, digest, xattrs, read_seconds, time.perf_counter() - start, waited
+
+def collect_files_data(target_dir: str, backup_dir: str, stats: Optional[OperationStats] = None,
+                       builder=None, throttle=None, max_workers: int = 1,
+                       max_memory: Optional[int] = None, initializer: Optional[Callable[[], None]] = None,
+                       checkpoint=None, metadata: bool = False, previous=None,
+                       trusted_before_ns: Optional[int] = None) -> FilesData:
+    """
+    Collect data from all files in the target directory.
+
+    If a ManifestBuilder is given, a [size, mtime_ns, digest, mode] row is added to it per file,
+    followed by uid, gid and extended attributes with metadata=True (see `scan_files`
+    for the symlinks and directories it then records).
+    Files are read within the budget of `throttle`, if given. With several workers
+    (or an initializer, e.g. to lower the priority of the reading threads) files are
+    read and hashed by a thread pool while the tree is walked, with at most
+    max_memory bytes read ahead of the walk.
+
+    With a checkpoint (which requires a builder), contents are committed to the
+    object store as they are read and the returned values are ObjectRefs; files
+    the checkpoint already holds unchanged are not read again.
+
+    With the `previous` snapshot's manifest, contents identical to it are not
+    held (see `FilesData`). Regular files whose size and mtime match it are not
+    read either, and their recorded digest is reused, unless they were modified
+    at or after trusted_before_ns (the start of the previous capture), as they
+    may have changed again within the mtime granularity. Without
+    trusted_before_ns every file is read.
+    """
+    stats = stats or OperationStats('collect')
+    files_data = FilesData(target_dir, stats)
+    want_hash = builder is not None
+
+    def consume(relative_path, st, result):
+        data, digest, xattrs, read_seconds, hash_seconds, waited = result
+        stats.observe('read', read_seconds)
+        if waited:
+            stats.observe('throttle', waited)
+        stats.incr('files')
+        stats.incr('bytes_read', len(data))
+        if builder is None:
+            files_data[relative_path] = data
+            return
+        stats.observe('hash', hash_seconds)
+        entry = index_entry(len(data), st, digest, xattrs)
+        builder.add(relative_path, entry)
+        if checkpoint is not None:
+            with stats.phase('write'):
+                files_data[relative_path], written = checkpoint.commit(relative_path, data, entry)
+            stats.incr('bytes_written', written)
+            return
+        previous_entry = previous.get(relative_path) if previous is not None else None
+        if previous_entry is None or previous_entry.digest != digest:
+            files_data[relative_path] = data
+
+    def unchanged(relative_path, file_path, st) -> bool:
+        if previous is None or builder is None or not stat.S_ISREG(st.st_mode):
+            return False
+        entry = previous.get(relative_path)
+        if (entry is None or not stat.S_ISREG(entry.mode) or entry.size != st.st_size or
+                entry.mtime_ns != st.st_mtime_ns or trusted_before_ns is None or st.st_mtime_ns >= trusted_before_ns):
+            return False
+        builder.add(relative_path, index_entry(st.st_size, st, entry.digest,
+                                               read_xattrs(file_path) if metadata else None))
+        stats.incr('files')
+        stats.incr('files_unchanged')
+        return True
+
+    def resume(relative_path, st) -> bool:
+        resumed = checkpoint.resume(relative_path, st) if checkpoint is not None else None
+        if resumed is None:
+            return False
+        entry, files_data[relative_path] = resumed
+        builder.add(relative_path, entry)
+        stats.incr('files')
+        stats.incr('files_resumed')
+        return True
+
+    if max_workers <= 1 and initializer is None:
+        for relative_path, file_path, st in scan_files(target_dir, backup_dir, stats, metadata):
+            if not unchanged(relative_path, file_path, st) and not resume(relative_path, st):
+                consume(relative_path, st, _read_and_hash(file_path, st, throttle, want_hash, metadata))
+        return files_data
+
+    # Stats are only updated from this thread; workers return their timings
+    pending = deque()
+    in_flight = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers), initializer=initializer) as executor:
+        for relative_path, file_path, st in scan_files(target_dir, backup_dir, stats, metadata):
+            if unchanged(relative_path, file_path, st) or resume(relative_path, st):
+                continue
+            while pending and (len(pending) >= 2 * max_workers or
+                               (max_memory is not None and in_flight + st.st_size > max_memory)):
+                done_path, done_st, future = pending.popleft()
+                consume(done_path, done_st, future.result())
+                in_flight -= done_st.st_size
+            pending.append((relative_path, st, executor.submit(_read_and_hash, file_path, st,
+                                                               throttle, want_hash, metadata)))
+            in_flight += st.st_size
+        while pending:
+            done_path, done_st, future = pending.popleft()
+            consume(done_path, done_st, future.result())
     return files_data
 
-def apply_snapshot(target_dir: str, snapshot_data: Dict[str, bytes]) -> None:
-    """Apply the snapshot data to the target directory."""
+def apply_snapshot(target_dir: str, snapshot_data: Dict[str, bytes], index: Dict[str, list],
+                   stats: Optional[OperationStats] = None, store=None, copy_mode: str = 'auto',
+                   throttle=None) -> None:
+    """
+    Apply the snapshot data to the target directory.
+
+    Values are either the file content, or references to objects in `store` which
+    are copied with `store.copy_to` using the given copy mode. Writes are kept
+    within the budget of `throttle`, if given. The snapshot's index tells which
+    entries are symlinks or directories, as their content alone does not; entries
+    missing from it, as in snapshots taken before indexes were recorded, are
+    written as regular files.
+    """
+    stats = stats or OperationStats('apply')
     for file_path, content in snapshot_data.items():
         full_path = os.path.join(target_dir, file_path)
+        size = len(content) if isinstance(content, (bytes, bytearray)) else content.size
+        if throttle is not None:
+            waited = throttle.acquire(size)
+            if waited:
+                stats.observe('throttle', waited)
+        start = time.perf_counter()
         os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with open(full_path, 'wb') as f:
-            f.write(content)
+        entry = index.get(file_path)
+        mode = entry[3] if entry is not None and len(entry) > 3 else 0
+        if stat.S_ISDIR(mode):
+            if os.path.islink(full_path) or os.path.isfile(full_path):
+                os.remove(full_path)
+            os.makedirs(full_path, exist_ok=True)
+        elif stat.S_ISLNK(mode):
+            if os.path.lexists(full_path):
+                os.remove(full_path)
+            os.symlink(content if isinstance(content, (bytes, bytearray)) else store.get(content.digest), full_path)
+        else:
+            if os.path.islink(full_path):
+                # Write a regular file in place of the link, not through it
+                os.remove(full_path)
+            if isinstance(content, (bytes, bytearray)):
+                with open(full_path, 'wb') as f:
+                    f.write(content)
+            else:
+                link_mode = copy_mode
+                if copy_mode == 'hardlink' and (not mode or mode & 0o222):
+                    # A writable file must not share its inode with the read-only stored object
+                    link_mode = 'auto'
+                method = store.copy_to(content.digest, full_path, link_mode)
+                stats.incr(f'copy_{method}')
+        elapsed = time.perf_counter() - start
+        stats.observe('write', elapsed)
+        if throttle is not None:
+            paused = throttle.record_latency(elapsed, size)
+            if paused:
+                stats.observe('throttle', paused)
+        stats.incr('files')
+        stats.incr('bytes_written', size)
+
+def apply_metadata(target_dir: str, index: Dict[str, list], stats: Optional[OperationStats] = None,
+                   store=None) -> None:
+    """
+    Reapply the ownership, extended attributes, permissions and mtimes recorded in an index.
+
+    Run once after all files are written, as writing into a directory changes its
+    mtime: files and symlinks come first, then directories, deepest first. Entries
+    whose type on disk differs from the recorded one are left alone. Ownership is
+    only changed where permitted, e.g. when restoring as root. Files hardlinked to
+    an object of `store` are skipped, as their inode is the stored object itself.
+    """
+    stats = stats or OperationStats('metadata')
+    entries = sorted(index.items(), key=lambda item: (stat.S_ISDIR(item[1][3]) if len(item[1]) > 3 else False,
+                                                      -item[0].count('/')))
+    with stats.phase('metadata'):
+        for relative_path, entry in entries:
+            mode = entry[3] if len(entry) > 3 else 0
+            full_path = os.path.join(target_dir, relative_path)
+            try:
+                st = os.lstat(full_path)
+            except FileNotFoundError:
+                continue
+            if not mode or stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+                continue
+            if store is not None and st.st_nlink > 1 and _is_stored_object(store, entry[2], st):
+                stats.incr('files_hardlinked')
+                continue
+            link = stat.S_ISLNK(mode)
+            try:
+                if len(entry) > 5 and (st.st_uid, st.st_gid) != (entry[4], entry[5]):
+                    try:
+                        os.chown(full_path, entry[4], entry[5], follow_symlinks=False)
+                    except PermissionError:
+                        logging.debug(f"Not permitted to restore the owner of {relative_path}")
+                if len(entry) > 6 and hasattr(os, 'setxattr'):
+                    for name, value in entry[6].items():
+                        os.setxattr(full_path, name, base64.b64decode(value), follow_symlinks=False)
+                if not link:  # Symlink permissions cannot be changed on most systems
+                    os.chmod(full_path, stat.S_IMODE(mode))
+                if not link or os.utime in os.supports_follow_symlinks:
+                    os.utime(full_path, ns=(entry[1], entry[1]), follow_symlinks=not link)
+            except OSError as e:
+                logging.warning(f"Failed to restore the metadata of {relative_path}: {e}")
+                continue
+            stats.incr('files_metadata')
+
+def _is_stored_object(store, digest: str, st: os.stat_result) -> bool:
+    try:
+        return os.path.samestat(st, os.stat(store.path(digest)))
+    except FileNotFoundError:
+        return False
 
 def encode_data(data: Dict[str, Optional[bytes]]) -> Dict[str, Optional[str]]:
     """Encode binary data as base64 strings."""
@@ -56,11 +455,26 @@ def decompress_data(compressed_data: bytes) -> bytes:
     """Decompress binary data using zlib."""
     return zlib.decompress(compressed_data)
 
+def _write_archive(archive_path: str, fill) -> None:
+    fd, temp_path = _temp_path(archive_path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                fill(tar)
+            f.flush()
+            os.fsync(f.fileno())
+        commit_file(temp_path, archive_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 def create_archive(archive_path: str, file_name: str, data: bytes) -> None:
-    with tarfile.open(archive_path, "w:gz") as tar:
+    def fill(tar):
         info = tarfile.TarInfo(name=file_name)
         info.size = len(data)
         tar.addfile(info, io.BytesIO(data))
+    _write_archive(archive_path, fill)
 
 def add_to_archive(archive_path: str, file_name: str, data: bytes) -> None:
     with tarfile.open(archive_path, "a:gz") as tar:
@@ -86,11 +500,28 @@ def extract_archive(archive_data: bytes, file_name: Optional[str] = None) -> Uni
             return extracted_data
 
 def update_archive(archive_path: str, file_name: str, data: bytes) -> None:
-    temp_archive = archive_path + '.temp'
-    with tarfile.open(archive_path, 'r:gz') as src, tarfile.open(temp_archive, 'w:gz') as dst:
-        for member in src.getmembers():
-            dst.addfile(member, src.extractfile(member))
-        info = tarfile.TarInfo(name=file_name)
-        info.size = len(data)
-        dst.addfile(info, io.BytesIO(data))
-    os.replace(temp_archive, archive_path)
+    """Rewrite the archive with an extra member, atomically replacing the original."""
+    with tarfile.open(archive_path, 'r:gz') as src:
+        def fill(dst):
+            for member in src.getmembers():
+                dst.addfile(member, src.extractfile(member))
+            info = tarfile.TarInfo(name=file_name)
+            info.size = len(data)
+            dst.addfile(info, io.BytesIO(data))
+        _write_archive(archive_path, fill)
+
+def remove_from_archive(archive_path: str, file_names) -> None:
+    """Rewrite the archive without the given members, atomically, removing it if nothing is left."""
+    with tarfile.open(archive_path, 'r:gz') as src:
+        all_members = src.getmembers()
+        members = [member for member in all_members if member.name not in file_names]
+        if len(members) == len(all_members):
+            return
+        if not members:
+            os.remove(archive_path)
+            fsync_dir(os.path.dirname(archive_path))
+            return
+        def fill(dst):
+            for member in members:
+                dst.addfile(member, src.extractfile(member))
+        _write_archive(archive_path, fill)
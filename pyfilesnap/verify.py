@@ -0,0 +1,149 @@
+import os
+import json
+import stat
+import base64
+import binascii
+from typing import Dict, List, Optional, Set
+from .utils import hash_data, hash_file, hash_fileobj, manifest_checksum, scan_files, read_entry, HASH_ALGORITHM
+from .manifest import Manifest
+
+def verify_snapshot_data(name: str, payload: bytes, known_snapshots: Set[str], fast: bool = False,
+                         store=None, manifests_dir: Optional[str] = None) -> List[str]:
+    """
+    Check a single stored snapshot and return a list of problems found.
+
+    The fast mode only checks the manifest structure: it parses, its parent exists,
+    its data is consistent with its index (read from its manifest file in
+    `manifests_dir`) and the objects it references exist in `store`. The full mode
+    also checks the manifest checksum, the digest of the manifest file and the hash
+    of every stored file.
+    """
+    try:
+        snapshot_data = json.loads(payload)
+    except ValueError as e:
+        return [f"{name}: manifest is not valid JSON ({e})"]
+    if not isinstance(snapshot_data, dict) or 'data' not in snapshot_data or 'time' not in snapshot_data:
+        return [f"{name}: manifest is missing required fields"]
+
+    errors = []
+    prev_snapshot = snapshot_data.get('prev_snapshot')
+    if prev_snapshot is not None:
+        if prev_snapshot == snapshot_data['time']:
+            errors.append(f"{name}: previous snapshot {prev_snapshot} is the snapshot itself")
+        elif prev_snapshot not in known_snapshots:
+            errors.append(f"{name}: previous snapshot {prev_snapshot} is missing")
+
+    index = None
+    if 'manifest' in snapshot_data:
+        index = _read_manifest(name, snapshot_data, manifests_dir, fast, errors)
+    elif 'index' in snapshot_data:
+        # Snapshots taken before manifest files were written
+        index = Manifest.from_index(snapshot_data['index'])
+    try:
+        _check_snapshot(name, snapshot_data, index, fast, store, errors)
+    finally:
+        if index is not None:
+            index.close()
+    return errors
+
+def _read_manifest(name: str, snapshot_data: dict, manifests_dir: Optional[str], fast: bool,
+                   errors: List[str]) -> Optional[Manifest]:
+    """Load the manifest file of a snapshot, checking its digest unless fast. Problems are added to errors."""
+    if manifests_dir is None:
+        return None
+    path = os.path.join(manifests_dir, f"{snapshot_data['time']}.manifest")
+    try:
+        if fast:
+            return Manifest.load(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if hash_data(data) != snapshot_data['manifest']:
+            errors.append(f"{name}: manifest file hash mismatch")
+        return Manifest.from_bytes(data)
+    except FileNotFoundError:
+        errors.append(f"{name}: manifest file is missing")
+    except ValueError as e:
+        errors.append(f"{name}: manifest file is not valid ({e})")
+    return None
+
+def _check_snapshot(name: str, snapshot_data: dict, index: Optional[Manifest], fast: bool, store,
+                    errors: List[str]) -> None:
+    if index is not None:
+        for file_path, content in snapshot_data['data'].items():
+            if content is None and file_path in index:
+                errors.append(f"{name}: {file_path} is deleted but still in the index")
+            elif content is not None and file_path not in index:
+                errors.append(f"{name}: {file_path} is stored but missing from the index")
+        for dest_path in snapshot_data.get('moves', {}):
+            if dest_path not in index:
+                errors.append(f"{name}: {dest_path} is moved but missing from the index")
+        for file_path in snapshot_data.get('metadata_changed', []):
+            if file_path not in index:
+                errors.append(f"{name}: metadata of {file_path} changed but it is missing from the index")
+
+    uses_objects = snapshot_data.get('storage') == 'objects'
+    if uses_objects and store is not None:
+        for file_path, digest in snapshot_data['data'].items():
+            if digest is not None and not store.has(digest):
+                errors.append(f"{name}: object {digest} of {file_path} is missing")
+
+    if fast:
+        return
+
+    checksum = snapshot_data.get('checksum')
+    if checksum is not None and checksum != manifest_checksum(snapshot_data):
+        errors.append(f"{name}: manifest checksum mismatch")
+    if index is not None and snapshot_data.get('hash_algorithm', HASH_ALGORITHM) == HASH_ALGORITHM:
+        for file_path, content in snapshot_data['data'].items():
+            if content is None or file_path not in index:
+                continue
+            if uses_objects:
+                if store is not None and store.has(content):
+                    with store.open(content) as f:
+                        if hash_fileobj(f) != index.get(file_path).digest:
+                            errors.append(f"{name}: object {content} of {file_path} hash mismatch")
+                continue
+            try:
+                decoded = base64.b64decode(content + '=' * (-len(content) % 4), validate=True)
+            except (binascii.Error, TypeError):
+                errors.append(f"{name}: {file_path} content is not valid base64")
+                continue
+            if hash_data(decoded) != index.get(file_path).digest:
+                errors.append(f"{name}: {file_path} content hash mismatch")
+
+def check_worktree(target_dir: str, backup_dir: str, index: Dict[str, list],
+                   content_hashes: Optional[Dict[str, str]] = None, metadata: bool = False) -> Dict[str, List[str]]:
+    """
+    Compare the live directory against a snapshot index.
+
+    Files whose size and mtime match the index are assumed unchanged; only the
+    others are hashed. content_hashes can provide digests for paths the index
+    does not carry (snapshots taken before indexes were recorded). metadata must
+    match the capture_metadata setting the snapshot was taken with, so symlinks
+    and empty directories are compared as recorded.
+    """
+    content_hashes = content_hashes or {}
+    report = {'added': [], 'removed': [], 'modified': []}
+    seen = set()
+    for relative_path, file_path, st in scan_files(target_dir, backup_dir, metadata=metadata):
+        seen.add(relative_path)
+        entry = index.get(relative_path)
+        if entry is None:
+            if relative_path in content_hashes:
+                if hash_file(file_path) != content_hashes[relative_path]:
+                    report['modified'].append(relative_path)
+            else:
+                report['added'].append(relative_path)
+            continue
+        # Directories are recorded without content
+        size = 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+        if entry[0] == size and entry[1] == st.st_mtime_ns:
+            continue
+        if entry[0] != size or hash_data(read_entry(file_path, st.st_mode)) != entry[2]:
+            report['modified'].append(relative_path)
+    for relative_path in set(index) | set(content_hashes):
+        if relative_path not in seen:
+            report['removed'].append(relative_path)
+    for paths in report.values():
+        paths.sort()
+    return report
@@ -0,0 +1,102 @@
+import io
+import base64
+from collections.abc import Mapping
+from typing import BinaryIO, Iterator, List, Optional
+from .manifest import Manifest, ManifestEntry
+from .stats import OperationStats
+from .utils import hash_data
+
+class SnapshotView(Mapping):
+    """
+    Lazy, read-only view of the files of one snapshot.
+
+    Iteration, `in`, `len` and `stat` are answered from the snapshot's manifest
+    without loading any content. `open` returns a file object reading one file on
+    demand: the stored object itself when it is in the object store (so seeking
+    and range reads do not load the rest of the file), otherwise the file decoded
+    from the newest snapshot of the chain that stored it. `view[path]` reads a
+    whole file.
+    """
+
+    def __init__(self, snapshot, snapshot_time: str):
+        self.snapshot = snapshot
+        self.time = snapshot_time
+        self._chain: Optional[List[str]] = None
+        manifest = snapshot._load_manifest(snapshot_time, OperationStats('view'))
+        if manifest is None:
+            # Snapshots taken before indexes were recorded: build one from the full state
+            state = snapshot._reconstruct_state(snapshot_time)
+            manifest = Manifest.from_index({path: [len(content), 0, hash_data(content), 0]
+                                            for path, content in state.items()})
+        self._manifest = manifest
+
+    @property
+    def manifest(self) -> Manifest:
+        """The snapshot's manifest, e.g. to diff two views."""
+        return self._manifest
+
+    def __getitem__(self, path: str) -> bytes:
+        if path not in self:
+            raise KeyError(path)
+        with self.open(path) as f:
+            return f.read()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._manifest)
+
+    def __len__(self) -> int:
+        return len(self._manifest)
+
+    def __contains__(self, path) -> bool:
+        return isinstance(path, str) and path in self._manifest
+
+    def stat(self, path: str) -> ManifestEntry:
+        """Return the size, mtime_ns, mode and digest recorded for a file."""
+        entry = self._manifest.get(path)
+        if entry is None:
+            raise FileNotFoundError(f"{path} is not in snapshot {self.time}")
+        return entry
+
+    def open(self, path: str) -> BinaryIO:
+        """Open a file of the snapshot for reading."""
+        digest = self.stat(path).digest
+        store = self.snapshot.store
+        if store.has(digest):
+            return store.open(digest)
+        return io.BytesIO(self._read_from_chain(path))
+
+    def read_range(self, path: str, offset: int, length: int) -> bytes:
+        """Read up to length bytes of a file, starting at offset."""
+        with self.open(path) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _read_from_chain(self, path: str) -> bytes:
+        """Find the newest snapshot of the chain that stored the file, following recorded moves."""
+        if self._chain is None:
+            self._chain = self.snapshot._get_snapshot_chain(self.time)
+        for snapshot_time in reversed(self._chain):
+            snapshot_data = self.snapshot._load_snapshot_data(f'snapshot_{snapshot_time}.json')
+            if path in snapshot_data['data']:
+                content = snapshot_data['data'][path]
+                if content is None:
+                    break
+                if snapshot_data.get('storage') == 'objects':
+                    return self.snapshot.store.get(content)
+                return base64.b64decode(content + '=' * (-len(content) % 4))
+            # A moved file has the content its source had in the previous snapshot
+            path = snapshot_data.get('moves', {}).get(path, path)
+        raise FileNotFoundError(f"Content of {path} is missing from the chain of snapshot {self.time}")
+
+    def close(self) -> None:
+        """Release the manifest, which may be memory-mapped."""
+        self._manifest.close()
+
+    def __enter__(self) -> 'SnapshotView':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f'SnapshotView({self.time!r}, {len(self)} files)'
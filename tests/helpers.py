@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+class Clock:
+    """Stands in for datetime so that consecutive snapshots get distinct times."""
+    def __init__(self):
+        self.current = datetime(2024, 1, 1, 12, 0, 0)
+
+    def now(self):
+        self.current += timedelta(seconds=1)
+        return self.current
+
+class SnapshotTestCase(unittest.TestCase):
+    """Runs each test in a fresh temporary directory, with a Clock giving snapshot times."""
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        patcher = mock.patch('pyfilesnap.snapshot.datetime', Clock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _path(self, filename):
+        return os.path.join(self.test_dir, filename)
+
+    def _create_file(self, filename, content):
+        os.makedirs(os.path.dirname(self._path(filename)), exist_ok=True)
+        with open(self._path(filename), 'w') as f:
+            f.write(content)
+
+    def _read_file(self, filename):
+        with open(self._path(filename)) as f:
+            return f.read()
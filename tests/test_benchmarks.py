@@ -0,0 +1,18 @@
+import unittest
+from benchmarks.generate import TreeSpec
+from benchmarks.run import run_benchmarks, compare_results
+
+class TestBenchmarks(unittest.TestCase):
+    def test_smoke(self):
+        # Operations that need no wait for a new snapshot name, on a tiny tree
+        spec = TreeSpec(files=20, max_size=1024, depth=1, fanout=2)
+        operations = ('snapshot', 'partial_restore', 'listing')
+        results = run_benchmarks(spec, repeat=1, history=1, operations=operations)
+        self.assertEqual(sorted(results['results']), sorted(f'{operation}[{mode}]' for operation in operations
+                                                            for mode in ('uncompressed', 'compressed')))
+        self.assertGreater(results['results']['partial_restore[uncompressed]']['bytes_written'], 0)
+        self.assertGreater(results['results']['partial_restore[compressed]']['bytes_written'], 0)
+        self.assertEqual(compare_results(results, results), [])
+
+if __name__ == '__main__':
+    unittest.main()
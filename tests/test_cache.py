@@ -0,0 +1,91 @@
+import os
+import unittest
+from pyfilesnap.cache import LRUCache
+from pyfilesnap.manifest import Manifest
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from helpers import SnapshotTestCase
+
+class TestCache(SnapshotTestCase):
+    def test_lru_eviction_by_size(self):
+        cache = LRUCache(max_bytes=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now the least recently used
+        cache.put('c', 3, 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.current_bytes, 8)
+        cache.put('huge', 4, 11)
+        self.assertIsNone(cache.get('huge'))
+
+    def test_version_change_invalidates(self):
+        cache = LRUCache()
+        cache.set_version(1)
+        cache.put('a', 1, 1)
+        cache.set_version(1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set_version(2)
+        self.assertIsNone(cache.get('a'))
+
+    def test_deletion_recorded_against_full_state(self):
+        self._create_file('a.txt', 'A')
+        self._create_file('b.txt', 'B')
+        snapshot = Snapshot(self.test_dir)
+        snapshot.take_snapshot()
+        self._create_file('a.txt', 'A2')
+        snapshot.take_snapshot()
+        os.remove(os.path.join(self.test_dir, 'b.txt'))
+        time3 = snapshot.take_snapshot()
+
+        self.assertEqual(snapshot.get_stored_diff(time3), {'b.txt': None})
+        self.assertEqual(snapshot.get_full_state(time3), {'a.txt': b'A2'})
+
+    def test_next_snapshot_uses_latest_state(self):
+        self._create_file('a.txt', 'A')
+        snapshot = Snapshot(self.test_dir)
+        time1 = snapshot.take_snapshot()
+
+        manifest = Manifest.load(os.path.join(self.test_dir, '.pyfilesnap', 'manifests', f'{time1}.manifest'))
+        self.assertEqual(manifest.meta['time'], time1)
+        self.assertIn('a.txt', manifest)
+        manifest.close()
+
+        self._create_file('b.txt', 'B')
+        snapshot.take_snapshot()
+        # Once to look for unchanged files while reading the tree, once to diff
+        self.assertEqual(snapshot.last_stats.counters.get('manifests_mapped'), 2)
+        self.assertNotIn('load', snapshot.last_stats.histograms)
+
+    def test_restore_reuses_reconstructed_state(self):
+        self._create_file('a.txt', 'A')
+        Snapshot(self.test_dir).take_snapshot()
+        self._create_file('a.txt', 'A2')
+        Snapshot(self.test_dir).take_snapshot()
+
+        restore = Restore(self.test_dir)
+        restore.restore_last()
+        # Only the second snapshot is needed, as it stores the only file
+        self.assertEqual(restore.last_stats.counters['cache_misses'], 1)
+        restore.restore_last()
+        self.assertNotIn('cache_misses', restore.last_stats.counters)
+        self.assertNotIn('decode', restore.last_stats.histograms)
+
+        # A new snapshot bumps the catalog version and invalidates the cache
+        self._create_file('a.txt', 'A3')
+        Snapshot(self.test_dir).take_snapshot()
+        restore.restore_last()
+        self.assertIn('decode', restore.last_stats.histograms)
+        with open(os.path.join(self.test_dir, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'A3')
+
+    def test_cache_disabled(self):
+        self._create_file('a.txt', 'A')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(cache_size=0))
+        time1 = snapshot.take_snapshot()
+        snapshot.get_full_state(time1)
+        snapshot.get_full_state(time1)
+        self.assertEqual(len(snapshot._cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import unittest
+from unittest import mock
+from pyfilesnap.checkpoint import read_progress, CHECKPOINT_DIR, PROGRESS_FILE
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.store import ObjectStore
+from helpers import SnapshotTestCase
+
+class _Interrupted(Exception):
+    pass
+
+class TestCheckpoint(SnapshotTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(10):
+            self._create_file(f'file{i}.txt', f'content {i}')
+        self.config = SnapshotConfig(object_store=True, resumable=True, checkpoint_interval=2)
+
+    def _interrupt_after(self, snapshot, count):
+        """Take a snapshot that is interrupted while storing its (count + 1)th object."""
+        original_put = ObjectStore.put
+        calls = []
+
+        def put(store, data, digest=None):
+            if len(calls) == count:
+                raise _Interrupted()
+            calls.append(digest)
+            return original_put(store, data, digest)
+
+        with mock.patch.object(ObjectStore, 'put', put):
+            with self.assertRaises(_Interrupted):
+                snapshot.take_snapshot()
+
+    def test_interrupted_capture_resumes(self):
+        snapshot = Snapshot(self.test_dir, config=self.config)
+        self._interrupt_after(snapshot, 4)
+        self.assertEqual(snapshot.list_snapshots(), [])
+        progress_path = os.path.join(snapshot.backup_dir, CHECKPOINT_DIR, PROGRESS_FILE)
+        # The fifth file was logged, but its object was never written
+        self.assertEqual(len(read_progress(progress_path)), 5)
+
+        # A file changed since the interrupted run is read again
+        resumed_paths = sorted(path for path, entry in read_progress(progress_path).items()
+                               if snapshot.store.has(entry[2]))
+        self._create_file(resumed_paths[0], 'changed')
+        os.utime(os.path.join(self.test_dir, resumed_paths[0]), ns=(1, 1))
+
+        snapshot_time = snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['files_resumed'], 3)
+        self.assertEqual(snapshot.last_stats.counters['files'], 10)
+        self.assertFalse(os.path.exists(progress_path))
+
+        state = snapshot.get_full_state(snapshot_time)
+        self.assertEqual(state[resumed_paths[0]], b'changed')
+        self.assertEqual(state['file9.txt'], b'content 9')
+        self.assertEqual(len(state), 10)
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_torn_progress_line_is_ignored(self):
+        snapshot = Snapshot(self.test_dir, config=self.config)
+        self._interrupt_after(snapshot, 2)
+        progress_path = os.path.join(snapshot.backup_dir, CHECKPOINT_DIR, PROGRESS_FILE)
+        with open(progress_path, 'a') as f:
+            f.write('["file9.txt", 9, 12')
+
+        snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['files_resumed'], 2)
+
+    def test_repack_keeps_objects_of_unfinished_capture(self):
+        snapshot = Snapshot(self.test_dir, config=self.config)
+        self._interrupt_after(snapshot, 4)
+        snapshot.repack()
+        self.assertEqual(snapshot.last_stats.counters.get('objects_removed', 0), 0)
+
+        snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['files_resumed'], 4)
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_resumable_needs_object_store(self):
+        with self.assertRaises(ValueError):
+            SnapshotConfig(resumable=True)
+
+if __name__ == '__main__':
+    unittest.main()
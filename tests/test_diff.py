@@ -1,5 +1,5 @@
 import unittest
-from pyfilesnap.diff import create_diff, apply_diff
+from pyfilesnap.diff import create_diff, apply_diff, detect_moves, find_similar
 
 class TestDiff(unittest.TestCase):
     def test_create_diff(self):
@@ -19,5 +19,28 @@ class TestDiff(unittest.TestCase):
         expected = {'file1': b'content1', 'file2': b'modified', 'file3': b'new'}
         self.assertEqual(result, expected)
 
+    def test_apply_diff_with_moves(self):
+        base_data = {'old': b'content1', 'file2': b'content2'}
+        diff_data = {'old': None}
+
+        result = apply_diff(base_data, diff_data, {'new': 'old', 'copy': 'file2'})
+
+        self.assertEqual(result, {'new': b'content1', 'file2': b'content2', 'copy': b'content2'})
+
+    def test_detect_moves_prefers_deleted_source(self):
+        old_digests = {'a': 'd1', 'b': 'd1', 'c': 'd2'}
+        new_index = {'a': [1, 0, 'd1'], 'x': [1, 0, 'd1'], 'y': [1, 0, 'd3']}
+
+        moves = detect_moves(old_digests, new_index, ['x', 'y'], ['b', 'c'])
+
+        self.assertEqual(moves, {'x': 'b'})
+
+    def test_find_similar(self):
+        old_contents = {'old.txt': b'line one\nline two\nline three\n', 'other.txt': b'unrelated'}
+        new_contents = {'new.txt': b'line one\nline 2\nline three\n'}
+
+        self.assertEqual(find_similar(new_contents, old_contents, 0.8), {'new.txt': 'old.txt'})
+        self.assertEqual(find_similar(new_contents, old_contents, 0.99), {})
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
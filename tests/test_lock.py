@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+from pyfilesnap import lock
+from pyfilesnap.lock import RepositoryLock
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.utils import atomic_write, remove_temp_files
+from helpers import SnapshotTestCase
+
+class TestLock(SnapshotTestCase):
+    def test_lock_is_exclusive(self):
+        with RepositoryLock(self.test_dir):
+            with self.assertRaises(TimeoutError):
+                RepositoryLock(self.test_dir, timeout=0.1).acquire()
+        # Released on exit
+        with RepositoryLock(self.test_dir, timeout=0.1):
+            pass
+
+    def test_lockfile_fallback_removes_stale_lock(self):
+        with mock.patch.object(lock, 'fcntl', None):
+            # A lock file left by a process that no longer exists
+            with open(os.path.join(self.test_dir, 'lock'), 'w') as f:
+                f.write(f'999999999@{lock.socket.gethostname()}\n')
+            with RepositoryLock(self.test_dir, timeout=1):
+                with self.assertRaises(TimeoutError):
+                    RepositoryLock(self.test_dir, timeout=0.1).acquire()
+            self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'lock')))
+
+    def test_atomic_write_and_temp_cleanup(self):
+        path = os.path.join(self.test_dir, 'file.json')
+        atomic_write(path, b'first')
+        atomic_write(path, b'second')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'second')
+
+        # Simulate a write interrupted before its rename
+        with open(os.path.join(self.test_dir, '.tmp-abc'), 'wb') as f:
+            f.write(b'partial')
+        remove_temp_files(self.test_dir)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['file.json'])
+
+    def test_catalog_lists_published_snapshots(self):
+        with open(os.path.join(self.test_dir, 'file1.txt'), 'w') as f:
+            f.write('content')
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+
+        with open(os.path.join(self.test_dir, '.pyfilesnap', 'catalog.json')) as f:
+            catalog = json.load(f)
+        self.assertEqual(catalog, {'version': 1, 'snapshots': [snapshot_time]})
+        self.assertEqual(snapshot.list_snapshots(), [snapshot_time])
+        self.assertEqual(snapshot.catalog_version(), 1)
+
+    def test_concurrent_snapshots(self):
+        for i in range(5):
+            with open(os.path.join(self.test_dir, f'file{i}.txt'), 'w') as f:
+                f.write(f'content {i}')
+        errors = []
+
+        def take():
+            try:
+                Snapshot(self.test_dir, config=SnapshotConfig(compress=True)).take_snapshot()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(compress=True))
+        self.assertEqual(len(snapshot.list_snapshots()), 1)
+        self.assertEqual(snapshot.verify(), {})
+        self.assertFalse(any(name.startswith('.tmp-') for name in os.listdir(snapshot.backup_dir)))
+
+    def test_snapshot_names_follow_the_chain(self):
+        with open(os.path.join(self.test_dir, 'file1.txt'), 'w') as f:
+            f.write('content')
+        # Times of: the first capture, the second capture and its commit, the third capture and its commit
+        times = [datetime(2024, 1, 1, 12, 0, 0), datetime(2024, 1, 1, 12, 0, 0), datetime(2024, 1, 1, 12, 0, 0),
+                 datetime(2024, 1, 1, 11, 0, 0), datetime(2024, 1, 1, 11, 0, 0)]
+        names = []
+        with mock.patch('pyfilesnap.snapshot.datetime', mock.Mock(now=mock.Mock(side_effect=times))):
+            for content in ('changed', 'changed again', 'changed once more'):
+                names.append(Snapshot(self.test_dir).take_snapshot())
+                with open(os.path.join(self.test_dir, 'file1.txt'), 'w') as f:
+                    f.write(content)
+        # Captured in the same second as the first snapshot, then before the latest one
+        self.assertEqual(names, ['20240101_120000', '20240101_120001', '20240101_120002'])
+
+        snapshot = Snapshot(self.test_dir)
+        self.assertEqual(snapshot.list_snapshots(), names)
+        snapshot_data = snapshot._load_snapshot_data(f'snapshot_{names[2]}.json')
+        self.assertEqual(snapshot_data['prev_snapshot'], names[1])
+        self.assertEqual(snapshot_data['started'], '20240101_110000')
+        self.assertEqual(snapshot.get_full_state(names[0]), {'file1.txt': b'content'})
+        self.assertEqual(snapshot.verify(), {})
+
+if __name__ == '__main__':
+    unittest.main()
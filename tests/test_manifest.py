@@ -0,0 +1,103 @@
+import os
+import unittest
+from pyfilesnap.manifest import Manifest, ManifestBuilder, RESTART_INTERVAL
+from helpers import SnapshotTestCase
+
+def _digest(n):
+    return f'{n:064x}'
+
+class TestManifest(SnapshotTestCase):
+    def setUp(self):
+        super().setUp()
+        # Enough entries to span several restart blocks, with shared prefixes
+        self.index = {
+            f'dir{i % 5}/sub dir/file_{i:04d}.txt': [i * 10, 1700000000000000000 + i, _digest(i), 0o100644]
+            for i in range(RESTART_INTERVAL * 5 + 3)
+        }
+        self.index['ünïcode/файл'] = [1, 2, _digest(999), 0o100600]
+
+    def test_round_trip(self):
+        manifest = Manifest.from_index(self.index)
+        self.assertEqual(len(manifest), len(self.index))
+        self.assertEqual(list(manifest), sorted(self.index))
+        self.assertEqual(manifest.to_index(), self.index)
+
+    def test_lookup(self):
+        manifest = Manifest.from_index(self.index)
+        entry = manifest.get('dir3/sub dir/file_0013.txt')
+        self.assertEqual(entry.size, 130)
+        self.assertEqual(entry.mtime_ns, 1700000000000000013)
+        self.assertEqual(entry.digest, _digest(13))
+        self.assertEqual(entry.mode, 0o100644)
+        self.assertIn('ünïcode/файл', manifest)
+        self.assertNotIn('dir3/sub dir/file_9999.txt', manifest)
+        self.assertNotIn('', manifest)
+        self.assertIsNone(manifest.get('zzz'))
+
+    def test_save_and_mmap_load(self):
+        path = os.path.join(self.test_dir, 'test.manifest')
+        Manifest.from_index(self.index, meta={'time': '20240101_000000'}).save(path)
+        manifest = Manifest.load(path)
+        self.assertEqual(manifest.meta, {'time': '20240101_000000'})
+        self.assertEqual(manifest.to_index(), self.index)
+        self.assertIsInstance(manifest.sizes, memoryview)
+        manifest.close()
+
+    def test_empty_manifest(self):
+        path = os.path.join(self.test_dir, 'empty.manifest')
+        Manifest.from_index({}).save(path)
+        manifest = Manifest.load(path)
+        self.assertEqual(len(manifest), 0)
+        self.assertEqual(list(manifest), [])
+        self.assertNotIn('a', manifest)
+        manifest.close()
+
+    def test_merge_join_diff(self):
+        new_index = dict(self.index)
+        del new_index['dir0/sub dir/file_0000.txt']
+        new_index['dir1/sub dir/file_0001.txt'] = [1, 1, _digest(12345), 0o100644]
+        new_index['dir2/sub dir/file_0002.txt'] = [20, 5, _digest(2), 0o100644]  # Only mtime changed
+        new_index['aaa_first'] = [1, 1, _digest(1), 0o100644]
+        new_index['zzz_last'] = [1, 1, _digest(1), 0o100644]
+
+        changed, deleted = Manifest.from_index(self.index).diff(Manifest.from_index(new_index))
+        self.assertEqual(changed, ['aaa_first', 'dir1/sub dir/file_0001.txt', 'zzz_last'])
+        self.assertEqual(deleted, ['dir0/sub dir/file_0000.txt'])
+
+    def test_builder_sorts_rows(self):
+        builder = ManifestBuilder()
+        for path in reversed(list(self.index)):
+            builder.add(path, self.index[path])
+        self.assertEqual(len(builder), len(self.index))
+        self.assertEqual(builder.build().to_index(), self.index)
+
+        builder.replace('ünïcode/файл', [2, 3, _digest(1000), 0o100644, 0, 0, {'user.tag': 'dGFn'}])
+        builder.replace('dir0/sub dir/file_0000.txt', None)
+        index = dict(self.index)
+        index['ünïcode/файл'] = [2, 3, _digest(1000), 0o100644, 0, 0, {'user.tag': 'dGFn'}]
+        del index['dir0/sub dir/file_0000.txt']
+        manifest = builder.build({'time': '20240101_000000'})
+        self.assertEqual(manifest.to_index(), index)
+        self.assertEqual(manifest.meta, {'time': '20240101_000000'})
+
+    def test_owner_and_xattrs(self):
+        index = dict(self.index)
+        index['owned'] = [1, 2, _digest(1), 0o100644, 1000, 100]
+        index['with_xattrs'] = [1, 2, _digest(2), 0o100644, 0, 0, {'user.tag': 'dGFn'}]
+        path = os.path.join(self.test_dir, 'test.manifest')
+        Manifest.from_index(index).save(path)
+        manifest = Manifest.load(path)
+        self.assertEqual(manifest.to_index(), index)
+        self.assertEqual(manifest.get('with_xattrs').xattrs, {'user.tag': 'dGFn'})
+
+        new_index = dict(index)
+        new_index['owned'] = [1, 2, _digest(1), 0o100644, 1001, 100]
+        new_index['with_xattrs'] = [1, 2, _digest(2), 0o100644, 0, 0]
+        new_index['dir2/sub dir/file_0002.txt'] = [20, 5, _digest(2), 0o100644]
+        new_index['dir3/sub dir/file_0003.txt'] = [30, 5, _digest(12345), 0o100644]  # Content changed
+        self.assertEqual(manifest.changed_metadata(Manifest.from_index(new_index)),
+                         ['dir2/sub dir/file_0002.txt', 'owned', 'with_xattrs'])
+        manifest.close()
+
+if __name__ == '__main__':
+    unittest.main()
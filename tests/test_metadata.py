@@ -0,0 +1,175 @@
+import os
+import stat
+import shutil
+import unittest
+from unittest import mock
+from pyfilesnap import snapshot as snapshot_module, utils
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from helpers import SnapshotTestCase
+
+# 2020-01-01, before the times the clock below gives snapshots
+OLD_MTIME_NS = 1577836800 * 1000000000
+
+class TestMetadata(SnapshotTestCase):
+    def test_metadata_only_changes(self):
+        self._create_file('a.txt', 'content')
+        os.chmod(self._path('a.txt'), 0o600)
+        snapshot = Snapshot(self.test_dir)
+        first = snapshot.take_snapshot()
+        manifest = snapshot._load_manifest(first)
+        entry = manifest.get('a.txt').to_list()
+        manifest.close()
+        self.assertEqual(entry[3], stat.S_IFREG | 0o600)
+        self.assertEqual(entry[4:6], [os.getuid(), os.getgid()])
+
+        os.chmod(self._path('a.txt'), 0o640)
+        second = snapshot.take_snapshot()
+        self.assertNotEqual(second, first)
+        snapshot_data = snapshot._load_snapshot_data(f'snapshot_{second}.json')
+        self.assertEqual(snapshot_data['data'], {})
+        self.assertEqual(snapshot_data['metadata_changed'], ['a.txt'])
+
+        os.utime(self._path('a.txt'), ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+        third = snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['files_metadata_changed'], 1)
+        self.assertEqual(snapshot.take_snapshot(), third)  # Nothing changed since
+        self.assertEqual(snapshot.verify(), {})
+
+        os.chmod(self._path('a.txt'), 0o644)
+        restore = Restore(self.test_dir)
+        self.assertTrue(restore._restore_snapshot(first))
+        self.assertEqual(stat.S_IMODE(os.stat(self._path('a.txt')).st_mode), 0o600)
+        self.assertEqual(os.stat(self._path('a.txt')).st_mtime_ns, entry[1])
+        self.assertTrue(restore._restore_snapshot(third))
+        self.assertEqual(stat.S_IMODE(os.stat(self._path('a.txt')).st_mode), 0o640)
+        self.assertEqual(os.stat(self._path('a.txt')).st_mtime_ns, OLD_MTIME_NS)
+
+    def test_symlinks_and_empty_directories(self):
+        self._create_file('dir/a.txt', 'content')
+        os.symlink('dir/a.txt', self._path('file_link'))
+        os.symlink('dir', self._path('dir_link'))
+        os.symlink('missing', self._path('broken_link'))
+        os.makedirs(self._path('empty/nested'))
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(object_store=True))
+        snapshot_time = snapshot.take_snapshot()
+        state = snapshot.get_full_state(snapshot_time)
+        self.assertEqual(state, {'dir/a.txt': b'content', 'file_link': b'dir/a.txt', 'dir_link': b'dir',
+                                 'broken_link': b'missing', 'empty/nested': b''})
+        self.assertEqual(snapshot.check_worktree(snapshot_time), {'added': [], 'removed': [], 'modified': []})
+
+        os.remove(self._path('file_link'))
+        os.remove(self._path('dir_link'))
+        self._create_file('broken_link', 'a regular file now')
+        shutil.rmtree(self._path('empty'))
+        os.utime(self._path('dir'), ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+        Restore(self.test_dir).restore_last()
+        self.assertEqual(os.readlink(self._path('file_link')), 'dir/a.txt')
+        self.assertEqual(os.readlink(self._path('dir_link')), 'dir')
+        self.assertEqual(os.readlink(self._path('broken_link')), 'missing')
+        self.assertTrue(os.path.isdir(self._path('empty/nested')))
+        with open(self._path('file_link')) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_apply_full_state(self):
+        self._create_file('dir/a.txt', 'content')
+        os.symlink('dir', self._path('dir_link'))
+        os.makedirs(self._path('empty'))
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+        manifest = snapshot._load_manifest(snapshot_time)
+        index = manifest.to_index()
+        manifest.close()
+        copy_dir = self._path('copy')
+        utils.apply_snapshot(copy_dir, snapshot.get_full_state(snapshot_time), index)
+        self.assertTrue(os.path.isdir(os.path.join(copy_dir, 'empty')))
+        self.assertEqual(os.readlink(os.path.join(copy_dir, 'dir_link')), 'dir')
+        with open(os.path.join(copy_dir, 'dir/a.txt')) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_xattrs(self):
+        self._create_file('a.txt', 'content')
+        try:
+            os.setxattr(self._path('a.txt'), 'user.origin', b'test')
+        except (AttributeError, OSError):
+            self.skipTest('Extended attributes are not supported here')
+        snapshot = Snapshot(self.test_dir)
+        first = snapshot.take_snapshot()
+        os.setxattr(self._path('a.txt'), 'user.origin', b'changed')
+        second = snapshot.take_snapshot()
+        self.assertEqual(snapshot._load_snapshot_data(f'snapshot_{second}.json')['metadata_changed'], ['a.txt'])
+
+        Restore(self.test_dir)._restore_snapshot(first)
+        self.assertEqual(os.getxattr(self._path('a.txt'), 'user.origin'), b'test')
+
+    def test_unchanged_files_are_not_read(self):
+        for i in range(5):
+            self._create_file(f'file{i}.txt', f'content {i}')
+            os.utime(self._path(f'file{i}.txt'), ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+        snapshot = Snapshot(self.test_dir)
+        snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['bytes_read'], 45)
+
+        self._create_file('file0.txt', 'changed 0')
+        with mock.patch.object(utils, 'read_entry', wraps=utils.read_entry) as read_entry:
+            second = snapshot.take_snapshot()
+        self.assertEqual(read_entry.call_count, 1)
+        self.assertEqual(snapshot.last_stats.counters['files_unchanged'], 4)
+        self.assertEqual(snapshot.last_stats.counters['bytes_read'], 9)
+        self.assertEqual(snapshot.get_stored_diff(second), {'file0.txt': b'changed 0'})
+
+        # Without trusting mtimes, every file is read again, but only changed contents are kept
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(trust_mtime=False))
+        self._create_file('file1.txt', 'changed 1')
+        collect_files_data = snapshot_module.collect_files_data
+        collected = []
+
+        def collect(*args, **kwargs):
+            collected.append(collect_files_data(*args, **kwargs))
+            return collected[-1]
+
+        with mock.patch.object(snapshot_module, 'collect_files_data', collect):
+            third = snapshot.take_snapshot()
+        self.assertNotIn('files_unchanged', snapshot.last_stats.counters)
+        self.assertEqual(snapshot.last_stats.counters['bytes_read'], 45)
+        self.assertEqual(list(collected[0]), ['file1.txt'])
+        self.assertEqual(snapshot.get_stored_diff(third), {'file1.txt': b'changed 1'})
+
+    def test_files_changed_while_committing(self):
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self._create_file(name, f'{name} v1')
+            os.utime(self._path(name), ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+        snapshot = Snapshot(self.test_dir)
+        snapshot.take_snapshot()
+        collect_files_data = snapshot_module.collect_files_data
+
+        def collect_then_race(*args, **kwargs):
+            files_data = collect_files_data(*args, **kwargs)
+            # Another writer publishes b.txt and c.txt changed, so this capture needs their skipped contents
+            with mock.patch.object(snapshot_module, 'collect_files_data', collect_files_data):
+                self._create_file('b.txt', 'b.txt v2')
+                self._create_file('c.txt', 'c.txt v2')
+                Snapshot(self.test_dir).take_snapshot()
+            # ...which change again before they are read
+            self._create_file('b.txt', 'b.txt v3')
+            os.remove(self._path('c.txt'))
+            return files_data
+
+        with mock.patch.object(snapshot_module, 'collect_files_data', collect_then_race):
+            third = snapshot.take_snapshot()
+        self.assertEqual(snapshot.last_stats.counters['files_reread'], 1)
+        self.assertEqual(snapshot.get_full_state(third), {'a.txt': b'a.txt v1', 'b.txt': b'b.txt v3'})
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_without_metadata_capture(self):
+        self._create_file('a.txt', 'content')
+        os.symlink('a.txt', self._path('link'))
+        os.makedirs(self._path('empty'))
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(capture_metadata=False))
+        first = snapshot.take_snapshot()
+        self.assertEqual(snapshot.get_full_state(first), {'a.txt': b'content', 'link': b'content'})
+        os.chmod(self._path('a.txt'), 0o600)
+        self.assertEqual(snapshot.take_snapshot(), first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import unittest
+from pyfilesnap.pack import PackSet, PackWriter, compress
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from helpers import SnapshotTestCase
+
+class TestPack(SnapshotTestCase):
+    def _take_snapshots(self, config):
+        snapshot = Snapshot(self.test_dir, config=config)
+        times = []
+        for i in range(3):
+            self._create_file(f'file{i}.txt', f'content {i}' * 50)
+            self._create_file('changing.txt', f'version {i}')
+            times.append(snapshot.take_snapshot())
+        return snapshot, times
+
+    def test_pack_writer_and_reader(self):
+        writer = PackWriter(self.test_dir)
+        writer.add('object/a', b'a' * 1000, 'lzma')
+        writer.add('object/b', b'\x00\x01', 'zlib')  # Does not shrink, stored as is
+        writer.publish()
+
+        packs = PackSet(self.test_dir)
+        self.assertEqual(packs.read('object/a'), b'a' * 1000)
+        self.assertEqual(packs.read('object/b'), b'\x00\x01')
+        self.assertEqual(packs.keys('object/'), ['object/a', 'object/b'])
+        self.assertEqual(compress(b'\x00\x01', 'zlib')[1], 'none')
+        with self.assertRaises(FileNotFoundError):
+            packs.read('object/c')
+
+        # A pack published within the same mtime tick as the last lookup is still found
+        packs_dir = os.path.join(self.test_dir, 'packs')
+        stamp = os.stat(packs_dir).st_mtime_ns
+        writer.add('object/c', b'c', 'none')
+        writer.publish()
+        os.utime(packs_dir, ns=(stamp, stamp))
+        self.assertEqual(packs.read('object/c'), b'c')
+
+    def test_repack_object_store(self):
+        snapshot, times = self._take_snapshots(SnapshotConfig(object_store=True))
+        expected = {t: snapshot.get_full_state(t) for t in times}
+        # An object left by a snapshot that was never published
+        snapshot.store.put(b'orphan')
+
+        self.assertTrue(snapshot.repack())
+        stats = snapshot.last_stats.counters
+        self.assertEqual(stats['objects_removed'], 1)
+        self.assertEqual(stats['entries_lzma'], 2)  # Old versions of changing.txt
+        self.assertEqual(list(snapshot.store.iter_loose()), [])
+        self.assertFalse(any(name.startswith('snapshot_') for name in os.listdir(snapshot.backup_dir)))
+
+        reader = Snapshot(self.test_dir, config=SnapshotConfig(object_store=True))
+        reader._cache.clear()  # Read everything back from the packs
+        self.assertEqual(reader.list_snapshots(), times)
+        for t in times:
+            self.assertEqual(reader.get_full_state(t), expected[t])
+        self.assertEqual(reader.verify(), {})
+
+        self._create_file('changing.txt', 'modified')
+        restore = Restore(self.test_dir)
+        self.assertTrue(restore.restore_last())
+        self.assertEqual(self._read_file('changing.txt'), 'version 2')
+        self.assertEqual(restore.last_stats.counters['copy_unpack'], 4)
+
+        # New snapshots keep working on top of packed ones
+        self._create_file('new.txt', 'new')
+        new_time = reader.take_snapshot()
+        self.assertEqual(reader.get_full_state(new_time)['new.txt'], b'new')
+        self.assertEqual(reader.get_full_state(new_time)['file0.txt'], b'content 0' * 50)
+
+    def test_repack_compressed_archive(self):
+        snapshot, times = self._take_snapshots(SnapshotConfig(compress=True))
+        expected = snapshot.get_full_state(times[-1])
+
+        self.assertTrue(snapshot.repack())
+        self.assertFalse(os.path.exists(os.path.join(snapshot.backup_dir, 'snapshots.tar.gz')))
+        snapshot._cache.clear()
+        self.assertEqual(snapshot.get_full_state(times[-1]), expected)
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_repack_is_resumable_under_budget(self):
+        snapshot, times = self._take_snapshots(SnapshotConfig(object_store=True))
+        expected = snapshot.get_full_state(times[-1])
+
+        runs = 0
+        while not snapshot.repack(pack_size=100, max_bytes=100):
+            runs += 1
+            snapshot._cache.clear()
+            self.assertEqual(snapshot.get_full_state(times[-1]), expected)
+        self.assertGreater(runs, 1)
+        self.assertGreater(len(snapshot.store.packs.keys()), 0)
+        self.assertEqual(list(snapshot.store.iter_loose()), [])
+        self.assertEqual(snapshot.verify(), {})
+
+if __name__ == '__main__':
+    unittest.main()
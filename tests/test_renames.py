@@ -0,0 +1,49 @@
+import os
+import unittest
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from helpers import SnapshotTestCase
+
+class TestRenames(SnapshotTestCase):
+    def test_rename_stores_no_content(self):
+        self._create_file('old.txt', 'content' * 100)
+        snapshot = Snapshot(self.test_dir)
+        first = snapshot.take_snapshot()
+        os.rename(os.path.join(self.test_dir, 'old.txt'), os.path.join(self.test_dir, 'new.txt'))
+        second = snapshot.take_snapshot()
+
+        self.assertEqual(snapshot.get_stored_diff(second), {'old.txt': None})
+        self.assertEqual(snapshot.last_stats.counters['files_moved'], 1)
+        self.assertEqual(snapshot.get_full_state(second), {'new.txt': b'content' * 100})
+        self.assertEqual(snapshot.get_full_state(first), {'old.txt': b'content' * 100})
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_similar_rename_keeps_content(self):
+        self._create_file('old.txt', 'line one\nline two\nline three\n')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(similarity_threshold=0.8))
+        snapshot.take_snapshot()
+        os.remove(os.path.join(self.test_dir, 'old.txt'))
+        self._create_file('new.txt', 'line one\nline 2\nline three\n')
+        second = snapshot.take_snapshot()
+
+        self.assertEqual(snapshot.get_stored_diff(second)['new.txt'], b'line one\nline 2\nline three\n')
+        self.assertEqual(snapshot.get_full_state(second), {'new.txt': b'line one\nline 2\nline three\n'})
+
+    def test_restore_replays_rename(self):
+        self._create_file('old.txt', 'content')
+        snapshot = Snapshot(self.test_dir)
+        snapshot.take_snapshot()
+        os.rename(os.path.join(self.test_dir, 'old.txt'), os.path.join(self.test_dir, 'new.txt'))
+        second = snapshot.take_snapshot()
+        # Go back to the state of the first snapshot
+        os.rename(os.path.join(self.test_dir, 'new.txt'), os.path.join(self.test_dir, 'old.txt'))
+
+        restore = Restore(self.test_dir)
+        self.assertTrue(restore._restore_snapshot(second))
+        self.assertEqual(restore.last_stats.counters['files_renamed'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'old.txt')))
+        with open(os.path.join(self.test_dir, 'new.txt')) as f:
+            self.assertEqual(f.read(), 'content')
+
+if __name__ == '__main__':
+    unittest.main()
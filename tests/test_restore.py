@@ -3,6 +3,7 @@ import shutil
 import tempfile
 import unittest
 from datetime import datetime, timedelta
+from unittest import mock
 from pyfilesnap.snapshot import Snapshot, SnapshotConfig
 from pyfilesnap.restore import Restore
 import time
@@ -19,6 +20,86 @@ class TestRestore(unittest.TestCase):
         with open(os.path.join(self.test_dir, filename), 'w') as f:
             f.write(content)
 
+    def _read_tree(self):
+        tree = {}
+        for root, dirs, files in os.walk(self.test_dir):
+            dirs[:] = [d for d in dirs if d != self.backup_dir]
+            for file in files:
+                path = os.path.join(root, file)
+                with open(path, 'rb') as f:
+                    tree[os.path.relpath(path, self.test_dir)] = f.read()
+        return tree
+
+    def _take_chain(self, config):
+        """Take a chain of snapshots, each changing a few files, and return their times."""
+        clock = mock.Mock(now=mock.Mock(side_effect=[datetime(2024, 1, 1) + timedelta(seconds=i)
+                                                     for i in range(1, 20)]))
+        snapshot = Snapshot(self.test_dir, config=config)
+        times = []
+        with mock.patch('pyfilesnap.snapshot.datetime', clock):
+            for i in range(6):
+                self._create_file('hot.txt', f'version {i}')
+                self._create_file(f'file{i}.txt', f'content {i}' * 50)
+                if i == 3:
+                    os.rename(os.path.join(self.test_dir, 'file0.txt'), os.path.join(self.test_dir, 'moved.txt'))
+                    os.remove(os.path.join(self.test_dir, 'file1.txt'))
+                times.append(snapshot.take_snapshot())
+        return snapshot, times
+
+    def test_pipelined_restore(self):
+        for config in (SnapshotConfig(), SnapshotConfig(compress=True, max_workers=3, max_memory_mb=0.0001),
+                       SnapshotConfig(object_store=True, max_workers=2)):
+            with self.subTest(config=config):
+                snapshot, times = self._take_chain(config)
+                for snapshot_time in times:
+                    snapshot._cache.clear()
+                    restore = Restore(self.test_dir, config=config)
+                    self.assertTrue(restore._restore_snapshot(snapshot_time))
+                    state = snapshot.get_full_state(snapshot_time)
+                    tree = self._read_tree()
+                    # Files the snapshot does not hold are left alone
+                    self.assertEqual({path: tree[path] for path in state}, state)
+                if not config.object_store:
+                    # Each file is decoded from the newest snapshot storing it only
+                    self.assertEqual(restore.last_stats.counters['files_decoded'], 6)
+                shutil.rmtree(self.test_dir)
+                os.makedirs(self.test_dir)
+                snapshot._cache.clear()
+
+    def test_damaged_chain_leaves_tree_untouched(self):
+        snapshot, times = self._take_chain(SnapshotConfig())
+        os.remove(os.path.join(self.test_dir, self.backup_dir, f'snapshot_{times[0]}.json'))
+        snapshot._cache.clear()
+        self._create_file('hot.txt', 'edited')
+        tree = self._read_tree()
+        self.assertFalse(Restore(self.test_dir)._restore_snapshot(times[-1]))
+        self.assertEqual(self._read_tree(), tree)
+
+    def test_partial_restore(self):
+        snapshot, times = self._take_chain(SnapshotConfig())
+        self._create_file('hot.txt', 'edited')
+        self._create_file('file5.txt', 'edited')
+        # Undo the rename of times[3], so that restoring it could replay the rename
+        os.rename(os.path.join(self.test_dir, 'moved.txt'), os.path.join(self.test_dir, 'file0.txt'))
+        restore = Restore(self.test_dir)
+        self.assertTrue(restore.restore_to_date(times[3], paths=['hot.txt']))
+        tree = self._read_tree()
+        self.assertEqual(tree['hot.txt'], b'version 3')
+        self.assertEqual(tree['file5.txt'], b'edited')
+        # The rename's destination is not selected, so its source stays where it is
+        self.assertIn('file0.txt', tree)
+        self.assertNotIn('moved.txt', tree)
+        self.assertEqual(restore.last_stats.counters['files'], 1)
+
+        self.assertTrue(restore.restore_to_date(times[3], paths=['moved.txt']))
+        tree = self._read_tree()
+        self.assertNotIn('file0.txt', tree)
+        self.assertEqual(tree['moved.txt'], b'content 0' * 50)
+        self.assertEqual(restore.last_stats.counters['files_renamed'], 1)
+
+        self.assertTrue(restore.restore_last(paths=['file5.txt/']))
+        self.assertEqual(self._read_tree()['file5.txt'], b'content 5' * 50)
+
     def _create_snapshot(self, compress=False):
         config = SnapshotConfig(compress=compress)
         snapshot = Snapshot(self.test_dir, config=config)
@@ -242,11 +242,8 @@ class TestSnapshot(unittest.TestCase):
         actual_state2 = snapshot.get_full_state(snapshot_time2)
         
         self.assertEqual(reconstructed_state2, actual_state2, "Reconstructed state does not match actual state")
-
-        # Add a check for circular reference warning
-        with self.assertLogs(level='WARNING') as cm:
-            snapshot.get_full_state(snapshot_time2)
-        self.assertTrue(any("Circular reference detected in snapshot chain" in msg for msg in cm.output))
+        # Both snapshots were taken within the same second, yet keep distinct names
+        self.assertNotEqual(snapshot_time1, snapshot_time2)
 
     def test_snapshot_custom_backup_dir(self):
         # Test snapshot creation with custom backup directory name
@@ -0,0 +1,78 @@
+import os
+import json
+import unittest
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from pyfilesnap.stats import OperationStats, Histogram
+from helpers import SnapshotTestCase
+
+class TestStats(SnapshotTestCase):
+    def test_histogram_buckets(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        self.assertEqual(histogram.cumulative(), [1, 2, 3])
+        self.assertEqual(histogram.count, 3)
+
+    def test_snapshot_stats(self):
+        self._create_file('file1.txt', 'Some content')
+        self._create_file('file2.txt', 'More content')
+        reported = []
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(stats_callback=reported.append))
+        snapshot.take_snapshot()
+
+        stats = snapshot.last_stats
+        self.assertEqual(reported, [stats])
+        self.assertEqual(stats.counters['files'], 2)
+        self.assertEqual(stats.counters['bytes_read'], 24)
+        self.assertGreater(stats.counters['bytes_written'], 0)
+        self.assertEqual(stats.histograms['read'].count, 2)
+        self.assertIn('write', stats.histograms)
+        # Uncompressed, the snapshot file is all that is written
+        self.assertEqual(stats.counters['bytes_written'], stats.counters['snapshot_bytes'])
+
+    def test_compressed_snapshot_bytes(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(compress=True))
+        snapshot_time = snapshot.take_snapshot()
+        stats = snapshot.last_stats
+        archive_path = os.path.join(snapshot.backup_dir, 'snapshots.tar.gz')
+        manifest_path = os.path.join(snapshot.backup_dir, 'manifests', f'{snapshot_time}.manifest')
+        self.assertEqual(stats.counters['bytes_written'], os.path.getsize(archive_path) + os.path.getsize(manifest_path))
+        self.assertGreater(stats.counters['snapshot_bytes'], 0)
+
+    def test_restore_stats(self):
+        self._create_file('file1.txt', 'Some content')
+        Snapshot(self.test_dir).take_snapshot()
+
+        reported = []
+        restore = Restore(self.test_dir, stats_callback=reported.append)
+        restore.restore_last()
+
+        stats = restore.last_stats
+        self.assertEqual(reported, [stats])
+        self.assertEqual(stats.counters['bytes_written'], 12)
+        self.assertIn('restore', stats.histograms)
+
+    def test_export_formats(self):
+        stats = OperationStats('snapshot')
+        stats.incr('files', 3)
+        with stats.phase('read'):
+            pass
+        stats.finish()
+
+        exported = json.loads(stats.to_json())
+        self.assertEqual(exported['counters'], {'files': 3})
+        self.assertEqual(exported['phases']['read']['count'], 1)
+
+        text = stats.to_prometheus()
+        self.assertIn('pyfilesnap_files_total{operation="snapshot"} 3', text)
+        self.assertIn('pyfilesnap_phase_seconds_count{operation="snapshot",phase="read"} 1', text)
+        self.assertIn('le="+Inf"', text)
+
+        with self.assertRaises(ValueError):
+            stats.observe('unknown', 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import json
+import stat
+import unittest
+from unittest import mock
+from pyfilesnap import store as store_module
+from pyfilesnap.store import ObjectStore, copy_file
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from pyfilesnap.utils import hash_data
+from helpers import SnapshotTestCase
+
+class TestStore(SnapshotTestCase):
+    def test_put_is_deduplicated_and_read_only(self):
+        store = ObjectStore(self.test_dir)
+        self.assertEqual(store.put(b'content'), 7)
+        self.assertEqual(store.put(b'content'), 0)
+        digest = hash_data(b'content')
+        self.assertEqual(store.get(digest), b'content')
+        self.assertFalse(os.stat(store.path(digest)).st_mode & stat.S_IWUSR)
+
+    def test_copy_file_fallbacks(self):
+        src = os.path.join(self.test_dir, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'x' * 100000)
+        for mode in ('auto', 'copy_file_range', 'sendfile', 'copy'):
+            dest = os.path.join(self.test_dir, f'dest_{mode}')
+            method = copy_file(src, dest, mode)
+            self.assertIn(method, ('reflink', 'copy_file_range', 'sendfile', 'copy'))
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 100000)
+
+        # A failing kernel copy falls back to a plain copy without leaving partial data
+        def broken(src, dst):
+            dst.write(b'partial')
+            raise OSError("unsupported")
+        with mock.patch.object(store_module, '_COPY_METHODS',
+                               (('reflink', broken), ('copy', store_module._plain_copy))):
+            dest = os.path.join(self.test_dir, 'dest_fallback')
+            self.assertEqual(copy_file(src, dest), 'copy')
+            self.assertEqual(os.path.getsize(dest), 100000)
+
+    def test_snapshot_with_object_store(self):
+        self._create_file('file1.txt', 'Shared content')
+        self._create_file('file2.txt', 'Shared content')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(object_store=True))
+        snapshot_time = snapshot.take_snapshot()
+
+        with open(os.path.join(snapshot.backup_dir, f'snapshot_{snapshot_time}.json')) as f:
+            snapshot_data = json.load(f)
+        digest = hash_data(b'Shared content')
+        self.assertEqual(snapshot_data['data'], {'file1.txt': digest, 'file2.txt': digest})
+        self.assertGreater(snapshot.last_stats.counters['bytes_written'], 0)
+        self.assertEqual(snapshot.get_stored_diff(snapshot_time)['file1.txt'], b'Shared content')
+        self.assertEqual(snapshot.verify(), {})
+
+        # Objects inside the backup directory are not snapshotted themselves
+        manifest = snapshot._load_manifest(snapshot_time)
+        self.assertEqual(sorted(manifest.to_index()), ['file1.txt', 'file2.txt'])
+        manifest.close()
+
+    def test_verify_detects_missing_object(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(object_store=True))
+        snapshot_time = snapshot.take_snapshot()
+        os.remove(snapshot.store.path(hash_data(b'Some content')))
+
+        report = snapshot.verify(fast=True)
+        self.assertTrue(any('is missing' in e for e in report[f'snapshot_{snapshot_time}.json']))
+
+    def test_restore_modes(self):
+        self._create_file('file1.txt', 'Initial content')
+        Snapshot(self.test_dir, config=SnapshotConfig(object_store=True)).take_snapshot()
+
+        for mode in ('auto', 'copy', 'hardlink'):
+            self._create_file('file1.txt', 'Modified content')
+            restore = Restore(self.test_dir, copy_mode=mode)
+            restore.restore_last()
+            self.assertEqual(self._read_file('file1.txt'), 'Initial content')
+            self.assertEqual(restore.last_stats.counters['bytes_written'], 15)
+
+        # A writable file is copied rather than sharing the read-only stored object
+        object_path = restore.snapshot.store.path(hash_data(b'Initial content'))
+        self.assertFalse(os.path.samefile(os.path.join(self.test_dir, 'file1.txt'), object_path))
+        self.assertNotIn('copy_hardlink', restore.last_stats.counters)
+
+    def test_hardlink_restore_keeps_objects_intact(self):
+        self._create_file('writable.txt', 'Writable content')
+        self._create_file('readonly.txt', 'Read-only content')
+        os.chmod(os.path.join(self.test_dir, 'readonly.txt'), 0o444)
+        os.utime(os.path.join(self.test_dir, 'readonly.txt'), ns=(10 ** 18, 10 ** 18))
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(object_store=True))
+        snapshot.take_snapshot()
+        readonly_object = snapshot.store.path(hash_data(b'Read-only content'))
+        object_stat = os.stat(readonly_object)
+        os.remove(os.path.join(self.test_dir, 'writable.txt'))
+        os.remove(os.path.join(self.test_dir, 'readonly.txt'))
+
+        restore = Restore(self.test_dir, copy_mode='hardlink')
+        self.assertTrue(restore.restore_last())
+        self.assertEqual(restore.last_stats.counters['copy_hardlink'], 1)
+        self.assertTrue(os.path.samefile(os.path.join(self.test_dir, 'readonly.txt'), readonly_object))
+        # The metadata pass leaves the shared inode alone
+        self.assertEqual(restore.last_stats.counters['files_hardlinked'], 1)
+        self.assertEqual(os.stat(readonly_object).st_mode, object_stat.st_mode)
+        self.assertEqual(os.stat(readonly_object).st_mtime_ns, object_stat.st_mtime_ns)
+
+        # Writing to the restored file does not reach the stored history
+        with open(os.path.join(self.test_dir, 'writable.txt'), 'a') as f:
+            f.write(' and more')
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_unknown_copy_mode(self):
+        with self.assertRaises(ValueError):
+            Restore(self.test_dir, copy_mode='teleport')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import threading
+import unittest
+from pyfilesnap import throttle as throttle_module
+from pyfilesnap.throttle import TokenBucket, Throttle, MB
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.restore import Restore
+from helpers import SnapshotTestCase
+
+class _FakeTime:
+    """A clock that only advances when sleeping."""
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class TestThrottle(SnapshotTestCase):
+    def test_token_bucket(self):
+        fake = _FakeTime()
+        bucket = TokenBucket(100, clock=fake.clock, sleep=fake.sleep)
+        self.assertEqual(bucket.consume(100), 0.0)  # The initial burst
+        self.assertAlmostEqual(bucket.consume(50), 0.5)
+        # Larger than the capacity: waits in proportion instead of forever
+        self.assertAlmostEqual(bucket.consume(300), 3.0)
+        fake.now += 10
+        self.assertEqual(bucket.consume(100), 0.0)  # Refilled, but never above capacity
+        self.assertGreater(bucket.consume(1), 0.0)
+
+    def test_adaptive_backoff(self):
+        fake = _FakeTime()
+        throttle = Throttle(adaptive=True, target_latency=0.01, sleep=fake.sleep)
+        self.assertEqual(throttle.record_latency(0.001, 4096), 0.0)
+        # Slow reads halve the share of time spent on the disk
+        throttle.record_latency(0.1, 4096)
+        self.assertEqual(throttle.duty_cycle, 0.5)
+        throttle.record_latency(0.1, 4096)
+        self.assertEqual(throttle.duty_cycle, 0.25)
+        self.assertAlmostEqual(fake.slept[-1], 0.3)
+        # Latency is measured per MiB, so large fast reads do not count as slow
+        for _ in range(50):
+            throttle.record_latency(0.001 * 8, 8 * MB)
+        self.assertEqual(throttle.duty_cycle, 1.0)
+
+    def test_parallel_capture_matches_sequential(self):
+        for i in range(20):
+            self._create_file(f'file{i}.txt', f'content {i}' * (i + 1))
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+        expected = snapshot.get_full_state(snapshot_time)
+        shutil.rmtree(snapshot.backup_dir)
+        snapshot._cache.clear()
+
+        config = SnapshotConfig(max_workers=4, max_memory_mb=0.0001, max_read_mbps=100, max_iops=10000,
+                                adaptive_throttle=True)
+        snapshot = Snapshot(self.test_dir, config=config)
+        snapshot_time = snapshot.take_snapshot()
+        self.assertEqual(snapshot.get_full_state(snapshot_time), expected)
+        self.assertEqual(snapshot.last_stats.counters['files'], 20)
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_io_threads_run_with_lowered_priority(self):
+        caller_ioprio = throttle_module.get_thread_ioprio()
+        seen = []
+
+        def worker():
+            SnapshotConfig(nice=5, ionice_class='idle').worker_initializer()()
+            seen.append((os.getpriority(os.PRIO_PROCESS, threading.get_native_id()),
+                         throttle_module.get_thread_ioprio()))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertGreaterEqual(seen[0][0], 5)
+        if caller_ioprio is not None:
+            self.assertEqual(seen[0][1], 3 << 13)  # Idle class
+            # Only the worker thread was affected
+            self.assertEqual(throttle_module.get_thread_ioprio(), caller_ioprio)
+
+        self._create_file('file1.txt', 'content')
+        config = SnapshotConfig(nice=5, ionice_class='idle', max_workers=2)
+        Snapshot(self.test_dir, config=config).take_snapshot()
+        self._create_file('file1.txt', 'modified')
+        restore = Restore(self.test_dir, config=config)
+        self.assertTrue(restore.restore_last())
+        with open(os.path.join(self.test_dir, 'file1.txt')) as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertEqual(throttle_module.get_thread_ioprio(), caller_ioprio)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            SnapshotConfig(ionice_class='lowest')
+        with self.assertRaises(ValueError):
+            SnapshotConfig(max_workers=0)
+
+if __name__ == '__main__':
+    unittest.main()
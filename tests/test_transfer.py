@@ -0,0 +1,222 @@
+import io
+import os
+import json
+import stat
+import shutil
+import struct
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.transfer import export, import_stream, EXPORT_INFO
+from pyfilesnap.__main__ import main
+from helpers import SnapshotTestCase
+
+class TestTransfer(SnapshotTestCase):
+    def setUp(self):
+        super().setUp()
+        # Files are created in the source directory
+        self.source_dir = self.test_dir
+        self.dest_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.dest_dir)
+
+    def _reset(self, *snapshots):
+        for snapshot in snapshots:
+            snapshot._cache.clear()
+        for directory in (self.source_dir, self.dest_dir):
+            shutil.rmtree(directory)
+            os.makedirs(directory)
+
+    def _take_snapshots(self, config=None):
+        snapshot = Snapshot(self.source_dir, config=config)
+        self._create_file('a.txt', 'first version of a')
+        self._create_file('dir/b.txt', '0123456789' * 10)
+        self._create_file('gone.txt', 'deleted later')
+        first = snapshot.take_snapshot()
+        self._create_file('a.txt', 'second version of a')
+        self._create_file('dir/c.txt', '0123456789' * 10)  # Same content as b.txt
+        os.remove(os.path.join(self.source_dir, 'gone.txt'))
+        second = snapshot.take_snapshot()
+        return snapshot, first, second
+
+    def _transfer(self, source, dest, **kwargs):
+        stream = io.BytesIO()
+        export(source, stream, **kwargs)
+        stream.seek(0)
+        return import_stream(dest, stream)
+
+    def test_pack_full_and_incremental(self):
+        for config in (None, SnapshotConfig(object_store=True, compress=True)):
+            with self.subTest(config=config):
+                source, first, second = self._take_snapshots(config)
+                dest = Snapshot(self.dest_dir, config=SnapshotConfig(object_store=True))
+                self.assertEqual(self._transfer(source, dest, snapshot_time=first, format='pack'), first)
+                self.assertEqual(self._transfer(source, dest, snapshot_time=second, format='pack', base=first),
+                                 second)
+                # b.txt was already sent with the base, c.txt shares its content
+                self.assertEqual(source.last_stats.counters['objects'], 1)
+                self.assertEqual(source.last_stats.counters['objects_skipped'], 1)
+
+                self.assertEqual(dest.list_snapshots(), [first, second])
+                self.assertEqual(dest.get_full_state(second), source.get_full_state(second))
+                self.assertEqual(dest.get_full_state(first), source.get_full_state(first))
+                self.assertEqual(dest.verify(), {})
+                self._reset(source, dest)
+
+    def test_import_deduplicates_against_repository(self):
+        source, first, second = self._take_snapshots()
+        dest = Snapshot(self.dest_dir, config=SnapshotConfig(object_store=True))
+        self._transfer(source, dest, snapshot_time=first, format='pack')
+        # A full export of the second snapshot carries objects the repository already has
+        self._transfer(source, dest, snapshot_time=second, format='pack')
+        self.assertEqual(dest.last_stats.counters['objects_deduplicated'], 1)
+        self.assertEqual(dest.last_stats.counters['objects_written'], 1)
+        self.assertEqual(dest.get_full_state(second), source.get_full_state(second))
+        # Importing a snapshot twice is a no-op
+        self.assertEqual(self._transfer(source, dest, snapshot_time=second, format='pack'), second)
+        self.assertEqual(dest.list_snapshots(), [first, second])
+
+    def test_tar_export(self):
+        source, first, second = self._take_snapshots()
+        stream = io.BytesIO()
+        export(source, stream, snapshot_time=second)
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode='r') as tar:
+            self.assertEqual(tar.getnames()[0], EXPORT_INFO)
+            self.assertEqual(sorted(tar.getnames()[1:]), ['a.txt', 'dir/b.txt', 'dir/c.txt'])
+            self.assertEqual(tar.extractfile('a.txt').read(), b'second version of a')
+
+        stream = io.BytesIO()
+        export(source, stream, snapshot_time=second, base=first)
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode='r') as tar:
+            self.assertEqual(sorted(tar.getnames()[1:]), ['a.txt', 'dir/c.txt'])
+
+    def test_tar_round_trip(self):
+        for config in (None, SnapshotConfig(object_store=True)):
+            with self.subTest(config=config):
+                source, first, second = self._take_snapshots(config)
+                dest = Snapshot(self.dest_dir, config=config)
+                self.assertEqual(self._transfer(source, dest, snapshot_time=first), first)
+                self.assertEqual(self._transfer(source, dest, snapshot_time=second, base=first), second)
+                self.assertEqual(dest.get_full_state(second), source.get_full_state(second))
+                self.assertEqual(dest.verify(), {})
+                self._reset(source, dest)
+
+    def test_plain_tar_import(self):
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tar:
+            for name, data in (('./x.txt', b'x'), ('.hidden', b'h'), ('../escape.txt', b'e')):
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+        stream.seek(0)
+        dest = Snapshot(self.dest_dir)
+        snapshot_time = import_stream(dest, stream)
+        self.assertEqual(dest.get_full_state(snapshot_time), {'x.txt': b'x', '.hidden': b'h'})
+
+    def test_tar_import_directories_and_owners(self):
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tar:
+            for name, kind, mode in (('.', tarfile.DIRTYPE, 0o755), ('dir', tarfile.DIRTYPE, 0o755),
+                                     ('dir/f.txt', tarfile.REGTYPE, 0o600), ('empty', tarfile.DIRTYPE, 0o750)):
+                member = tarfile.TarInfo(name)
+                member.type, member.mode, member.uid, member.gid = kind, mode, 1234, 5678
+                member.size = 1 if kind == tarfile.REGTYPE else 0
+                tar.addfile(member, io.BytesIO(b'f') if kind == tarfile.REGTYPE else None)
+        stream.seek(0)
+        dest = Snapshot(self.dest_dir)
+        snapshot_time = import_stream(dest, stream)
+        with dest.open(snapshot_time) as view:
+            # Only the empty directory is recorded, like a capture does
+            self.assertEqual(sorted(view.manifest.to_index()), ['dir/f.txt', 'empty'])
+            self.assertEqual(view.stat('empty').mode, stat.S_IFDIR | 0o750)
+            self.assertEqual(view.stat('dir/f.txt').mode, stat.S_IFREG | 0o600)
+            self.assertEqual((view.stat('dir/f.txt').uid, view.stat('dir/f.txt').gid), (1234, 5678))
+        self.assertEqual(dest.verify(), {})
+
+    def test_export_empty_repository(self):
+        for format in ('pack', 'tar'):
+            with self.assertRaises(ValueError):
+                export(Snapshot(self.source_dir), io.BytesIO(), format=format)
+
+    def test_missing_base_or_corrupt_stream(self):
+        source, first, second = self._take_snapshots()
+        dest = Snapshot(self.dest_dir, config=SnapshotConfig(object_store=True))
+        for format in ('pack', 'tar'):
+            with self.assertRaises(ValueError):
+                self._transfer(source, dest, snapshot_time=second, format=format, base=first)
+
+        stream = io.BytesIO()
+        export(source, stream, snapshot_time=first, format='pack')
+        data = bytearray(stream.getvalue())
+        with self.assertRaises(ValueError):
+            import_stream(dest, io.BytesIO(bytes(data[:len(data) // 2])))
+        # Flip a byte of the digest of the first object, after the magic and the header record
+        header_size = struct.unpack_from('<Q', data, 6)[0]
+        data[5 + 9 + header_size + 9] ^= 0xFF
+        with self.assertRaises(ValueError):
+            import_stream(dest, io.BytesIO(bytes(data)))
+        self.assertEqual(dest.list_snapshots(), [])
+
+    def test_pack_with_unsafe_paths(self):
+        source, first, _ = self._take_snapshots()
+        stream = io.BytesIO()
+        export(source, stream, snapshot_time=first, format='pack')
+        data = stream.getvalue()
+        # Records follow the magic: a type byte and a little-endian length, then the payload
+        offset, records = 5, []
+        while offset < len(data):
+            kind, length = struct.unpack_from('<cQ', data, offset)
+            records.append((kind, data[offset + 9:offset + 9 + length]))
+            offset += 9 + length
+
+        def tampered(change):
+            out = bytearray(data[:5])
+            for kind, payload in records:
+                if kind == b'M':
+                    snapshot_data = json.loads(payload)
+                    change(snapshot_data)
+                    payload = json.dumps(snapshot_data).encode()
+                out += struct.pack('<cQ', kind, len(payload)) + payload
+            return io.BytesIO(bytes(out))
+
+        def escape_data(snapshot_data):
+            snapshot_data['data']['../escaped'] = snapshot_data['data'].pop('a.txt')
+        def escape_index(snapshot_data):
+            snapshot_data['index']['/etc/escaped'] = snapshot_data['index']['a.txt']
+        def escape_moves(snapshot_data):
+            snapshot_data['moves'] = {'a.txt': 'dir/../../escaped'}
+        def escape_time(snapshot_data):
+            snapshot_data['time'] = '../../escaped'
+
+        dest = Snapshot(self.dest_dir, config=SnapshotConfig(object_store=True))
+        for change in (escape_data, escape_index, escape_moves, escape_time):
+            with self.subTest(change.__name__):
+                with self.assertRaises(ValueError):
+                    import_stream(dest, tampered(change))
+        self.assertEqual(dest.list_snapshots(), [])
+        self.assertEqual(import_stream(dest, tampered(lambda snapshot_data: None)), first)
+
+    def test_cli_keeps_repository_compression(self):
+        source, first, second = self._take_snapshots(SnapshotConfig(compress=True))
+        dest = Snapshot(self.dest_dir, config=SnapshotConfig(compress=True))
+        self._transfer(source, dest, snapshot_time=first, format='pack')
+
+        # No flags: both repositories are found to be compressed
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            self.assertEqual(main(['export', self.source_dir, '--base', first]), 0)
+        stdout.buffer.seek(0)
+        with mock.patch('sys.stdin', io.TextIOWrapper(stdout.buffer)), mock.patch('sys.stderr', io.StringIO()):
+            self.assertEqual(main(['import', self.dest_dir]), 0)
+        self.assertEqual(dest.list_snapshots(), [first, second])
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, '.pyfilesnap', f'snapshot_{second}.json')))
+        self.assertEqual(dest.get_full_state(second), source.get_full_state(second))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import json
+import base64
+import unittest
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from helpers import SnapshotTestCase
+
+class TestVerify(SnapshotTestCase):
+    def _snapshot_path(self, snapshot_time):
+        return os.path.join(self.test_dir, '.pyfilesnap', f'snapshot_{snapshot_time}.json')
+
+    def test_snapshot_records_hashes(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot_time = Snapshot(self.test_dir).take_snapshot()
+
+        with open(self._snapshot_path(snapshot_time)) as f:
+            snapshot_data = json.load(f)
+        self.assertEqual(snapshot_data['hash_algorithm'], 'sha256')
+        self.assertNotIn('index', snapshot_data)
+        self.assertEqual(len(snapshot_data['manifest']), 64)
+        self.assertIn('checksum', snapshot_data)
+        manifest = Snapshot(self.test_dir)._load_manifest(snapshot_time)
+        self.assertEqual(manifest.get('file1.txt').size, 12)
+        self.assertEqual(len(manifest.get('file1.txt').digest), 64)
+        manifest.close()
+
+    def test_verify_clean_repository(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir)
+        snapshot.take_snapshot()
+        self.assertEqual(snapshot.verify(), {})
+        self.assertEqual(snapshot.verify(fast=True), {})
+
+    def test_verify_detects_corrupted_content(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+
+        with open(self._snapshot_path(snapshot_time)) as f:
+            snapshot_data = json.load(f)
+        snapshot_data['data']['file1.txt'] = base64.b64encode(b'Corrupted').decode()
+        with open(self._snapshot_path(snapshot_time), 'w') as f:
+            json.dump(snapshot_data, f)
+
+        report = snapshot.verify()
+        errors = report[f'snapshot_{snapshot_time}.json']
+        self.assertTrue(any('checksum mismatch' in e for e in errors))
+        self.assertTrue(any('file1.txt content hash mismatch' in e for e in errors))
+        # The fast mode does not hash content
+        self.assertEqual(snapshot.verify(fast=True), {})
+
+    def test_verify_detects_missing_parent_and_bad_json(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+
+        with open(self._snapshot_path(snapshot_time)) as f:
+            snapshot_data = json.load(f)
+        snapshot_data['prev_snapshot'] = '19990101_000000'
+        with open(self._snapshot_path(snapshot_time), 'w') as f:
+            json.dump(snapshot_data, f)
+        with open(self._snapshot_path('20000101_000000'), 'w') as f:
+            f.write('{"truncated')
+
+        report = snapshot.verify(fast=True)
+        self.assertTrue(any('19990101_000000 is missing' in e for e in report[f'snapshot_{snapshot_time}.json']))
+        self.assertTrue(any('not valid JSON' in e for e in report['snapshot_20000101_000000.json']))
+
+    def test_verify_detects_bad_manifest_file(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir)
+        first = snapshot.take_snapshot()
+        self._create_file('file2.txt', 'Other content')
+        second = snapshot.take_snapshot()
+
+        manifest_path = os.path.join(snapshot.backup_dir, 'manifests', f'{first}.manifest')
+        with open(manifest_path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        os.remove(os.path.join(snapshot.backup_dir, 'manifests', f'{second}.manifest'))
+
+        report = snapshot.verify()
+        self.assertTrue(any('manifest file hash mismatch' in e for e in report[f'snapshot_{first}.json']))
+        self.assertTrue(any('manifest file is missing' in e for e in report[f'snapshot_{second}.json']))
+        self.assertTrue(any('manifest file is missing' in e for e in snapshot.verify(fast=True)[f'snapshot_{second}.json']))
+
+    def test_verify_compressed(self):
+        self._create_file('file1.txt', 'Some content')
+        snapshot = Snapshot(self.test_dir, config=SnapshotConfig(compress=True))
+        snapshot.take_snapshot()
+        self.assertEqual(snapshot.verify(), {})
+
+    def test_check_worktree(self):
+        self._create_file('file1.txt', 'Some content')
+        self._create_file('file2.txt', 'Other content')
+        self._create_file('file3.txt', 'Untouched')
+        snapshot = Snapshot(self.test_dir)
+        snapshot_time = snapshot.take_snapshot()
+
+        self._create_file('file1.txt', 'Changed content')
+        os.remove(os.path.join(self.test_dir, 'file2.txt'))
+        self._create_file('file4.txt', 'New file')
+        # Only the mtime changes: the file is hashed and found unchanged
+        os.utime(os.path.join(self.test_dir, 'file3.txt'), (1, 1))
+
+        report = snapshot.check_worktree(snapshot_time)
+        self.assertEqual(report, {'added': ['file4.txt'], 'removed': ['file2.txt'], 'modified': ['file1.txt']})
+
+if __name__ == '__main__':
+    unittest.main()
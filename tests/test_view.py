@@ -0,0 +1,90 @@
+import os
+import json
+import unittest
+from collections.abc import Mapping
+from unittest import mock
+from pyfilesnap.restore import Restore
+from pyfilesnap.snapshot import Snapshot, SnapshotConfig
+from pyfilesnap.utils import manifest_checksum
+from helpers import SnapshotTestCase
+
+class TestView(SnapshotTestCase):
+    def _take_snapshots(self, config):
+        snapshot = Snapshot(self.test_dir, config=config)
+        self._create_file('a.txt', 'first version of a')
+        self._create_file('dir/b.txt', '0123456789' * 10)
+        first = snapshot.take_snapshot()
+        self._create_file('a.txt', 'second version of a')
+        os.rename(os.path.join(self.test_dir, 'dir/b.txt'), os.path.join(self.test_dir, 'c.txt'))
+        second = snapshot.take_snapshot()
+        return snapshot, first, second
+
+    def _check_views(self, config):
+        snapshot, first, second = self._take_snapshots(config)
+        with snapshot.open(second) as view:
+            self.assertIsInstance(view, Mapping)
+            # dir is left empty by the rename, and recorded as an empty directory
+            self.assertEqual(list(view), ['a.txt', 'c.txt', 'dir'])
+            self.assertEqual(len(view), 3)
+            self.assertEqual(view['dir'], b'')
+            self.assertIn('c.txt', view)
+            self.assertNotIn('dir/b.txt', view)
+            self.assertEqual(view.stat('a.txt').size, 19)
+            self.assertEqual(view['a.txt'], b'second version of a')
+            # c.txt is a move recorded in the second snapshot: read through the chain
+            self.assertEqual(view.read_range('c.txt', 15, 10), b'5678901234')
+            with view.open('c.txt') as f:
+                f.seek(95)
+                self.assertEqual(f.read(), b'56789')
+            with self.assertRaises(FileNotFoundError):
+                view.stat('dir/b.txt')
+            with self.assertRaises(KeyError):
+                view['missing.txt']
+
+        with snapshot.open(first) as view:
+            self.assertEqual(dict(view), {'a.txt': b'first version of a', 'dir/b.txt': b'0123456789' * 10})
+
+    def test_view_inline_snapshots(self):
+        self._check_views(SnapshotConfig())
+
+    def test_view_object_store(self):
+        self._check_views(SnapshotConfig(object_store=True))
+
+    def test_view_does_not_reconstruct_state(self):
+        snapshot, first, second = self._take_snapshots(SnapshotConfig())
+        snapshot._cache.clear()
+        with mock.patch.object(Snapshot, '_reconstruct_state', side_effect=AssertionError):
+            with snapshot.open(second) as view:
+                self.assertEqual(view['a.txt'], b'second version of a')
+
+    def test_snapshots_with_inline_index(self):
+        # Snapshots written before manifest files kept their index in the snapshot itself
+        snapshot, first, second = self._take_snapshots(SnapshotConfig())
+        for snapshot_time in (first, second):
+            manifest = snapshot._load_manifest(snapshot_time)
+            index = manifest.to_index()
+            manifest.close()
+            os.remove(os.path.join(snapshot.backup_dir, 'manifests', f'{snapshot_time}.manifest'))
+            snapshot_path = os.path.join(snapshot.backup_dir, f'snapshot_{snapshot_time}.json')
+            with open(snapshot_path) as f:
+                snapshot_data = json.load(f)
+            del snapshot_data['manifest'], snapshot_data['checksum']
+            snapshot_data['index'] = index
+            snapshot_data['checksum'] = manifest_checksum(snapshot_data)
+            with open(snapshot_path, 'w') as f:
+                json.dump(snapshot_data, f)
+        snapshot = Snapshot(self.test_dir)
+
+        self.assertEqual(snapshot.verify(), {})
+        with snapshot.open(second) as view:
+            self.assertEqual(list(view), ['a.txt', 'c.txt', 'dir'])
+            self.assertEqual(view['c.txt'], b'0123456789' * 10)
+        os.remove(self._path('a.txt'))
+        self.assertTrue(Restore(self.test_dir).restore_last())
+        self.assertEqual(self._read_file('a.txt'), 'second version of a')
+        self._create_file('d.txt', 'new')
+        third = snapshot.take_snapshot()
+        self.assertEqual(snapshot.get_stored_diff(third), {'d.txt': b'new'})
+
+if __name__ == '__main__':
+    unittest.main()